@@ -1,130 +1,1930 @@
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, send_from_directory, send_file
+import os
+
+# Server mode has to be known before anything else is imported: 'threading'
+# is the development server, 'eventlet' and 'gevent' are the production async
+# modes and monkey-patch the standard library first.
+ASYNC_MODE = os.environ.get('CHATAPP_ASYNC_MODE', 'threading')
+OFFLOAD_THREADS = int(os.environ.get('CHATAPP_OFFLOAD_THREADS', 32))  # OS threads for blocking DB / CPU work
+if ASYNC_MODE == 'eventlet':
+    os.environ.setdefault('EVENTLET_THREADPOOL_SIZE', str(OFFLOAD_THREADS))
+    import eventlet
+    eventlet.monkey_patch()
+elif ASYNC_MODE == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, send_from_directory, send_file, g, Request, has_app_context
 from flask_socketio import SocketIO, emit, join_room
+from socketio import PubSubManager
 from warborne import WarBorne
 import sqlite3
-import os
-from datetime import datetime
+import hashlib
+import gzip
+import hmac
+import tempfile
+import click
+import json
+import html
+import sys
+import socket
+from datetime import datetime, timedelta
 from werkzeug.utils import secure_filename
 from io import BytesIO
+import threading
+import atexit
+import time
+import re
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.middleware.proxy_fix import ProxyFix
+from queue import LifoQueue, Queue, Empty
 try:
-    from PIL import Image
+    from PIL import Image, ImageOps
 except ImportError:
     Image = None
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'secret!'
-socketio = SocketIO(app)
 
-DB_NAME = 'chatapp.db'
+# --- SERVER MODE ---
+# In the async modes every socket shares one OS thread, so anything that
+# blocks in C (sqlite3, file I/O, Pillow, hashing) goes through run_blocking
+# to a real thread pool. SQLite connections from ConnectionPool are wrapped
+# so that happens on every execute/fetch/commit without touching call sites.
+SERVER_HOST = os.environ.get('CHATAPP_HOST', '127.0.0.1')
+SERVER_PORT = int(os.environ.get('CHATAPP_PORT', 5000))
+SERVER_BACKLOG = int(os.environ.get('CHATAPP_BACKLOG', 4096))                 # listen() queue for connect bursts
+SERVER_MAX_CONNECTIONS = int(os.environ.get('CHATAPP_MAX_CONNECTIONS', 60000))  # concurrent sockets (eventlet)
+SOCKET_PING_INTERVAL = int(os.environ.get('CHATAPP_PING_INTERVAL', 25))  # seconds between server pings
+SOCKET_PING_TIMEOUT = int(os.environ.get('CHATAPP_PING_TIMEOUT', 20))    # seconds to wait for a pong
+SOCKET_MAX_BUFFER = int(os.environ.get('CHATAPP_MAX_BUFFER', 1000000))   # largest accepted packet, bytes
+# Wire format. WebSocket frames are permessage-deflate compressed whenever the
+# browser offers it (simple-websocket and eventlet negotiate it; gevent-websocket
+# does not); long-polling responses over the threshold are gzipped.
+SOCKET_COMPRESSION_THRESHOLD = int(os.environ.get('CHATAPP_COMPRESSION_THRESHOLD', 1024))  # bytes
+SOCKET_SERIALIZER = os.environ.get('CHATAPP_SOCKET_SERIALIZER', 'default')  # 'msgpack' for binary frames
+SOCKET_COMPACT = os.environ.get('CHATAPP_SOCKET_COMPACT') == '1'            # short field codes (see WIRE_FIELDS)
+SOCKET_BATCH_WINDOW = float(os.environ.get('CHATAPP_SOCKET_BATCH_WINDOW', 0))  # seconds; 0 sends each message at once
+SOCKET_BATCH_MAX = 100  # events per batched frame
+
+if ASYNC_MODE == 'eventlet':
+    from eventlet import tpool
+
+    def run_blocking(fn, *args, **kwargs):
+        return tpool.execute(fn, *args, **kwargs)
+elif ASYNC_MODE == 'gevent':
+    import gevent
+    gevent.get_hub().threadpool.maxsize = OFFLOAD_THREADS
+
+    def run_blocking(fn, *args, **kwargs):
+        return gevent.get_hub().threadpool.apply(fn, args, kwargs)
+else:
+    def run_blocking(fn, *args, **kwargs):
+        return fn(*args, **kwargs)
+
+class OffloadedCursor:
+    """InstrumentedCursor whose blocking calls run through run_blocking.
+
+    The call's timing is recorded afterwards, back in the calling greenlet:
+    the metric locks and logging are green under monkey-patching and can't
+    be taken from the offload thread.
+    """
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def _call(self, fn, *args):
+        try:
+            return run_blocking(fn, *args)
+        finally:
+            self._cursor.record()
+
+    def execute(self, *args):
+        self._call(self._cursor.execute, *args)
+        return self
+
+    def executemany(self, *args):
+        self._call(self._cursor.executemany, *args)
+        return self
+
+    def fetchone(self):
+        return self._call(self._cursor.fetchone)
+
+    def fetchmany(self, *args):
+        return self._call(self._cursor.fetchmany, *args)
+
+    def fetchall(self):
+        return self._call(self._cursor.fetchall)
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def __getattr__(self, name):
+        # rowcount, lastrowid, description, close
+        return getattr(self._cursor, name)
+
+class OffloadedConnection:
+    """sqlite3.Connection whose blocking calls run through run_blocking."""
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def cursor(self):
+        return OffloadedCursor(self._conn.cursor())
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+    def commit(self):
+        run_blocking(self._conn.commit)
+
+    def rollback(self):
+        run_blocking(self._conn.rollback)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+class ProcessPool:
+    """ProcessPoolExecutor started on first use and replaced when it breaks.
+
+    A worker that dies (OOM killer, segfault, SIGKILL) leaves its executor
+    broken for good; ``reset`` drops it so the next call starts a fresh one.
+    """
+
+    def __init__(self, max_workers, initializer=None):
+        self.max_workers = max_workers
+        self.initializer = initializer
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def __call__(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers, initializer=self.initializer)
+            return self._executor
+
+    def reset(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def submit_cpu(pool, fn, *args):
+    # Process pools don't mix with a monkey-patched server; in the async
+    # modes the work goes to run_blocking's threads and a Future is returned
+    # all the same
+    if ASYNC_MODE == 'threading':
+        executor = pool()
+        try:
+            return executor.submit(fn, *args)
+        except BrokenProcessPool:
+            app.logger.warning('%s process pool broke, starting a new one', getattr(fn, '__name__', fn))
+            pool.reset(executor)
+            return pool().submit(fn, *args)
+    future = Future()
+
+    def run():
+        try:
+            future.set_result(run_blocking(fn, *args))
+        except BaseException as e:
+            future.set_exception(e)
+    socketio.start_background_task(run)
+    return future
+
+def run_cpu(pool, fn, *args, timeout=None):
+    # submit_cpu(...).result(), run once more on a fresh pool if the worker died mid-call
+    try:
+        return submit_cpu(pool, fn, *args).result(timeout=timeout)
+    except BrokenProcessPool:
+        return submit_cpu(pool, fn, *args).result(timeout=timeout)
+
+# --- METRICS ---
+# In-process Prometheus-style metrics, rendered by /metrics. Routes are timed
+# by the request hooks below, Socket.IO events by instrument_socket_handlers()
+# and SQL statements by InstrumentedConnection (ConnectionPool uses it).
+app.logger.setLevel(os.environ.get('CHATAPP_LOG_LEVEL', 'INFO').upper())
+METRICS_TOKEN = os.environ.get('CHATAPP_METRICS_TOKEN')  # if set, /metrics wants "Authorization: Bearer <token>"
+SLOW_QUERY_MS = float(os.environ.get('CHATAPP_SLOW_QUERY_MS', 0))  # log statements slower than this; 0 = off
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SQL_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+
+def _label_text(names, values):
+    if not names:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in values)
+    return '{' + ','.join(f'{n}="{v}"' for n, v in zip(names, escaped)) + '}'
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, labels
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for labels, value in self._values.items():
+                lines.append(f'{self.name}{_label_text(self.labels, labels)} {value}')
+        return lines
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        self._lock = threading.Lock()
+        self._series = {}  # labels: [per-bucket counts (+Inf last), sum, count]
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for labels, (counts, total, count) in self._series.items():
+                cumulative = 0
+                for bound, n in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += n
+                    lines.append(f'{self.name}_bucket{_label_text(self.labels + ("le",), labels + (bound,))} {cumulative}')
+                lines.append(f'{self.name}_sum{_label_text(self.labels, labels)} {total}')
+                lines.append(f'{self.name}_count{_label_text(self.labels, labels)} {count}')
+        return lines
+
+class Gauge:
+    """Read at scrape time from ``fn``, which returns a number or {labels tuple: number}."""
+
+    def __init__(self, name, help, fn, labels=(), kind='gauge'):
+        self.name, self.help, self.fn, self.labels, self.kind = name, help, fn, labels, kind
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        try:
+            value = self.fn()
+        except Exception as e:
+            app.logger.warning('Metric %s failed: %s', self.name, e)
+            return lines
+        for labels, v in (value.items() if isinstance(value, dict) else [((), value)]):
+            lines.append(f'{self.name}{_label_text(self.labels, labels)} {v}')
+        return lines
+
+metrics = []  # everything /metrics renders, in order
+
+def register_metric(metric):
+    metrics.append(metric)
+    return metric
+
+http_latency = register_metric(Histogram('chatapp_http_request_seconds', 'Flask route latency.',
+                                         ('endpoint', 'method', 'status')))
+socket_latency = register_metric(Histogram('chatapp_socketio_event_seconds', 'Socket.IO event handler latency.',
+                                           ('event',)))
+socket_errors = register_metric(Counter('chatapp_socketio_event_errors_total',
+                                        'Socket.IO event handlers that raised.', ('event',)))
+sql_latency = register_metric(Histogram('chatapp_sql_seconds', 'SQLite statement time, execute plus fetch.',
+                                        ('verb', 'table'), SQL_BUCKETS))
+slow_queries = register_metric(Counter('chatapp_sql_slow_total', 'Statements slower than CHATAPP_SLOW_QUERY_MS.',
+                                       ('verb', 'table')))
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_time(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        http_latency.observe(time.perf_counter() - started, request.endpoint or 'unmatched',
+                             request.method, str(response.status_code))
+    return response
+
+def instrument_socket_handlers():
+    # Wraps every registered Socket.IO handler; call once all handlers exist
+    for handlers in socketio.server.handlers.values():
+        for event, handler in list(handlers.items()):
+            handlers[event] = _timed_handler(event, handler)
+
+def _timed_handler(event, handler):
+    def timed(*args):
+        started = time.perf_counter()
+        try:
+            return handler(*args)
+        except Exception:
+            socket_errors.inc(event)
+            raise
+        finally:
+            socket_latency.observe(time.perf_counter() - started, event)
+    return timed
+
+_SQL_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE(?:\s+IF\s+NOT\s+EXISTS)?|ON)\s+"?(\w+)', re.IGNORECASE)
+_sql_labels = {}
+
+def sql_labels(sql):
+    # (verb, table) for a statement; bounded because IN (?, ?, ...) lists make many distinct strings
+    labels = _sql_labels.get(sql)
+    if labels is None:
+        match = _SQL_TABLE.search(sql)
+        labels = (sql.split(None, 1)[0].upper() if sql.strip() else '', match.group(1) if match else '')
+        if len(_sql_labels) > 4096:
+            _sql_labels.clear()
+        _sql_labels[sql] = labels
+    return labels
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Charges execute and the following fetches to the statement's (verb, table)."""
+    _sql = ''
+    _labels = ('', '')
+    _elapsed = None  # last call's time, until record() charges it
+
+    def _timed(self, fn, *args):
+        started = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self._elapsed = time.perf_counter() - started
+            if ASYNC_MODE == 'threading':
+                self.record()  # otherwise OffloadedCursor does, off the offload thread
+
+    def record(self):
+        elapsed, self._elapsed = self._elapsed, None
+        if elapsed is None:
+            return
+        sql_latency.observe(elapsed, *self._labels)
+        if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+            slow_queries.inc(*self._labels)
+            app.logger.warning('Slow query (%.1f ms): %s', elapsed * 1000, ' '.join(self._sql.split())[:500])
+
+    def execute(self, sql, *args):
+        self._sql, self._labels = sql, sql_labels(sql)
+        return self._timed(super().execute, sql, *args)
+
+    def executemany(self, sql, *args):
+        self._sql, self._labels = sql, sql_labels(sql)
+        return self._timed(super().executemany, sql, *args)
+
+    def fetchone(self):
+        return self._timed(super().fetchone)
+
+    def fetchmany(self, *args):
+        return self._timed(super().fetchmany, *args)
+
+    def fetchall(self):
+        return self._timed(super().fetchall)
+
+class InstrumentedConnection(sqlite3.Connection):
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+# Cross-process fan-out for running several workers: redis://, amqp://,
+# kafka:// (handled by python-socketio) or sqlite:///<file> (SQLitePubSubManager)
+MESSAGE_QUEUE = os.environ.get('CHATAPP_MESSAGE_QUEUE')
+
+class SQLitePubSubManager(PubSubManager):
+    """Socket.IO pub/sub backend on a shared SQLite file.
+
+    A broker-less stand-in for Redis so several workers on one machine (and
+    tests) can share emits. Published messages are appended to a table that
+    every listener polls; rows older than ``retention`` seconds are pruned.
+    """
+    name = 'sqlite'
+
+    def __init__(self, url, channel='socketio', write_only=False, logger=None,
+                 poll_interval=0.02, retention=60):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        # sqlite:///relative.db or sqlite:////absolute.db
+        self.path = url.split('://', 1)[1][1:]
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._published = 0
+        self._writer = self._connect()
+        self._writer.execute('''CREATE TABLE IF NOT EXISTS pubsub (
+            id      INTEGER PRIMARY KEY AUTOINCREMENT,
+            channel TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            created REAL NOT NULL
+        )''')
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False, timeout=5)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _publish(self, data):
+        run_blocking(self._publish_sync, data)
+
+    def _publish_sync(self, data):
+        with self._lock:
+            now = time.time()
+            self._writer.execute('INSERT INTO pubsub (channel, payload, created) VALUES (?, ?, ?)',
+                                 (self.channel, self.json.dumps(data), now))
+            self._published += 1
+            if self._published % 500 == 0:
+                self._writer.execute('DELETE FROM pubsub WHERE created < ?', (now - self.retention,))
+
+    def _listen(self):
+        conn = self._connect()
+        last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM pubsub').fetchone()[0]
+        while True:
+            rows = run_blocking(lambda: conn.execute('SELECT id, payload FROM pubsub WHERE id > ? AND channel = ? '
+                                                     'ORDER BY id', (last_id, self.channel)).fetchall())
+            for last_id, payload in rows:
+                yield payload
+            if not rows:
+                self.server.sleep(self.poll_interval)
+
+def socketio_options():
+    if not MESSAGE_QUEUE:
+        return {}
+    if MESSAGE_QUEUE.startswith('sqlite://'):
+        return {'client_manager': SQLitePubSubManager(MESSAGE_QUEUE)}
+    return {'message_queue': MESSAGE_QUEUE}
+
+socketio = SocketIO(app, async_mode=ASYNC_MODE,
+                    ping_interval=SOCKET_PING_INTERVAL, ping_timeout=SOCKET_PING_TIMEOUT,
+                    max_http_buffer_size=SOCKET_MAX_BUFFER, compression_threshold=SOCKET_COMPRESSION_THRESHOLD,
+                    serializer=SOCKET_SERIALIZER, **socketio_options())
+
+DB_NAME = os.environ.get('CHATAPP_DB', 'chatapp.db')
+
+# Connection pool sizing / SQLite tuning
+DB_POOL_SIZE = int(os.environ.get('CHATAPP_DB_POOL_SIZE', 16))
+DB_POOL_TIMEOUT = float(os.environ.get('CHATAPP_DB_POOL_TIMEOUT', 10))
+DB_STATEMENT_CACHE = 256
+DB_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('busy_timeout', 5000),
+    ('cache_size', -16000),       # ~16 MB page cache per connection
+    ('mmap_size', 268435456),     # 256 MB
+    ('temp_store', 'MEMORY'),
+)
+
+CHAT_PAGE_SIZE = 50    # default messages per chat_history page
+CHAT_PAGE_MAX = 200
+CHAT_SYNC_MAX = 1000   # cap for a single since= catch-up
+
+# Opt-in group commit for chat messages (see WriteBehindQueue)
+WRITE_BEHIND = os.environ.get('CHATAPP_WRITE_BEHIND') == '1'
+WRITE_BEHIND_BATCH = int(os.environ.get('CHATAPP_WRITE_BEHIND_BATCH', 256))
+WRITE_BEHIND_INTERVAL = float(os.environ.get('CHATAPP_WRITE_BEHIND_INTERVAL', 0.005))
+WRITE_BEHIND_FSYNC = os.environ.get('CHATAPP_WRITE_BEHIND_FSYNC') == '1'  # also survive power loss
+WRITE_BEHIND_RETRY_MIN = 0.05  # seconds before retrying a failed commit, doubling up to the max
+WRITE_BEHIND_RETRY_MAX = 5.0
+WRITE_BEHIND_ROTATE_BYTES = 4 * 1024 * 1024  # committed journal bytes kept before rewriting it
+
+# Messages older than this move to per-month files under ARCHIVE_FOLDER (flask archive-messages)
+ARCHIVE_FOLDER = os.environ.get('CHATAPP_ARCHIVE', 'archive')
+ARCHIVE_AFTER_DAYS = int(os.environ.get('CHATAPP_ARCHIVE_AFTER_DAYS', 180))
+
+SEARCH_PAGE_SIZE = 20
+SEARCH_PAGE_MAX = 50
 
 UPLOAD_FOLDER = 'uploads'
+ATTACHMENT_FOLDER = os.environ.get('CHATAPP_ATTACHMENTS', 'attachments')
+ATTACHMENT_CHUNK_SIZE = 1024 * 1024
+ATTACHMENT_MAX_AGE = 365 * 24 * 3600  # content-addressed, so safe to cache for a year
+# Minified, content-hashed copies of static/ with .gz/.br variants (flask build-assets)
+ASSET_SOURCES = ('chat.js', 'style.css', 'auth.js', 'auth.css')
+ASSET_FOLDER = os.path.join(app.static_folder, 'dist')
+ASSET_MANIFEST = os.path.join(ASSET_FOLDER, 'manifest.json')
+MAX_UPLOAD_SIZE = int(os.environ.get('CHATAPP_MAX_UPLOAD', 50 * 1024 * 1024))
+IMAGE_VARIANT_SIZES = (64, 256, 1024)  # thumbnail bounding boxes, in pixels
+IMAGE_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+IMAGE_QUEUE_LIMIT = 32                 # images queued or in flight before we stop generating variants
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'pdf', 'txt', 'doc', 'docx', 'xls', 'xlsx', 'zip', 'rar', 'mp4', 'mp3', 'csv'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.config['ATTACHMENT_FOLDER'] = ATTACHMENT_FOLDER
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_SIZE + 64 * 1024  # multipart overhead
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+os.makedirs(ATTACHMENT_FOLDER, exist_ok=True)
+
+class ConnectionPool:
+    """Bounded pool of tuned SQLite connections shared by requests and socket handlers.
+
+    Connections are handed out LIFO so the hottest ones (warm page cache and
+    statement cache) get reused first. Callers block for up to ``timeout``
+    seconds when every connection is checked out.
+    """
+
+    def __init__(self, database, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT):
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self._idle = LifoQueue(maxsize=size)
+        self._lock = threading.Lock()
+        self._created = 0
+        self._checked_out = 0
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._timeouts = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.database, check_same_thread=False,
+                               cached_statements=DB_STATEMENT_CACHE, factory=InstrumentedConnection)
+        conn.row_factory = sqlite3.Row
+        for name, value in DB_PRAGMAS:
+            conn.execute(f'PRAGMA {name}={value}')
+        return conn if ASYNC_MODE == 'threading' else OffloadedConnection(conn)
+
+    def acquire(self):
+        try:
+            conn = self._idle.get_nowait()
+        except Empty:
+            conn = None
+            with self._lock:
+                if self._created < self.size:
+                    self._created += 1
+                    create = True
+                else:
+                    create = False
+            if create:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                started = time.perf_counter()
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except Empty:
+                    with self._lock:
+                        self._timeouts += 1
+                    raise RuntimeError('Timed out waiting for a database connection')
+                finally:
+                    with self._lock:
+                        self._waits += 1
+                        self._wait_time += time.perf_counter() - started
+        with self._lock:
+            self._checked_out += 1
+            self._checkouts += 1
+        return conn
+
+    def release(self, conn):
+        # Never hand a connection with a dangling transaction to the next caller
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            self._checked_out -= 1
+        self._idle.put_nowait(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self.size,
+                'created': self._created,
+                'idle': self._idle.qsize(),
+                'checked_out': self._checked_out,
+                'checkouts': self._checkouts,
+                'waits': self._waits,
+                'wait_time': round(self._wait_time, 6),
+                'timeouts': self._timeouts,
+            }
+
+db_pool = ConnectionPool(DB_NAME)
 
 def get_db():
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    return conn
-
-def init_db():
-    if not os.path.exists(DB_NAME):
-        conn = get_db()
-        c = conn.cursor()
-        c.execute('''CREATE TABLE user (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            last_seen DATETIME DEFAULT CURRENT_TIMESTAMP,
-            profile_picture TEXT NOT NULL
-        )''')
-        c.execute('''CREATE TABLE friend (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            friend_id INTEGER NOT NULL,
-            status TEXT NOT NULL,
-            FOREIGN KEY(user_id) REFERENCES user(id),
-            FOREIGN KEY(friend_id) REFERENCES user(id)
-        )''')
-        c.execute('''CREATE TABLE message (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            sender_id INTEGER NOT NULL,
-            receiver_id INTEGER NOT NULL,
-            message TEXT NOT NULL,
-            timestamp DATETIME NOT NULL,
-            read INTEGER DEFAULT 0,
-            read_at DATETIME,
-            FOREIGN KEY(sender_id) REFERENCES user(id),
-            FOREIGN KEY(receiver_id) REFERENCES user(id)
-        )''')
-        c.execute('''CREATE TABLE file (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            filename TEXT NOT NULL,
-            mimetype TEXT NOT NULL,
-            data BLOB NOT NULL,
-            timestamp DATETIME NOT NULL,
-            FOREIGN KEY(user_id) REFERENCES user(id)
-        )''')
+    # One pooled connection per request / socket event, returned on teardown
+    if 'db' not in g:
+        g.db = db_pool.acquire()
+    return g.db
+
+@app.teardown_appcontext
+def release_db(exc):
+    conn = g.pop('db', None)
+    if conn is not None:
+        db_pool.release(conn)
+
+# Schema as of migration 1 (see MIGRATIONS below). These lists are frozen:
+# later changes go in a new migration so they reach existing databases once.
+# Columns added after the original schema: (table, column, declaration)
+SCHEMA_COLUMNS = [
+    ('file', 'sha256', 'TEXT'),   # content hash; set once the bytes live in ATTACHMENT_FOLDER
+    ('file', 'size', 'INTEGER'),
+    ('user', 'avatar', 'TEXT'),   # sha256 of a custom avatar in the store; NULL means the default
+]
+
+SCHEMA_TABLES = [
+    '''CREATE TABLE IF NOT EXISTS socket_route (
+        sid          TEXT PRIMARY KEY,
+        user_id      INTEGER NOT NULL,
+        node         TEXT NOT NULL,
+        connected_at REAL NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS socket_node (
+        node      TEXT PRIMARY KEY,
+        heartbeat REAL NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS device_cursor (
+        user_id          INTEGER NOT NULL,
+        device_id        TEXT NOT NULL,
+        message_id       INTEGER NOT NULL DEFAULT 0,
+        group_message_id INTEGER NOT NULL DEFAULT 0,
+        updated_at       DATETIME,
+        PRIMARY KEY (user_id, device_id)
+    )''',
+    '''CREATE TABLE IF NOT EXISTS file_variant (
+        sha256   TEXT NOT NULL,
+        variant  TEXT NOT NULL,
+        path     TEXT NOT NULL,
+        mimetype TEXT NOT NULL,
+        size     INTEGER NOT NULL,
+        PRIMARY KEY (sha256, variant)
+    )''',
+    # One row per user per conversation partner, kept current by insert_private_messages
+    # and mark_read so the inbox never has to scan message
+    '''CREATE TABLE IF NOT EXISTS conversation (
+        user_id         INTEGER NOT NULL,
+        peer_id         INTEGER NOT NULL,
+        last_message_id INTEGER NOT NULL,
+        last_sender_id  INTEGER NOT NULL,
+        preview         TEXT NOT NULL,
+        last_timestamp  TEXT,
+        unread          INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, peer_id)
+    )''',
+    '''CREATE TABLE IF NOT EXISTS avatar_variant (
+        sha256   TEXT NOT NULL,
+        size     INTEGER NOT NULL,
+        path     TEXT NOT NULL,
+        mimetype TEXT NOT NULL,
+        bytes    INTEGER NOT NULL,
+        PRIMARY KEY (sha256, size)
+    )''',
+]
+
+SCHEMA_INDEXES = [
+    # Conversation pair in canonical order, so both directions share one index range
+    '''CREATE INDEX IF NOT EXISTS idx_message_pair
+       ON message (min(sender_id, receiver_id), max(sender_id, receiver_id), id)''',
+    'CREATE INDEX IF NOT EXISTS idx_file_sha256 ON file (sha256)',
+    'CREATE INDEX IF NOT EXISTS idx_socket_route_user ON socket_route (user_id)',
+    # Friendships are looked up from either side
+    'CREATE INDEX IF NOT EXISTS idx_friend_user ON friend (user_id, friend_id)',
+    'CREATE INDEX IF NOT EXISTS idx_friend_friend ON friend (friend_id, user_id)',
+    # Per-user replay of everything after a device cursor
+    'CREATE INDEX IF NOT EXISTS idx_message_receiver ON message (receiver_id, id)',
+    'CREATE INDEX IF NOT EXISTS idx_message_sender ON message (sender_id, id)',
+    # Group history pages and replay scan one group's messages by id
+    'CREATE INDEX IF NOT EXISTS idx_group_message_group ON group_message (group_id, id)',
+    # Membership is loaded per user on connect and per group on accept
+    'CREATE INDEX IF NOT EXISTS idx_group_member_user ON group_member (user_id, status, group_id)',
+    'CREATE INDEX IF NOT EXISTS idx_group_member_group ON group_member (group_id, user_id)',
+    # mark_read's UPDATE and the conversation rebuild's unread counts
+    'CREATE INDEX IF NOT EXISTS idx_message_unread ON message (receiver_id, sender_id, read)',
+    # Inbox: a user's conversations, most recent first
+    'CREATE INDEX IF NOT EXISTS idx_conversation_recent ON conversation (user_id, last_message_id)',
+    # Case-insensitive prefix search (LIKE 'abc%') runs as a range scan on this
+    'CREATE INDEX IF NOT EXISTS idx_user_username_nocase ON user (username COLLATE NOCASE)',
+]
+
+def fts5_trigram_available():
+    try:
+        sqlite3.connect(':memory:').execute("CREATE VIRTUAL TABLE t USING fts5(x, tokenize='trigram')")
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+FTS_AVAILABLE = fts5_trigram_available()
+
+# External-content FTS5 tables kept in sync by triggers. Each is rebuilt from
+# its source table the first time it is created.
+FTS_INDEXES = {
+    'user_search': [
+        "CREATE VIRTUAL TABLE user_search USING fts5(username, content='user', content_rowid='id', tokenize='trigram')",
+        '''CREATE TRIGGER user_search_ai AFTER INSERT ON user BEGIN
+               INSERT INTO user_search(rowid, username) VALUES (new.id, new.username);
+           END''',
+        '''CREATE TRIGGER user_search_ad AFTER DELETE ON user BEGIN
+               INSERT INTO user_search(user_search, rowid, username) VALUES ('delete', old.id, old.username);
+           END''',
+        '''CREATE TRIGGER user_search_au AFTER UPDATE OF username ON user BEGIN
+               INSERT INTO user_search(user_search, rowid, username) VALUES ('delete', old.id, old.username);
+               INSERT INTO user_search(rowid, username) VALUES (new.id, new.username);
+           END''',
+    ],
+    # Message indexes are fed by insert_private_messages / insert_group_messages
+    'message_fts': [
+        "CREATE VIRTUAL TABLE message_fts USING fts5(message, content='message', content_rowid='id', "
+        "tokenize='porter unicode61 remove_diacritics 2')",
+    ],
+    'group_message_fts': [
+        "CREATE VIRTUAL TABLE group_message_fts USING fts5(message, content='group_message', content_rowid='id', "
+        "tokenize='porter unicode61 remove_diacritics 2')",
+    ],
+}
+
+def create_schema(conn):
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS user (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT UNIQUE NOT NULL,
+        password_hash TEXT NOT NULL,
+        last_seen DATETIME DEFAULT CURRENT_TIMESTAMP,
+        profile_picture TEXT NOT NULL
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS friend (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        friend_id INTEGER NOT NULL,
+        status TEXT NOT NULL,
+        FOREIGN KEY(user_id) REFERENCES user(id),
+        FOREIGN KEY(friend_id) REFERENCES user(id)
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS message (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        sender_id INTEGER NOT NULL,
+        receiver_id INTEGER NOT NULL,
+        message TEXT NOT NULL,
+        timestamp DATETIME NOT NULL,
+        read INTEGER DEFAULT 0,
+        read_at DATETIME,
+        FOREIGN KEY(sender_id) REFERENCES user(id),
+        FOREIGN KEY(receiver_id) REFERENCES user(id)
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS file (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        filename TEXT NOT NULL,
+        mimetype TEXT NOT NULL,
+        data BLOB NOT NULL,
+        timestamp DATETIME NOT NULL,
+        FOREIGN KEY(user_id) REFERENCES user(id)
+    )''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS "group"
+                 (
+                     id         INTEGER PRIMARY KEY AUTOINCREMENT,
+                     name       TEXT NOT NULL,
+                     owner_id   INTEGER REFERENCES user (id),
+                     created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                 )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS group_member
+                 (
+                     id         INTEGER PRIMARY KEY AUTOINCREMENT,
+                     group_id   INTEGER REFERENCES "group" (id),
+                     user_id    INTEGER REFERENCES user (id),
+                     invited_by INTEGER REFERENCES user (id),
+                     status     TEXT CHECK (status IN ('pending', 'accepted')) DEFAULT 'pending',
+                     joined_at  DATETIME
+                 )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS group_message
+                 (
+                     id        INTEGER PRIMARY KEY AUTOINCREMENT,
+                     group_id  INTEGER REFERENCES "group" (id),
+                     sender_id INTEGER REFERENCES user (id),
+                     message   TEXT NOT NULL,
+                     timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+                 )''')
+
+@app.cli.command('rebuild-search')
+def rebuild_search():
+    """Rebuild every full-text index from its source table."""
+    if not FTS_AVAILABLE:
+        raise click.ClickException('This SQLite build has no FTS5 trigram support')
+    ensure_db()
+    with db_pool.connection() as conn:
+        for name in FTS_INDEXES:
+            conn.execute(f"INSERT INTO {name}({name}) VALUES ('rebuild')")
+            click.echo(f'Rebuilt {name}')
+        conn.commit()
 
-        c.execute('''CREATE TABLE "group"
-                     (
-                         id         INTEGER PRIMARY KEY AUTOINCREMENT,
-                         name       TEXT NOT NULL,
-                         owner_id   INTEGER REFERENCES user (id),
-                         created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-                     )''')
-        c.execute('''CREATE TABLE group_member
-                     (
-                         id         INTEGER PRIMARY KEY AUTOINCREMENT,
-                         group_id   INTEGER REFERENCES "group" (id),
-                         user_id    INTEGER REFERENCES user (id),
-                         invited_by INTEGER REFERENCES user (id),
-                         status     TEXT CHECK (status IN ('pending', 'accepted')) DEFAULT 'pending',
-                         joined_at  DATETIME
-                     )''')
-        c.execute('''CREATE TABLE group_message
-                     (
-                         id        INTEGER PRIMARY KEY AUTOINCREMENT,
-                         group_id  INTEGER REFERENCES "group" (id),
-                         sender_id INTEGER REFERENCES user (id),
-                         message   TEXT NOT NULL,
-                         timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-                     )''')
+PREVIEW_LENGTH = 200  # characters of the last message kept in conversation.preview
+
+# Recomputes every conversation row from message; run when the table is first created
+CONVERSATION_REBUILD = (
+    'DELETE FROM conversation',
+    f'''INSERT INTO conversation (user_id, peer_id, last_message_id, last_sender_id, preview, last_timestamp, unread)
+        WITH sides AS (
+            SELECT sender_id AS me, receiver_id AS peer, id, 0 AS unread FROM message
+            UNION ALL
+            SELECT receiver_id, sender_id, id, read = 0 FROM message WHERE receiver_id != sender_id
+        ), latest AS (
+            SELECT me, peer, MAX(id) AS last_id, SUM(unread) AS unread FROM sides GROUP BY me, peer
+        )
+        SELECT latest.me, latest.peer, m.id, m.sender_id, substr(m.message, 1, {PREVIEW_LENGTH}), m.timestamp, latest.unread
+        FROM latest JOIN message m ON m.id = latest.last_id''',
+)
+
+@app.cli.command('rebuild-inbox')
+def rebuild_inbox():
+    """Recompute conversation summaries from the message table."""
+    ensure_db()
+    with db_pool.connection() as conn:
+        for statement in CONVERSATION_REBUILD:
+            conn.execute(statement)
+        conn.commit()
+        count = conn.execute('SELECT COUNT(*) FROM conversation').fetchone()[0]
+    click.echo(f'Rebuilt {count} conversation row(s)')
+
+# --- MIGRATIONS ---
+# Append-only list of (version, function). PRAGMA user_version records the last
+# one applied; each runs once, in its own transaction, on every database.
+MIGRATIONS = []
+
+def migration(version):
+    def register(fn):
+        assert not MIGRATIONS or MIGRATIONS[-1][0] == version - 1, 'migrations must be numbered in order'
+        MIGRATIONS.append((version, fn))
+        return fn
+    return register
+
+@migration(1)
+def migrate_baseline(conn):
+    # Everything up to the migration runner. Idempotent, so databases created
+    # before user_version was tracked pass through it safely.
+    existing_tables = {row['name'] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    create_schema(conn)
+    for statement in SCHEMA_TABLES:
+        conn.execute(statement)
+    for table, column, declaration in SCHEMA_COLUMNS:
+        existing = {row['name'] for row in conn.execute(f'PRAGMA table_info("{table}")')}
+        if column not in existing:
+            conn.execute(f'ALTER TABLE "{table}" ADD COLUMN {column} {declaration}')
+    for statement in SCHEMA_INDEXES:
+        conn.execute(statement)
+    if 'conversation' not in existing_tables:
+        for statement in CONVERSATION_REBUILD:
+            conn.execute(statement)
+
+def now_ms():
+    return int(time.time() * 1000)
+
+def backfill_epoch_ms(conn, table):
+    # Old rows hold '%I:%M %p' display strings (message), NULL (group_message)
+    # or local ISO datetimes. Walk newest to oldest so ids give the ordering:
+    # a clock-only time is placed on the latest day that keeps it no later than
+    # the next message (or its read_at); a missing one inherits that bound.
+    has_read_at = table == 'message'
+    rows = conn.execute(f'SELECT id, timestamp{", read_at" if has_read_at else ""} FROM {table} ORDER BY id DESC').fetchall()
+    bound = datetime.now()
+    updates = []
+    for row in rows:
+        value = row['timestamp']
+        if isinstance(value, int):
+            bound = min(bound, datetime.fromtimestamp(value / 1000))
+            continue
+        upper = bound
+        if has_read_at and row['read_at']:
+            try:
+                upper = min(upper, datetime.fromisoformat(row['read_at']))
+            except ValueError:
+                pass
+        sent = None
+        if isinstance(value, str):
+            try:
+                sent = datetime.fromisoformat(value)
+            except ValueError:
+                try:
+                    clock = datetime.strptime(value.strip(), '%I:%M %p').time()
+                    sent = datetime.combine(upper.date(), clock)
+                    if sent > upper:
+                        sent -= timedelta(days=1)
+                except ValueError:
+                    pass
+        sent = min(sent or upper, upper)
+        bound = sent
+        updates.append((int(sent.timestamp() * 1000), row['id']))
+    conn.executemany(f'UPDATE {table} SET timestamp = ? WHERE id = ?', updates)
+    return len(updates)
+
+@migration(2)
+def migrate_epoch_timestamps(conn):
+    # message / group_message timestamps become integer epoch milliseconds so they
+    # sort and range-scan; clients format them. conversation copies the same value.
+    for table in ('message', 'group_message'):
+        count = backfill_epoch_ms(conn, table)
+        app.logger.info('Backfilled %d %s timestamp(s)', count, table)
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_message_timestamp ON message (timestamp)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_group_message_timestamp ON group_message (timestamp)')
+    conn.execute('DROP TABLE IF EXISTS conversation')
+    conn.execute('''CREATE TABLE conversation (
+        user_id         INTEGER NOT NULL,
+        peer_id         INTEGER NOT NULL,
+        last_message_id INTEGER NOT NULL,
+        last_sender_id  INTEGER NOT NULL,
+        preview         TEXT NOT NULL,
+        last_timestamp  INTEGER,
+        unread          INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, peer_id)
+    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_conversation_recent ON conversation (user_id, last_message_id)')
+    for statement in CONVERSATION_REBUILD:
+        conn.execute(statement)
+
+# Conversation key of an archived row: the canonical pair for direct messages,
+# (group_id, 0) for group messages
+ARCHIVE_SPAN_KEYS = {
+    'message': ('min(sender_id, receiver_id)', 'max(sender_id, receiver_id)'),
+    'group_message': ('group_id', '0'),
+}
+ARCHIVE_SPAN_UPSERT = '''INSERT INTO archive_span (tbl, conv_low, conv_high, month, min_id, max_id)
+                         VALUES (?, ?, ?, ?, ?, ?)
+                         ON CONFLICT (tbl, conv_low, conv_high, month) DO UPDATE SET
+                             min_id = min(min_id, excluded.min_id), max_id = max(max_id, excluded.max_id)'''
+
+@migration(3)
+def migrate_archive_spans(conn):
+    # Which archive months hold rows of each conversation, so history opens
+    # only the files that can answer it
+    conn.execute('''CREATE TABLE IF NOT EXISTS archive_span (
+        tbl       TEXT NOT NULL,
+        conv_low  INTEGER NOT NULL,
+        conv_high INTEGER NOT NULL,
+        month     TEXT NOT NULL,
+        min_id    INTEGER NOT NULL,
+        max_id    INTEGER NOT NULL,
+        PRIMARY KEY (tbl, conv_low, conv_high, month)
+    )''')
+    # Archives written before the table existed
+    try:
+        names = os.listdir(ARCHIVE_FOLDER)
+    except FileNotFoundError:
+        names = []
+    for name in names:
+        if not (name.startswith('messages-') and name.endswith('.db')):
+            continue
+        month = name[len('messages-'):-len('.db')]
+        archive = sqlite3.connect(f'file:{os.path.join(ARCHIVE_FOLDER, name)}?mode=ro', uri=True)
+        try:
+            for table, (low, high) in ARCHIVE_SPAN_KEYS.items():
+                try:
+                    spans = archive.execute(f'SELECT {low}, {high}, MIN(id), MAX(id) FROM {table} GROUP BY 1, 2').fetchall()
+                except sqlite3.OperationalError:
+                    continue  # month file without this table
+                conn.executemany(ARCHIVE_SPAN_UPSERT, [(table, *span[:2], month, *span[2:]) for span in spans])
+        finally:
+            archive.close()
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def migrate(conn, target=None):
+    # Workers may start together: BEGIN IMMEDIATE serialises them and the
+    # version is re-read under the lock, so each migration applies exactly once
+    applied = []
+    for version, fn in MIGRATIONS:
+        if target is not None and version > target:
+            break
+        if version <= schema_version(conn):
+            continue
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if version > schema_version(conn):
+                fn(conn)
+                conn.execute(f'PRAGMA user_version = {version}')
+                applied.append(version)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        app.logger.info('Applied migration %d (%s)', version, fn.__name__)
+    return applied
+
+def ensure_search_indexes(conn):
+    # Depends on the SQLite build rather than the schema version, so checked every start
+    if not FTS_AVAILABLE:
+        return
+    for name, statements in FTS_INDEXES.items():
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (name,)).fetchone():
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f"INSERT INTO {name}({name}) VALUES ('rebuild')")
+    conn.commit()
 
+@app.cli.command('migrate')
+@click.option('--to', 'target', type=int, default=None, help='Stop after this version.')
+def migrate_command(target):
+    """Apply pending schema migrations."""
+    with db_pool.connection() as conn:
+        before = schema_version(conn)
+        applied = migrate(conn, target)
+    click.echo(f'Schema version {before} -> {before if not applied else applied[-1]} '
+               f'({len(applied)} migration(s) applied, latest is {MIGRATIONS[-1][0]})')
 
+def init_db():
+    with db_pool.connection() as conn:
+        migrate(conn)
+        ensure_search_indexes(conn)
+        # Routes a previous process with the same host:pid may have left behind
+        conn.execute('DELETE FROM socket_route WHERE node = ?', (NODE_ID,))
         conn.commit()
-        conn.close()
 
-init_db()
+_db_ready = False
+_db_ready_lock = threading.Lock()
+
+def ensure_db():
+    # Migrations run once per process before it serves or changes anything,
+    # never at import, so `flask migrate --to N` really stops at N
+    global _db_ready
+    with _db_ready_lock:
+        if not _db_ready:
+            init_db()
+            _db_ready = True
+
+@app.before_request
+def prepare_db():
+    ensure_db()
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+# --- ATTACHMENT STORE ---
+def attachment_path(sha256):
+    # Fan out into two directory levels so no single directory grows huge
+    return os.path.join(ATTACHMENT_FOLDER, sha256[:2], sha256[2:4], sha256)
+
+class UploadSpool:
+    """Write-only-once temp file that hashes bytes as they arrive.
+
+    Werkzeug's multipart parser writes uploaded file parts straight into it
+    (see ChatRequest), so an upload is hashed and spooled to disk in chunks
+    without ever being held in memory. ``commit()`` moves it into the
+    content-addressed store; an uncommitted spool is deleted on close.
+    """
+
+    def __init__(self, max_size=None):
+        fd, self.path = tempfile.mkstemp(dir=ATTACHMENT_FOLDER, prefix='.upload-')
+        self._file = os.fdopen(fd, 'w+b')
+        self._digest = hashlib.sha256()
+        self.max_size = max_size
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            raise RequestEntityTooLarge()
+        self._digest.update(data)
+        return self._file.write(data)
+
+    def __getattr__(self, name):
+        # read/seek/tell/flush etc. for FileStorage
+        return getattr(self._file, name)
+
+    def __iter__(self):
+        return iter(self._file)
+
+    def commit(self):
+        # Returns (sha256, size); identical content is stored only once
+        self._file.close()
+        sha256 = self._digest.hexdigest()
+        path = attachment_path(sha256)
+        if os.path.exists(path):
+            os.remove(self.path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(self.path, path)
+        return sha256, self.size
+
+    def close(self):
+        self._file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class ChatRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        spool = UploadSpool(max_size=MAX_UPLOAD_SIZE)
+        # Tracked here too so spools from a rejected or half-parsed body still get removed
+        self.__dict__.setdefault('_spools', []).append(spool)
+        return spool
+
+    def close(self):
+        super().close()
+        for spool in self.__dict__.get('_spools', ()):
+            spool.close()
+
+app.request_class = ChatRequest
+
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(e):
+    return jsonify({'error': 'File too large'}), 413
+
+def store_attachment(chunks):
+    # Write an iterable of byte chunks to the store, returns (sha256, size)
+    spool = UploadSpool()
+    try:
+        for chunk in chunks:
+            spool.write(chunk)
+        return spool.commit()
+    finally:
+        spool.close()
+
+# --- IMAGE VARIANTS ---
+def normalize_image(original):
+    """Orient and convert an opened image for re-encoding.
+
+    Returns ``(img, format, ext, mimetype)``: PNG when the source has any
+    transparency, JPEG otherwise.
+    """
+    img = ImageOps.exif_transpose(original)  # bake orientation in before EXIF is dropped
+    has_alpha = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+    img = img.convert('RGBA' if has_alpha else 'RGB')
+    if has_alpha:
+        return img, 'PNG', 'png', 'image/png'
+    return img, 'JPEG', 'jpg', 'image/jpeg'
+
+def render_image_variants(source):
+    """Runs in the image process pool; writes variants next to ``source``.
+
+    Produces an EXIF-stripped recompression of JPEGs plus one thumbnail per
+    IMAGE_VARIANT_SIZES entry, and returns ``[(variant, path, mimetype, size)]``.
+    """
+    variants = []
+    with Image.open(source) as original:
+        source_format = original.format
+        img, fmt, ext, mimetype = normalize_image(original)
+
+        if source_format == 'JPEG':
+            path = f'{source}.full.jpg'
+            img.save(path, format='JPEG', quality=85, optimize=True, progressive=True)
+            if os.path.getsize(path) < os.path.getsize(source):
+                variants.append(('full', path, 'image/jpeg', os.path.getsize(path)))
+            else:
+                os.remove(path)
+
+        for size in IMAGE_VARIANT_SIZES:
+            thumb = img.copy()
+            thumb.thumbnail((size, size))
+            path = f'{source}.{size}.{ext}'
+            thumb.save(path, format=fmt, quality=80, optimize=True)
+            variants.append((str(size), path, mimetype, os.path.getsize(path)))
+    return variants
+
+image_pool = ProcessPool(IMAGE_WORKERS)
+_image_slots = threading.BoundedSemaphore(IMAGE_QUEUE_LIMIT)
+
+def schedule_image_variants(file_id, sha256, user_id):
+    # Returns False when Pillow is missing or the queue is full; the original is served meanwhile
+    if Image is None or not _image_slots.acquire(blocking=False):
+        return False
+    try:
+        future = submit_cpu(image_pool, render_image_variants, attachment_path(sha256))
+    except Exception:
+        _image_slots.release()
+        raise
+    future.add_done_callback(lambda f: image_variants_done(f, file_id, sha256, user_id))
+    return True
+
+def image_variants_done(future, file_id, sha256, user_id):
+    _image_slots.release()
+    try:
+        variants = future.result()
+    except Exception as e:
+        app.logger.warning('Image processing failed for file %s: %s', file_id, e)
+        return
+    with db_pool.connection() as conn:
+        conn.executemany('INSERT OR REPLACE INTO file_variant (sha256, variant, path, mimetype, size) '
+                         'VALUES (?, ?, ?, ?, ?)',
+                         [(sha256, name, os.path.relpath(path, ATTACHMENT_FOLDER), mimetype, size)
+                          for name, path, mimetype, size in variants])
+        conn.commit()
+    router.send('file_ready', {'file_id': file_id, 'variants': [v[0] for v in variants]}, user_id)
+
+def read_blob_chunks(conn, file_id):
+    # Stream a legacy BLOB out of SQLite without loading it whole
+    with conn.blobopen('file', 'data', file_id, readonly=True) as blob:
+        while True:
+            chunk = blob.read(ATTACHMENT_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+@app.cli.command('migrate-files')
+@click.option('--vacuum', is_flag=True, help='VACUUM the database afterwards to reclaim BLOB space.')
+def migrate_files(vacuum):
+    """Move file BLOBs out of the database into the attachment store."""
+    ensure_db()
+    moved = 0
+    with db_pool.connection() as conn:
+        ids = [row['id'] for row in conn.execute('SELECT id FROM file WHERE sha256 IS NULL')]
+        for file_id in ids:
+            sha256, size = store_attachment(read_blob_chunks(conn, file_id))
+            conn.execute("UPDATE file SET sha256 = ?, size = ?, data = X'' WHERE id = ?",
+                         (sha256, size, file_id))
+            conn.commit()
+            moved += 1
+        if vacuum:
+            conn.execute('VACUUM')
+    click.echo(f'Migrated {moved} file(s) to {ATTACHMENT_FOLDER}')
+
+# --- AVATARS ---
+# Avatars live in the attachment store like any other upload, keyed by the
+# sha256 of the source image, with square renditions at AVATAR_SIZES next to
+# it. The default picture is just one more entry, so identical avatars are
+# stored once no matter how many users have them.
+AVATAR_SIZES = (32, 64, 128, 256)
+AVATAR_MAX_AGE = ATTACHMENT_MAX_AGE
+DEFAULT_AVATAR = os.path.join('static', 'pfp.png')
+
+def render_avatar_sizes(source):
+    """Runs in the image process pool; returns ``[(size, path, mimetype, bytes)]``."""
+    sizes = []
+    with Image.open(source) as original:
+        img, fmt, ext, mimetype = normalize_image(original)
+        for size in AVATAR_SIZES:
+            path = f'{source}.avatar{size}.{ext}'
+            ImageOps.fit(img, (size, size)).save(path, format=fmt, quality=85, optimize=True)
+            sizes.append((size, path, mimetype, os.path.getsize(path)))
+    return sizes
+
+def check_image(path):
+    # Runs in the image process pool; raises unless Pillow can decode the file
+    with Image.open(path) as img:
+        img.load()
+
+def store_avatar(conn, sha256):
+    # Render the sizes for an avatar already in the store, once per distinct image.
+    # Raises if the bytes are not an image Pillow can read.
+    if Image is None or conn.execute('SELECT 1 FROM avatar_variant WHERE sha256 = ?', (sha256,)).fetchone():
+        return
+    sizes = run_cpu(image_pool, render_avatar_sizes, attachment_path(sha256))
+    conn.executemany('INSERT OR REPLACE INTO avatar_variant (sha256, size, path, mimetype, bytes) '
+                     'VALUES (?, ?, ?, ?, ?)',
+                     [(sha256, size, os.path.relpath(path, ATTACHMENT_FOLDER), mimetype, nbytes)
+                      for size, path, mimetype, nbytes in sizes])
+    conn.commit()
+
+_default_avatar = None
+_default_avatar_lock = threading.Lock()
+
+def default_avatar(conn):
+    # sha256 of static/pfp.png, copied into the store on first use
+    global _default_avatar
+    with _default_avatar_lock:
+        if _default_avatar is None:
+            with open(DEFAULT_AVATAR, 'rb') as f:
+                sha256, _ = store_attachment(iter(lambda: f.read(ATTACHMENT_CHUNK_SIZE), b''))
+            store_avatar(conn, sha256)
+            _default_avatar = sha256
+        return _default_avatar
+
+def avatar_url(user_id, avatar, size=64):
+    # The version makes the URL change with the picture, so it can be cached forever
+    return url_for('avatar', user_id=user_id, size=size, v=(avatar or 'default')[:12])
+
+@app.route('/avatar/<int:user_id>/<int:size>')
+def avatar(user_id, size):
+    conn = get_db()
+    record = user_cache.get(conn, user_id)
+    if not record:
+        return 'User not found', 404
+    sha256 = record['avatar'] or default_avatar(conn)
+    size = next((s for s in AVATAR_SIZES if s >= size), AVATAR_SIZES[-1])
+    row = conn.execute('SELECT path, mimetype FROM avatar_variant WHERE sha256 = ? AND size = ?',
+                       (sha256, size)).fetchone()
+    if row:
+        path, mimetype = os.path.join(ATTACHMENT_FOLDER, row['path']), row['mimetype']
+    else:
+        # No Pillow: fall back to the stored original
+        path, mimetype = attachment_path(sha256), None
+    response = send_file(path, mimetype=mimetype, conditional=True, etag=f'{sha256}-{size}')
+    if request.args.get('v') == (record['avatar'] or 'default')[:12]:
+        response.cache_control.max_age = AVATAR_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        # Unversioned URL: the picture may change, revalidate with the ETag
+        response.cache_control.max_age = 0
+        response.cache_control.no_cache = True
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
+
+@app.cli.command('migrate-avatars')
+@click.option('--vacuum', is_flag=True, help='VACUUM the database afterwards to reclaim BLOB space.')
+def migrate_avatars(vacuum):
+    """Move profile pictures out of user.profile_picture into the avatar store."""
+    ensure_db()
+    with open(DEFAULT_AVATAR, 'rb') as f:
+        default_bytes = f.read()
+    moved = 0
+    with db_pool.connection() as conn:
+        rows = conn.execute("SELECT id, typeof(profile_picture) AS kind FROM user WHERE profile_picture != ''").fetchall()
+        for row in rows:
+            data = conn.execute('SELECT profile_picture FROM user WHERE id = ?', (row['id'],)).fetchone()[0]
+            if row['kind'] != 'blob':
+                # Old settings uploads: a filename in UPLOAD_FOLDER
+                path = os.path.join(UPLOAD_FOLDER, secure_filename(data))
+                data = None
+                if os.path.isfile(path):
+                    with open(path, 'rb') as f:
+                        data = f.read()
+            sha256 = None
+            if data and data != default_bytes:
+                sha256, _ = store_attachment([data])
+                try:
+                    store_avatar(conn, sha256)
+                except Exception as e:
+                    click.echo(f'User {row["id"]}: not an image ({e}), using the default')
+                    sha256 = None
+            conn.execute("UPDATE user SET avatar = ?, profile_picture = '' WHERE id = ?", (sha256, row['id']))
+            conn.commit()
+            moved += 1
+        if vacuum:
+            conn.execute('VACUUM')
+    click.echo(f'Migrated {moved} profile picture(s)')
+
+# --- STATIC ASSETS ---
+# Pages link to static/dist/<name>.<hash>.<ext> through asset_url(). The name
+# changes whenever the content does, so /assets/ responses are immutable, and
+# each has precompressed .gz (and .br with the brotli package) siblings chosen
+# by Accept-Encoding. The build reruns at startup when a source is newer than
+# the manifest, and deletes outputs older than the build it replaces.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import rjsmin
+    import rcssmin
+except ImportError:
+    rjsmin = rcssmin = None
+
+ASSET_MIMETYPES = {'.js': 'text/javascript', '.css': 'text/css'}
+ASSET_ENCODINGS = (('br', '.br'), ('gzip', '.gz'))  # server preference order
+_CSS_TOKENS = re.compile(r'''("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*'|/\*.*?\*/)''', re.S)
+_CSS_PUNCTUATION = re.compile(r'\s*([{};])\s*')
+_ASSET_OUTPUT = re.compile(r'([\w-]+\.[0-9a-f]{12}\.(?:js|css))(?:\.gz|\.br)?')  # built name, then encoding
+
+def minify_css(text):
+    if rcssmin:
+        return rcssmin.cssmin(text)
+    # Strings pass through untouched; comments go; whitespace collapses
+    parts = []
+    for i, part in enumerate(_CSS_TOKENS.split(text)):
+        if i % 2:
+            if not part.startswith('/*'):
+                parts.append(part)
+        else:
+            parts.append(_CSS_PUNCTUATION.sub(r'\1', re.sub(r'\s+', ' ', part)))
+    return ''.join(parts).strip()
+
+def minify_js(text):
+    if rjsmin:
+        return rjsmin.jsmin(text)
+    # Without a real minifier only drop indentation, blank lines and whole-line
+    # comments, leaving line breaks (and so semicolon insertion) intact. Lines
+    # inside multi-line template literals are kept as they are.
+    lines = []
+    in_template = False
+    for line in text.splitlines():
+        stripped = line if in_template else line.strip()
+        if not in_template and (not stripped or stripped.startswith('//')):
+            continue
+        lines.append(stripped)
+        if (line.count('`') - line.count('\\`')) % 2:
+            in_template = not in_template
+    return '\n'.join(lines) + '\n'
+
+def build_assets():
+    """Minify, fingerprint and precompress ASSET_SOURCES; returns the manifest."""
+    os.makedirs(ASSET_FOLDER, exist_ok=True)
+    manifest = {}
+    for name in ASSET_SOURCES:
+        stem, ext = os.path.splitext(name)
+        with open(os.path.join(app.static_folder, name), encoding='utf-8') as f:
+            source = f.read()
+        data = (minify_js(source) if ext == '.js' else minify_css(source)).encode('utf-8')
+        built = f'{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}'
+        variants = {'': data, '.gz': gzip.compress(data, compresslevel=9, mtime=0)}
+        if brotli:
+            variants['.br'] = brotli.compress(data, quality=11)
+        for suffix, content in variants.items():
+            path = os.path.join(ASSET_FOLDER, built + suffix)
+            if not os.path.exists(path):
+                # Workers may build at once; the content is identical, so last rename wins harmlessly
+                fd, tmp = tempfile.mkstemp(dir=ASSET_FOLDER)
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(content)
+                os.replace(tmp, path)
+        manifest[name] = built
+    try:
+        with open(ASSET_MANIFEST) as f:
+            previous = json.load(f)
+    except (OSError, ValueError):
+        previous = {}
+    fd, tmp = tempfile.mkstemp(dir=ASSET_FOLDER)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp, ASSET_MANIFEST)
+    prune_assets({*manifest.values(), *previous.values()})
+    return manifest
+
+def prune_assets(keep):
+    # Delete fingerprinted outputs other than ``keep``. The build before this
+    # one stays, for pages rendered (or workers still running) before it.
+    for filename in os.listdir(ASSET_FOLDER):
+        match = _ASSET_OUTPUT.fullmatch(filename)
+        if match and match.group(1) not in keep:
+            try:
+                os.remove(os.path.join(ASSET_FOLDER, filename))
+            except FileNotFoundError:
+                pass  # another worker pruned it first
+
+def load_asset_manifest():
+    try:
+        built_at = os.path.getmtime(ASSET_MANIFEST)
+        if all(os.path.getmtime(os.path.join(app.static_folder, name)) <= built_at for name in ASSET_SOURCES):
+            with open(ASSET_MANIFEST) as f:
+                return json.load(f)
+    except (OSError, ValueError):
+        pass
+    try:
+        return build_assets()
+    except OSError as e:
+        # Read-only deploy without a prebuilt dist/: fall back to the plain static files
+        app.logger.warning('Could not build static assets, serving them unversioned: %s', e)
+        return {}
+
+asset_manifest = load_asset_manifest()
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Minify, fingerprint and precompress the static assets."""
+    global asset_manifest
+    asset_manifest = build_assets()
+    for name, built in sorted(asset_manifest.items()):
+        sizes = ', '.join(f'{suffix or "raw"} {os.path.getsize(os.path.join(ASSET_FOLDER, built + suffix))}'
+                          for suffix in ('', '.gz', '.br') if os.path.exists(os.path.join(ASSET_FOLDER, built + suffix)))
+        click.echo(f'{name} -> {built} ({sizes} bytes; source {os.path.getsize(os.path.join(app.static_folder, name))})')
+
+@app.context_processor
+def asset_helpers():
+    def asset_url(name):
+        built = asset_manifest.get(name)
+        return url_for('asset', filename=built) if built else url_for('static', filename=name)
+    return {'asset_url': asset_url}
+
+@app.route('/assets/<path:filename>')
+def asset(filename):
+    mimetype = ASSET_MIMETYPES.get(os.path.splitext(filename)[1])
+    if mimetype is None:
+        return 'Not found', 404
+    accepted = request.accept_encodings
+    for encoding, suffix in ASSET_ENCODINGS:
+        if accepted[encoding] and os.path.exists(os.path.join(ASSET_FOLDER, filename + suffix)):
+            response = send_from_directory(ASSET_FOLDER, filename + suffix, mimetype=mimetype,
+                                           max_age=ATTACHMENT_MAX_AGE)
+            response.content_encoding = encoding
+            break
+    else:
+        response = send_from_directory(ASSET_FOLDER, filename, mimetype=mimetype, max_age=ATTACHMENT_MAX_AGE)
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+# --- USER CACHE ---
+USER_CACHE_SIZE = 100000
+USER_CACHE_TTL = 30 if MESSAGE_QUEUE else None  # other workers may write user rows
+
+class UserCache:
+    """Bounded LRU of user records shared by socket handlers and REST endpoints.
+
+    Records are ``{'id', 'username', 'avatar', 'last_seen'}`` or None for ids
+    that do not exist (so unknown ids don't hit the database every time).
+    Writers call ``invalidate``; presence flushes refresh last_seen in place.
+    """
+
+    def __init__(self, size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # user_id: (loaded_at, record)
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, conn, user_ids):
+        result = {}
+        missing = []
+        with self._lock:
+            for user_id in dict.fromkeys(user_ids):
+                item = self._entries.get(user_id)
+                if item is None or (self.ttl is not None and time.monotonic() - item[0] > self.ttl):
+                    missing.append(user_id)
+                else:
+                    self._entries.move_to_end(user_id)
+                    result[user_id] = item[1]
+            self.hits += len(result)
+            self.misses += len(missing)
+        if missing:
+            rows = conn.execute(f'SELECT id, username, last_seen, avatar FROM user '
+                                f'WHERE id IN ({",".join("?" * len(missing))})', missing).fetchall()
+            loaded = {user_id: None for user_id in missing}
+            for row in rows:
+                loaded[row['id']] = {'id': row['id'], 'username': row['username'],
+                                     'avatar': row['avatar'], 'last_seen': row['last_seen']}
+            now = time.monotonic()
+            with self._lock:
+                for user_id, record in loaded.items():
+                    self._entries[user_id] = (now, record)
+                    self._entries.move_to_end(user_id)
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+            result.update(loaded)
+        return result
+
+    def get(self, conn, user_id):
+        return self.get_many(conn, [user_id])[user_id]
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def update_last_seen(self, rows):
+        # rows: (last_seen, user_id) as written by flush_last_seen
+        with self._lock:
+            for last_seen_str, user_id in rows:
+                item = self._entries.get(user_id)
+                if item and item[1]:
+                    item[1]['last_seen'] = last_seen_str
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+user_cache = UserCache()
+
+def usernames(conn, user_ids):
+    return {user_id: record['username']
+            for user_id, record in user_cache.get_many(conn, user_ids).items() if record}
+
+# --- FRIEND GRAPH ---
+FRIEND_CACHE_SIZE = 50000                       # users whose adjacency is kept in memory
+FRIEND_CACHE_TTL = 30 if MESSAGE_QUEUE else None  # other workers may change the graph
+
+class FriendGraph:
+    """LRU cache of each user's friendships: accepted, pending sent, pending received.
+
+    Loaded per user from the friend indexes on first use and then updated by
+    the send/accept paths, so "are A and B friends" is a set lookup. Entries
+    hold frozensets and updates swap in new ones (copy-on-write), so callers
+    can iterate what they got without holding the lock.
+    With several workers, entries also expire after FRIEND_CACHE_TTL seconds
+    because another worker may have changed them.
+    """
+
+    def __init__(self, size=FRIEND_CACHE_SIZE, ttl=FRIEND_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # user_id: (loaded_at, {'accepted', 'sent', 'received'} frozensets)
+
+    def _cached(self, user_id):
+        item = self._entries.get(user_id)
+        if item is None or (self.ttl is not None and time.monotonic() - item[0] > self.ttl):
+            return None
+        self._entries.move_to_end(user_id)
+        return item[1]
+
+    def _load(self, conn, user_ids):
+        user_ids = list(user_ids)
+        loaded = {user_id: {'accepted': set(), 'sent': set(), 'received': set()} for user_id in user_ids}
+        marks = ','.join('?' * len(user_ids))
+        rows = conn.execute(f'''SELECT user_id, friend_id, status FROM friend WHERE user_id IN ({marks})
+                                UNION ALL
+                                SELECT user_id, friend_id, status FROM friend WHERE friend_id IN ({marks})''',
+                            user_ids + user_ids).fetchall()
+        for row in rows:
+            requester, addressee = row['user_id'], row['friend_id']
+            if row['status'] == 'accepted':
+                if requester in loaded:
+                    loaded[requester]['accepted'].add(addressee)
+                if addressee in loaded:
+                    loaded[addressee]['accepted'].add(requester)
+            else:
+                if requester in loaded:
+                    loaded[requester]['sent'].add(addressee)
+                if addressee in loaded:
+                    loaded[addressee]['received'].add(requester)
+        loaded = {user_id: {key: frozenset(ids) for key, ids in entry.items()} for user_id, entry in loaded.items()}
+        now = time.monotonic()
+        with self._lock:
+            for user_id, entry in loaded.items():
+                self._entries[user_id] = (now, entry)
+                self._entries.move_to_end(user_id)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return loaded
+
+    def get_many(self, conn, user_ids):
+        result = {}
+        with self._lock:
+            for user_id in user_ids:
+                entry = self._cached(user_id)
+                if entry is not None:
+                    result[user_id] = entry
+        missing = [user_id for user_id in dict.fromkeys(user_ids) if user_id not in result]
+        if missing:
+            result.update(self._load(conn, missing))
+        return result
+
+    def get(self, conn, user_id):
+        return self.get_many(conn, [user_id])[user_id]
+
+    def are_friends(self, conn, a, b):
+        return b in self.get(conn, a)['accepted']
+
+    def related(self, conn, a, b):
+        entry = self.get(conn, a)
+        return b in entry['accepted'] or b in entry['sent'] or b in entry['received']
+
+    def request_sent(self, requester, addressee):
+        with self._lock:
+            for user_id, key, other in ((requester, 'sent', addressee), (addressee, 'received', requester)):
+                item = self._entries.get(user_id)
+                if item:
+                    # Copy-on-write: readers keep whatever entry they already hold
+                    self._entries[user_id] = (item[0], dict(item[1], **{key: item[1][key] | {other}}))
+
+    def request_accepted(self, requester, addressee):
+        with self._lock:
+            for user_id, key, other in ((requester, 'sent', addressee), (addressee, 'received', requester)):
+                item = self._entries.get(user_id)
+                if item:
+                    self._entries[user_id] = (item[0], dict(item[1], **{key: item[1][key] - {other},
+                                                                        'accepted': item[1]['accepted'] | {other}}))
+
+friend_graph = FriendGraph()
+
+def accepted_friend_ids(conn, user_ids):
+    # user_id: frozenset of accepted friend ids, for every id in user_ids
+    return {user_id: entry['accepted'] for user_id, entry in friend_graph.get_many(conn, user_ids).items()}
+
+# --- GROUP MEMBERSHIP ---
+GROUP_CACHE_SIZE = 50000                       # users whose group list is kept in memory
+GROUP_CACHE_TTL = 30 if MESSAGE_QUEUE else None  # other workers may add members
+
+def group_room(group_id):
+    return f'group_{group_id}'
+
+class GroupMembership:
+    """LRU cache of the groups each user has accepted.
+
+    Used to rejoin group rooms on connect and to authorise group sends and
+    history reads without touching group_member. Entries are frozensets,
+    replaced (not mutated) when a group is created or an invite accepted.
+    """
+
+    def __init__(self, size=GROUP_CACHE_SIZE, ttl=GROUP_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # user_id: (loaded_at, frozenset of group ids)
+
+    def groups_of(self, conn, user_id):
+        with self._lock:
+            item = self._entries.get(user_id)
+            if item is not None and (self.ttl is None or time.monotonic() - item[0] <= self.ttl):
+                self._entries.move_to_end(user_id)
+                return item[1]
+        rows = conn.execute("SELECT group_id FROM group_member WHERE user_id = ? AND status = 'accepted'",
+                            (user_id,)).fetchall()
+        groups = frozenset(row['group_id'] for row in rows)
+        with self._lock:
+            self._entries[user_id] = (time.monotonic(), groups)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return groups
+
+    def is_member(self, conn, user_id, group_id):
+        return group_id in self.groups_of(conn, user_id)
+
+    def joined(self, user_id, group_id):
+        with self._lock:
+            item = self._entries.get(user_id)
+            if item:
+                self._entries[user_id] = (item[0], item[1] | {group_id})
+
+group_membership = GroupMembership()
+
+def join_group_rooms(user_id, group_ids):
+    # The current socket plus this worker's other sockets of the user;
+    # sockets on other workers pick the room up on their next connect
+    sids = {request.sid} | router.local_sids(user_id)
+    for sid in sids:
+        for group_id in group_ids:
+            join_room(group_room(group_id), sid=sid)
+
+# --- PASSWORD HASHING ---
+# Hashing runs in a small process pool so a burst of logins can't hold the
+# GIL (or an async server's event loop) away from message delivery. The pool
+# has a fixed number of slots; when they are taken auth requests get a 503
+# instead of piling up. Attempts are also throttled per client IP and per
+# username before any hashing happens; behind a reverse proxy set
+# CHATAPP_PROXY_HOPS so the client IP comes from X-Forwarded-For rather than
+# the proxy's address. CHATAPP_PASSWORD_WORKERS=0 hashes
+# inline (still slot-limited); `flask bench-auth` shows which is faster for
+# the current hash cost.
+PASSWORD_WORKERS = int(os.environ.get('CHATAPP_PASSWORD_WORKERS', max(1, min(4, (os.cpu_count() or 2) // 2))))
+PASSWORD_QUEUE_LIMIT = 64    # hashes queued or running before auth requests are shed
+PASSWORD_TIMEOUT = 10        # seconds to wait for a hash
+LOGIN_WINDOW = 300           # seconds
+LOGIN_MAX_PER_IP = int(os.environ.get('CHATAPP_LOGIN_MAX_PER_IP', 60))  # login/signup attempts per IP per window
+LOGIN_MAX_FAILURES = 5       # failed logins per username per window
+LOGIN_THROTTLE_SIZE = 100000 # tracked keys
+PROXY_HOPS = int(os.environ.get('CHATAPP_PROXY_HOPS', 0))  # trusted proxies in front; 0 trusts no headers
+
+if PROXY_HOPS:
+    # Only the last PROXY_HOPS X-Forwarded-For entries are believed, so clients can't spoof their IP
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_HOPS, x_proto=PROXY_HOPS)
+
+_hasher = None
+
+def _init_hasher():
+    global _hasher
+    _hasher = WarBorne()  # reads key.key once per worker
+
+def _hash_password(password):
+    if _hasher is None:
+        _init_hasher()
+    return _hasher.wb_hash(password)
+
+class AuthBusy(Exception):
+    pass
+
+password_pool = ProcessPool(PASSWORD_WORKERS, initializer=_init_hasher)
+_password_slots = threading.BoundedSemaphore(PASSWORD_QUEUE_LIMIT)
+_password_in_flight = 0
+_password_in_flight_lock = threading.Lock()
+
+def hash_password(password):
+    # Raises AuthBusy when every slot is taken, the hash times out or the pool keeps dying
+    global _password_in_flight
+    if not _password_slots.acquire(blocking=False):
+        raise AuthBusy()
+    with _password_in_flight_lock:
+        _password_in_flight += 1
+    try:
+        if not PASSWORD_WORKERS:
+            return _hash_password(password)
+        return run_cpu(password_pool, _hash_password, password, timeout=PASSWORD_TIMEOUT)
+    except (FutureTimeout, BrokenProcessPool):
+        app.logger.warning('Password hashing failed or timed out; answering busy')
+        raise AuthBusy()
+    finally:
+        with _password_in_flight_lock:
+            _password_in_flight -= 1
+        _password_slots.release()
+
+def check_password(password, password_hash):
+    return hmac.compare_digest(hash_password(password), password_hash)
+
+class LoginThrottle:
+    """Fixed-window attempt counters keyed by 'ip:<addr>' / 'user:<name>'."""
+
+    def __init__(self, size=LOGIN_THROTTLE_SIZE, window=LOGIN_WINDOW):
+        self.size = size
+        self.window = window
+        self._lock = threading.Lock()
+        self._counts = OrderedDict()  # key: (window_start, count)
+
+    def count(self, key):
+        with self._lock:
+            item = self._counts.get(key)
+            if item is None or time.monotonic() - item[0] > self.window:
+                return 0
+            return item[1]
+
+    def hit(self, key):
+        now = time.monotonic()
+        with self._lock:
+            item = self._counts.get(key)
+            if item is None or now - item[0] > self.window:
+                item = (now, 0)
+            self._counts[key] = (item[0], item[1] + 1)
+            self._counts.move_to_end(key)
+            while len(self._counts) > self.size:
+                self._counts.popitem(last=False)
+
+    def reset(self, key):
+        with self._lock:
+            self._counts.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {'tracked': len(self._counts)}
+
+login_throttle = LoginThrottle()
+
+def auth_throttled(username=None):
+    if login_throttle.count(f'ip:{request.remote_addr}') >= LOGIN_MAX_PER_IP:
+        return True
+    return username is not None and login_throttle.count(f'user:{username.lower()}') >= LOGIN_MAX_FAILURES
+
+def auth_error(template, error, status):
+    response = app.make_response((render_template(template, error=error), status))
+    response.headers['Retry-After'] = str(LOGIN_WINDOW if status == 429 else 1)
+    return response
+
+@app.cli.command('bench-auth')
+@click.option('--hashes', default=2000, help='Hashes to time directly and through the pool.')
+@click.option('--concurrency', default=16, help='Concurrent login requests.')
+@click.option('--logins', default=400, help='Login requests to time.')
+def bench_auth(hashes, concurrency, logins):
+    """Time password hashing in-process, through the pool, and as full logins."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    def percentiles(samples):
+        samples = sorted(samples)
+        return ' '.join(f'p{p}={samples[min(len(samples) - 1, len(samples) * p // 100)] * 1000:.3f}ms'
+                        for p in (50, 95, 99))
+
+    wb = WarBorne()
+    started = time.perf_counter()
+    for i in range(hashes):
+        wb.wb_hash(f'password{i}')
+    click.echo(f'inline hash: {(time.perf_counter() - started) / hashes * 1e6:.1f}us per hash')
+
+    def timed(fn, *args, **kwargs):
+        started = time.perf_counter()
+        fn(*args, **kwargs)
+        return time.perf_counter() - started
+
+    hash_password('warmup')
+    with ThreadPoolExecutor(concurrency) as pool:
+        samples = list(pool.map(lambda i: timed(hash_password, f'password{i}'), range(hashes)))
+    click.echo(f'hash_password ({PASSWORD_WORKERS} workers, {concurrency} callers): {percentiles(samples)}')
+
+    # Full login round trips through the test client, against a throwaway user
+    global LOGIN_MAX_PER_IP
+    LOGIN_MAX_PER_IP = sys.maxsize
+    username = f'bench-{os.getpid()}'
+    app.test_client().post('/signup', data={'username': username, 'password': 'bench'})
+    try:
+        with ThreadPoolExecutor(concurrency) as pool:
+            samples = list(pool.map(
+                lambda i: timed(app.test_client().post, '/login', data={'username': username, 'password': 'bench'}),
+                range(logins)))
+    finally:
+        with db_pool.connection() as conn:
+            conn.execute('DELETE FROM user WHERE username = ?', (username,))
+            conn.commit()
+    click.echo(f'login ({concurrency} concurrent): {percentiles(samples)}')
+
 @app.route('/')
 def index():
     if 'user_id' in session:
-        return render_template('chat.html', username=session['username'])
+        record = user_cache.get(get_db(), session['user_id'])
+        return render_template('chat.html', username=session['username'],
+                               avatar_url=avatar_url(session['user_id'], record and record['avatar']),
+                               wire=wire_config())
     return redirect(url_for('login'))
 
 @app.route('/signup', methods=['GET', 'POST'])
 def signup():
-    with open('static/pfp.png', 'rb') as f:
-        pic_data = f.read()
-    wb = WarBorne()
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
+        if auth_throttled():
+            return auth_error('signup.html', 'Too many attempts, try again later', 429)
+        login_throttle.hit(f'ip:{request.remote_addr}')
+        try:
+            password_hash = hash_password(password)
+        except AuthBusy:
+            return auth_error('signup.html', 'Server busy, try again', 503)
         conn = get_db()
         c = conn.cursor()
         try:
-            c.execute('INSERT INTO user (username, password_hash, profile_picture) VALUES (?, ?, ?)',
-                      (username, wb.wb_hash(password), pic_data))
-            conn.commit()
+            # profile_picture is legacy; avatar NULL means the shared default
+            c.execute("INSERT INTO user (username, password_hash, profile_picture) VALUES (?, ?, '')",
+                      (username, password_hash))
             conn.commit()
         except sqlite3.IntegrityError:
             return render_template('signup.html', error='Username already exists')
         user_id = c.lastrowid
+        user_cache.invalidate(user_id)
         session['user_id'] = user_id
         session['username'] = username
         return redirect(url_for('index'))
@@ -132,19 +1932,28 @@ def signup():
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
-    wb = WarBorne()
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
+        if auth_throttled(username):
+            return auth_error('login.html', 'Too many attempts, try again later', 429)
+        login_throttle.hit(f'ip:{request.remote_addr}')
         conn = get_db()
         c = conn.cursor()
-        c.execute('SELECT * FROM user WHERE username = ?', (username,))
+        c.execute('SELECT id, username, password_hash FROM user WHERE username = ?', (username,))
         user = c.fetchone()
-        if user and user['password_hash'] == wb.wb_hash(password):
+        try:
+            # Hash even for unknown users so timing doesn't reveal which names exist
+            valid = check_password(password, user['password_hash'] if user else '')
+        except AuthBusy:
+            return auth_error('login.html', 'Server busy, try again', 503)
+        if user and valid:
+            login_throttle.reset(f'user:{username.lower()}')
             session['user_id'] = user['id']
             session['username'] = user['username']
             return redirect(url_for('index'))
         else:
+            login_throttle.hit(f'user:{username.lower()}')
             return render_template('login.html', error='Invalid credentials')
     return render_template('index.html')
 
@@ -160,10 +1969,45 @@ def search_users():
     query = request.args.get('query', '').strip()
     if not query:
         return jsonify([])
+    try:
+        limit = max(min(int(request.args.get('limit', SEARCH_PAGE_SIZE)), SEARCH_PAGE_MAX), 0)
+        offset = max(int(request.args.get('offset', 0)), 0)
+    except ValueError:
+        return jsonify({'error': 'Invalid parameters'}), 400
+    rank_fof = request.args.get('fof', '1') != '0'
+    user_id = session['user_id']
     conn = get_db()
     c = conn.cursor()
-    c.execute('SELECT id, username FROM user WHERE username LIKE ? AND id != ?', (f'%{query}%', session['user_id']))
-    users = [{'id': row['id'], 'username': row['username']} for row in c.fetchall()]
+
+    # Friends-of-friends from the caller's friends only: each friend's list
+    # counts once towards every id on it
+    mutual = {}
+    if rank_fof:
+        mine = friend_graph.get(conn, user_id)['accepted']
+        for friend_ids in accepted_friend_ids(conn, mine).values():
+            for friend_id in friend_ids:
+                mutual[friend_id] = mutual.get(friend_id, 0) + 1
+        mutual.pop(user_id, None)
+
+    # Prefix matches are a range scan on idx_user_username_nocase; substring
+    # matches come from the trigram index (needs at least one full trigram).
+    # Ranking and paging happen in SQL so every page sees the same order:
+    # friends-of-friends first, then prefix matches, then shorter names.
+    pattern = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+    matches = "SELECT id, 1 AS prefix FROM user WHERE username LIKE ? ESCAPE '\\'"
+    params = [pattern]
+    if FTS_AVAILABLE and len(query) >= 3:
+        matches += ' UNION ALL SELECT rowid, 0 FROM user_search WHERE user_search MATCH ?'
+        params.append('"' + query.replace('"', '""') + '"')
+    c.execute(f'''SELECT u.id, u.username FROM (SELECT id, MAX(prefix) AS prefix FROM ({matches}) GROUP BY id) m
+                  JOIN user u ON u.id = m.id
+                  WHERE u.id != ?
+                  ORDER BY u.id NOT IN (SELECT value FROM json_each(?)), NOT m.prefix,
+                           length(u.username), lower(u.username)
+                  LIMIT ? OFFSET ?''', (*params, user_id, json.dumps(list(mutual)), limit, offset))
+
+    users = [{'id': row['id'], 'username': row['username'], 'mutual_friends': mutual.get(row['id'], 0)}
+             for row in c.fetchall()]
     return jsonify(users)
 
 @app.route('/api/send_friend_request', methods=['POST'])
@@ -174,15 +2018,20 @@ def send_friend_request():
     friend_id = data.get('friend_id')
     if not friend_id:
         return jsonify({'error': 'Missing friend_id'}), 400
+    try:
+        friend_id = int(friend_id)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid friend_id'}), 400
+    if friend_id == session['user_id']:
+        return jsonify({'error': 'Cannot add yourself'}), 400
     conn = get_db()
     c = conn.cursor()
-    c.execute('''SELECT * FROM friend WHERE (user_id=? AND friend_id=?) OR (user_id=? AND friend_id=?)''',
-              (session['user_id'], friend_id, friend_id, session['user_id']))
-    if c.fetchone():
+    if friend_graph.related(conn, session['user_id'], friend_id):
         return jsonify({'error': 'Already friends or pending'}), 400
     c.execute('INSERT INTO friend (user_id, friend_id, status) VALUES (?, ?, ?)',
               (session['user_id'], friend_id, 'pending'))
     conn.commit()
+    friend_graph.request_sent(session['user_id'], friend_id)
     return jsonify({'success': True})
 
 @app.route('/api/accept_friend_request', methods=['POST'])
@@ -193,12 +2042,19 @@ def accept_friend_request():
     friend_id = data.get('friend_id')
     if not friend_id:
         return jsonify({'error': 'Missing friend_id'}), 400
+    try:
+        friend_id = int(friend_id)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid friend_id'}), 400
     conn = get_db()
     c = conn.cursor()
     # Update status to accepted
     c.execute('''UPDATE friend SET status='accepted' WHERE user_id=? AND friend_id=? AND status='pending' ''',
               (friend_id, session['user_id']))
+    updated = c.rowcount
     conn.commit()
+    if updated:
+        friend_graph.request_accepted(friend_id, session['user_id'])
     return jsonify({'success': True})
 
 @app.route('/api/friends')
@@ -206,23 +2062,17 @@ def get_friends():
     if 'user_id' not in session:
         return jsonify({'error': 'Unauthorized'}), 401
     conn = get_db()
-    c = conn.cursor()
-    # Accepted friends
-    c.execute('''SELECT u.id, u.username FROM user u
-                 JOIN friend f ON ((f.user_id = ? AND f.friend_id = u.id) OR (f.friend_id = ? AND f.user_id = u.id))
-                 WHERE f.status = 'accepted' ''', (session['user_id'], session['user_id']))
-    friends = [{'id': row['id'], 'username': row['username']} for row in c.fetchall()]
-    # Pending requests sent
-    c.execute('''SELECT u.id, u.username FROM user u
-                 JOIN friend f ON f.friend_id = u.id
-                 WHERE f.user_id = ? AND f.status = 'pending' ''', (session['user_id'],))
-    pending_sent = [{'id': row['id'], 'username': row['username']} for row in c.fetchall()]
-    # Pending requests received
-    c.execute('''SELECT u.id, u.username FROM user u
-                 JOIN friend f ON f.user_id = u.id
-                 WHERE f.friend_id = ? AND f.status = 'pending' ''', (session['user_id'],))
-    pending_received = [{'id': row['id'], 'username': row['username']} for row in c.fetchall()]
-    return jsonify({'friends': friends, 'pending_sent': pending_sent, 'pending_received': pending_received})
+    entry = friend_graph.get(conn, session['user_id'])
+    records = user_cache.get_many(conn, entry['accepted'] | entry['sent'] | entry['received'])
+
+    def listing(ids):
+        return [{'id': user_id, 'username': records[user_id]['username'],
+                 'avatar': avatar_url(user_id, records[user_id]['avatar'])}
+                for user_id in sorted(ids) if records[user_id]]
+
+    return jsonify({'friends': listing(entry['accepted']),
+                    'pending_sent': listing(entry['sent']),
+                    'pending_received': listing(entry['received'])})
 
 @app.route('/api/upload', methods=['POST'])
 def upload_file():
@@ -237,28 +2087,30 @@ def upload_file():
     mimetype = file.mimetype
     user_id = session['user_id']
     timestamp = datetime.now().isoformat(sep=' ', timespec='seconds')
-    file_data = file.read()
-    # Compress image if possible
-    if Image and mimetype.startswith('image/'):
-        try:
-            img = Image.open(BytesIO(file_data))
-            buf = BytesIO()
-            img.save(buf, format='JPEG', quality=85, optimize=True)
-            file_data = buf.getvalue()
-            mimetype = 'image/jpeg'
-        except Exception:
-            pass  # fallback to original
-    # Store in DB
+    # The parser already spooled and hashed the upload, this only moves it into place
+    sha256, size = file.stream.commit()
+
     conn = get_db()
     c = conn.cursor()
-    c.execute('INSERT INTO file (user_id, filename, mimetype, data, timestamp) VALUES (?, ?, ?, ?, ?)',
-              (user_id, filename, mimetype, file_data, timestamp))
+    c.execute('''INSERT INTO file (user_id, filename, mimetype, data, timestamp, sha256, size)
+                 VALUES (?, ?, ?, X'', ?, ?, ?)''',
+              (user_id, filename, mimetype, timestamp, sha256, size))
     file_id = c.lastrowid
     conn.commit()
+
+    # Thumbnails / recompression happen off the request thread; a duplicate upload reuses them
+    c.execute('SELECT variant FROM file_variant WHERE sha256=?', (sha256,))
+    variants = [row['variant'] for row in c.fetchall()]
+    processing = False
+    if not variants and mimetype.startswith('image/'):
+        processing = schedule_image_variants(file_id, sha256, user_id)
+
     return jsonify({
         'file_id': file_id,
         'filetype': mimetype,
-        'filename': filename
+        'filename': filename,
+        'variants': variants,
+        'processing': processing
     })
 
 @app.route('/uploads/<filename>')
@@ -269,16 +2121,48 @@ def uploaded_file(filename):
 def serve_file(file_id):
     conn = get_db()
     c = conn.cursor()
-    c.execute('SELECT filename, mimetype, data FROM file WHERE id=?', (file_id,))
+    c.execute('SELECT filename, mimetype, sha256 FROM file WHERE id=?', (file_id,))
     row = c.fetchone()
     if not row:
         return 'File not found', 404
-    return send_file(
-        BytesIO(row['data']),
-        mimetype=row['mimetype'],
+    variant = request.args.get('variant')
+    if not row['sha256']:
+        # Not migrated yet, still a BLOB in the database
+        c.execute('SELECT data FROM file WHERE id=?', (file_id,))
+        return send_file(
+            BytesIO(c.fetchone()['data']),
+            mimetype=row['mimetype'],
+            download_name=row['filename'],
+            as_attachment=False
+        )
+    path, mimetype, etag = attachment_path(row['sha256']), row['mimetype'], row['sha256']
+    if variant:
+        c.execute('SELECT path, mimetype FROM file_variant WHERE sha256=? AND variant=?',
+                  (row['sha256'], variant))
+        found = c.fetchone()
+        if not found:
+            # Not rendered (yet): hand out the original, but don't let it be cached as the variant
+            response = send_file(path, mimetype=mimetype, download_name=row['filename'],
+                                 conditional=True, etag=False)
+            response.cache_control.no_cache = True
+            return response
+        path, mimetype = os.path.join(ATTACHMENT_FOLDER, found['path']), found['mimetype']
+        etag = f"{row['sha256']}-{variant}"
+    # Path-based send_file goes through wsgi.file_wrapper (sendfile) and
+    # handles Range / If-None-Match itself when conditional=True
+    response = send_file(
+        path,
+        mimetype=mimetype,
         download_name=row['filename'],
-        as_attachment=False
+        as_attachment=False,
+        conditional=True,
+        etag=etag,
+        max_age=ATTACHMENT_MAX_AGE
     )
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
 
 
 @app.route('/api/chat_history')
@@ -286,115 +2170,1259 @@ def chat_history():
     if 'user_id' not in session:
         return jsonify({'error': 'Unauthorized'}), 401
 
+    if request.args.get('group_id'):
+        return group_history()
+
     friend_id = request.args.get('friend_id')
     if not friend_id:
         return jsonify({'error': 'Missing friend_id'}), 400
 
+    try:
+        friend_id = int(friend_id)
+        limit = min(int(request.args.get('limit', CHAT_PAGE_SIZE)), CHAT_PAGE_MAX)
+        before_id = request.args.get('before_id', type=int)
+        after_id = request.args.get('after_id', type=int)
+        since = request.args.get('since', type=int)
+    except ValueError:
+        return jsonify({'error': 'Invalid parameters'}), 400
+    if limit <= 0:
+        return jsonify({'error': 'Invalid limit'}), 400
+
     conn = get_db()
     c = conn.cursor()
     user_id = session['user_id']
+    pair = (min(user_id, friend_id), max(user_id, friend_id))
+
+    # Keyset pagination over idx_message_pair; fetch one extra row to know if there is more
+    columns = 'id, sender_id, receiver_id, message, timestamp, read, read_at'
+    in_pair = 'min(sender_id, receiver_id) = ? AND max(sender_id, receiver_id) = ?'
+    if since is not None or after_id is not None:
+        # Newer messages, oldest first. since= is the reconnect catch-up with a larger cap
+        if since is not None:
+            after_id, limit = since, CHAT_SYNC_MAX
+        c.execute(f'SELECT {columns} FROM message WHERE {in_pair} AND id > ? ORDER BY id ASC LIMIT ?',
+                  pair + (after_id, limit + 1))
+        rows = c.fetchall()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+    else:
+        # Newest page, or the page before before_id
+        c.execute(f'SELECT {columns} FROM message WHERE {in_pair} AND id < ? ORDER BY id DESC LIMIT ?',
+                  pair + (before_id or sys.maxsize, limit + 1))
+        rows = c.fetchall()
+        if len(rows) <= limit:
+            # Hot table exhausted: continue into the archive files
+            cursor = rows[-1]['id'] if rows else (before_id or sys.maxsize)
+            rows += archived_rows(conn, 'message', pair, in_pair, pair, cursor, limit + 1 - len(rows))
+        has_more = len(rows) > limit
+        rows = rows[:limit][::-1]
+
+    # Only two participants, so resolve names once instead of joining per row
+    names = usernames(conn, pair)
+
+    messages = [{
+        'id': row['id'],
+        'message': row['message'],
+        'sender': names.get(row['sender_id']),
+        'sender_id': row['sender_id'],
+        'receiver': names.get(row['receiver_id']),
+        'receiver_id': row['receiver_id'],
+        'timestamp': row['timestamp'],
+        'read': bool(row['read']),
+        'read_at': row['read_at'] if row['read'] else None,
+    } for row in rows]
+
+    return jsonify({'messages': messages, 'has_more': has_more})
+
+def group_history():
+    # /api/chat_history?group_id=..., same keyset parameters as direct history
+    try:
+        group_id = int(request.args['group_id'])
+        limit = min(int(request.args.get('limit', CHAT_PAGE_SIZE)), CHAT_PAGE_MAX)
+        before_id = request.args.get('before_id', type=int)
+        after_id = request.args.get('after_id', type=int)
+        since = request.args.get('since', type=int)
+    except ValueError:
+        return jsonify({'error': 'Invalid parameters'}), 400
+    if limit <= 0:
+        return jsonify({'error': 'Invalid limit'}), 400
 
-    # Get messages with read status - query both directions of conversation
+    conn = get_db()
+    if not group_membership.is_member(conn, session['user_id'], group_id):
+        return jsonify({'error': 'Not a member of this group'}), 403
+
+    # Keyset pagination over idx_group_message_group
+    columns = 'id, group_id, sender_id, message, timestamp'
+    if since is not None or after_id is not None:
+        if since is not None:
+            after_id, limit = since, CHAT_SYNC_MAX
+        rows = conn.execute(f'SELECT {columns} FROM group_message WHERE group_id = ? AND id > ? ORDER BY id ASC LIMIT ?',
+                            (group_id, after_id, limit + 1)).fetchall()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+    else:
+        rows = conn.execute(f'SELECT {columns} FROM group_message WHERE group_id = ? AND id < ? ORDER BY id DESC LIMIT ?',
+                            (group_id, before_id or sys.maxsize, limit + 1)).fetchall()
+        if len(rows) <= limit:
+            cursor = rows[-1]['id'] if rows else (before_id or sys.maxsize)
+            rows += archived_rows(conn, 'group_message', (group_id, 0), 'group_id = ?', (group_id,),
+                                  cursor, limit + 1 - len(rows))
+        has_more = len(rows) > limit
+        rows = rows[:limit][::-1]
+
+    names = usernames(conn, {row['sender_id'] for row in rows})
+
+    messages = [{
+        'id': row['id'],
+        'group_id': row['group_id'],
+        'message': row['message'],
+        'sender': names.get(row['sender_id']),
+        'sender_id': row['sender_id'],
+        'timestamp': row['timestamp'],
+    } for row in rows]
+
+    return jsonify({'messages': messages, 'has_more': has_more})
+
+INBOX_PAGE_SIZE = 50
+INBOX_PAGE_MAX = 200
+
+def message_preview(text):
+    # File messages are stored as [fileid]<id>|<type>|<name>; show the name
+    if text.startswith('[fileid]'):
+        return '📎 ' + text.split('|', 2)[-1]
+    return text
+
+@app.route('/api/inbox')
+def inbox():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    try:
+        limit = min(int(request.args.get('limit', INBOX_PAGE_SIZE)), INBOX_PAGE_MAX)
+        before_id = request.args.get('before_id', type=int)
+    except ValueError:
+        return jsonify({'error': 'Invalid parameters'}), 400
+    if limit <= 0:
+        return jsonify({'error': 'Invalid limit'}), 400
+
+    conn = get_db()
+    user_id = session['user_id']
+    # Keyset over idx_conversation_recent; before_id is the last_message_id of the previous page's tail
+    rows = conn.execute('''SELECT peer_id, last_message_id, last_sender_id, preview, last_timestamp, unread
+                           FROM conversation WHERE user_id = ? AND last_message_id < ?
+                           ORDER BY last_message_id DESC LIMIT ?''',
+                        (user_id, before_id or sys.maxsize, limit + 1)).fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    records = user_cache.get_many(conn, [row['peer_id'] for row in rows])
+    online = presence.online([row['peer_id'] for row in rows])
+
+    conversations = [{
+        'peer_id': row['peer_id'],
+        'username': records[row['peer_id']]['username'],
+        'avatar': avatar_url(row['peer_id'], records[row['peer_id']]['avatar']),
+        'online': row['peer_id'] in online,
+        'unread': row['unread'],
+        'last_message': {
+            'id': row['last_message_id'],
+            'sender_id': row['last_sender_id'],
+            'preview': message_preview(row['preview']),
+            'timestamp': row['last_timestamp'],
+        },
+    } for row in rows if records[row['peer_id']]]
+
+    return jsonify({'conversations': conversations, 'has_more': has_more})
+
+# --- MESSAGE STORE ---
+# Every message insert goes through these two helpers, directly or via the
+# write-behind queue. Rows are (id, ...) tuples; id None lets SQLite assign it.
+def insert_private_messages(conn, rows):
+    ids = []
+    summaries = []
+    for row in rows:
+        c = conn.execute('INSERT OR IGNORE INTO message (id, sender_id, receiver_id, message, timestamp) '
+                         'VALUES (?, ?, ?, ?, ?)', row)
+        message_id = row[0] or c.lastrowid
+        if c.rowcount:
+            if FTS_AVAILABLE:
+                conn.execute('INSERT INTO message_fts (rowid, message) VALUES (?, ?)', (message_id, row[3]))
+            _, sender_id, receiver_id, message, timestamp = row
+            preview = message[:PREVIEW_LENGTH]
+            summaries.append((sender_id, receiver_id, message_id, sender_id, preview, timestamp, 0))
+            if receiver_id != sender_id:
+                summaries.append((receiver_id, sender_id, message_id, sender_id, preview, timestamp, 1))
+        ids.append(message_id)
+    if summaries:
+        # Rows may arrive out of order (write-behind replay), so only a newer message replaces the preview
+        conn.executemany('''INSERT INTO conversation (user_id, peer_id, last_message_id, last_sender_id,
+                                                       preview, last_timestamp, unread)
+                              VALUES (?, ?, ?, ?, ?, ?, ?)
+                              ON CONFLICT (user_id, peer_id) DO UPDATE SET
+                                  unread = unread + excluded.unread,
+                                  last_sender_id = iif(excluded.last_message_id > last_message_id,
+                                                       excluded.last_sender_id, last_sender_id),
+                                  preview = iif(excluded.last_message_id > last_message_id,
+                                                excluded.preview, preview),
+                                  last_timestamp = iif(excluded.last_message_id > last_message_id,
+                                                       excluded.last_timestamp, last_timestamp),
+                                  last_message_id = max(last_message_id, excluded.last_message_id)''',
+                         summaries)
+    return ids
+
+def insert_group_messages(conn, rows):
+    ids = []
+    for row in rows:
+        c = conn.execute('INSERT OR IGNORE INTO group_message (id, group_id, sender_id, message, timestamp) '
+                         'VALUES (?, ?, ?, ?, ?)', row)
+        message_id = row[0] or c.lastrowid
+        if c.rowcount and FTS_AVAILABLE:
+            conn.execute('INSERT INTO group_message_fts (rowid, message) VALUES (?, ?)', (message_id, row[3]))
+        ids.append(message_id)
+    return ids
+
+MESSAGE_INSERTERS = {
+    'message': insert_private_messages,
+    'group_message': insert_group_messages,
+}
+
+class WriteBehindQueue:
+    """Group-commit writer for chat messages.
+
+    ``submit`` assigns the row id immediately, appends the row to a local
+    journal and queues it; one writer thread commits queued rows in
+    multi-row transactions every ``interval`` seconds or ``batch_size`` rows.
+    The journal is replayed on start (inserts are idempotent thanks to the
+    explicit ids), so a crash never loses a message that was already
+    acknowledged. Once rows are committed their part of the journal is
+    dropped: it is truncated when empty and rewritten down to the
+    uncommitted tail once WRITE_BEHIND_ROTATE_BYTES of it are committed.
+
+    A commit that fails with OperationalError (busy, locked, disk) is
+    retried with backoff. Any other error means a row can never be stored;
+    the batch is split to find it, and it goes to ``<journal>.dead`` so it
+    can't hold up the rows behind it.
+
+    Only the serving process may own the journal: ``start`` runs from
+    ``run_server`` or on first use, never at import, so CLI commands leave it
+    alone.
+    """
+
+    def __init__(self, journal_path, batch_size=WRITE_BEHIND_BATCH,
+                 interval=WRITE_BEHIND_INTERVAL, fsync=WRITE_BEHIND_FSYNC):
+        self.journal_path = journal_path
+        self.dead_letter_path = journal_path + '.dead'
+        self.batch_size = batch_size
+        self.interval = interval
+        self.fsync = fsync
+        self._queue = Queue()
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._next_id = {}
+        self._pending = 0
+        self._journal = None
+        self._journal_base = 0  # journal offsets are counted from the first byte ever written;
+        self._journal_end = 0   # the file holds base..end
+        self._thread = None
+        self._started = False
+        self._stats = {'batches': 0, 'messages': 0, 'max_batch': 0, 'dead': 0,
+                       'commit_time': 0.0, 'max_commit_time': 0.0, 'last_commit_time': 0.0}
+
+    def start(self):
+        with self._start_lock:
+            if self._started:
+                return
+            ensure_db()
+            self.replay()
+            with db_pool.connection() as conn:
+                for table in MESSAGE_INSERTERS:
+                    self._next_id[table] = self.last_used_id(conn, table) + 1
+            self._journal = os.open(self.journal_path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o600)
+            self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+            self._thread.start()
+            self._started = True
+        atexit.register(self.stop)
+
+    @staticmethod
+    def last_used_id(conn, table):
+        # MAX(id) alone would hand out ids again once archiving empties the
+        # table. sqlite_sequence remembers every id ever used (SQLite raises it
+        # for explicit ids too) and archive_span covers the archived rows.
+        return max(
+            conn.execute('SELECT COALESCE(MAX(seq), 0) FROM sqlite_sequence WHERE name = ?', (table,)).fetchone()[0],
+            conn.execute(f'SELECT COALESCE(MAX(id), 0) FROM {table}').fetchone()[0],
+            conn.execute('SELECT COALESCE(MAX(max_id), 0) FROM archive_span WHERE tbl = ?', (table,)).fetchone()[0],
+        )
+
+    def replay(self):
+        if not os.path.exists(self.journal_path):
+            return
+        records = []
+        with open(self.journal_path) as journal:
+            for line in journal:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break  # torn final write from a crash
+        if records:
+            self._write(records)
+        os.truncate(self.journal_path, 0)
+
+    def submit(self, table, values):
+        if not self._started:
+            self.start()
+        with self._lock:
+            row_id = self._next_id[table]
+            self._next_id[table] += 1
+            record = [table, row_id, *values]
+            line = (json.dumps(record) + '\n').encode()
+            os.write(self._journal, line)
+            if self.fsync:
+                run_blocking(os.fsync, self._journal)
+            self._journal_end += len(line)
+            self._pending += 1
+            # Queued in journal order, so every batch commits a prefix of what is left
+            self._queue.put((record, self._journal_end))
+        return row_id
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except Empty:
+                break
+        return batch
+
+    def _insert(self, records):
+        by_table = {}
+        for table, *row in records:
+            by_table.setdefault(table, []).append(row)
+        with db_pool.connection() as conn:
+            try:
+                for table, rows in by_table.items():
+                    MESSAGE_INSERTERS[table](conn, rows)
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+
+    def _write(self, records):
+        # Commits every record that can be stored; only OperationalError
+        # (worth retrying) propagates. A re-run after one is safe because
+        # inserts with explicit ids are idempotent.
+        try:
+            self._insert(records)
+        except sqlite3.OperationalError:
+            raise
+        except Exception as e:
+            if len(records) == 1:
+                self._dead_letter(records[0], e)
+                return
+            middle = len(records) // 2
+            self._write(records[:middle])
+            self._write(records[middle:])
+
+    def _dead_letter(self, record, error):
+        app.logger.error('Write-behind row can never be stored (%s); moved to %s: %r',
+                         error, self.dead_letter_path, record)
+        with open(self.dead_letter_path, 'a') as f:
+            f.write(json.dumps(record, default=repr) + '\n')
+        with self._lock:
+            self._stats['dead'] += 1
+
+    def _trim_journal(self, committed):
+        # Called under _lock once everything up to offset ``committed`` is in the database
+        if committed == self._journal_end:
+            os.ftruncate(self._journal, 0)
+            self._journal_base = committed
+        elif committed - self._journal_base >= WRITE_BEHIND_ROTATE_BYTES:
+            # Never empty under steady load: rewrite it with only the uncommitted tail
+            tail = os.pread(self._journal, self._journal_end - committed, committed - self._journal_base)
+            rotated = self.journal_path + '.tmp'
+            journal = os.open(rotated, os.O_RDWR | os.O_APPEND | os.O_CREAT | os.O_TRUNC, 0o600)
+            os.write(journal, tail)
+            if self.fsync:
+                os.fsync(journal)
+            os.replace(rotated, self.journal_path)
+            os.close(self._journal)
+            self._journal = journal
+            self._journal_base = committed
+
+    def _commit(self, batch):
+        items = [item for item in batch if item is not None]
+        if not items:
+            return
+        records = [record for record, _ in items]
+        started = time.perf_counter()
+        self._write(records)
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self._pending -= len(records)
+            self._trim_journal(items[-1][1])
+            stats = self._stats
+            stats['batches'] += 1
+            stats['messages'] += len(records)
+            stats['max_batch'] = max(stats['max_batch'], len(records))
+            stats['commit_time'] += elapsed
+            stats['last_commit_time'] = elapsed
+            stats['max_commit_time'] = max(stats['max_commit_time'], elapsed)
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            delay = WRITE_BEHIND_RETRY_MIN
+            while True:
+                try:
+                    self._commit(batch)
+                    break
+                except (sqlite3.OperationalError, OSError) as e:
+                    if None in batch:
+                        # Shutting down: the rows stay in the journal for the next start
+                        app.logger.exception('Write-behind commit failed at shutdown: %s', e)
+                        break
+                    # Keep the batch (and everything queued behind it) until it commits;
+                    # the journal is only trimmed past rows that made it in
+                    app.logger.exception('Write-behind commit failed, retrying in %.2fs: %s', delay, e)
+                    time.sleep(delay)
+                    delay = min(delay * 2, WRITE_BEHIND_RETRY_MAX)
+            if None in batch:
+                return
+
+    def stop(self, timeout=5):
+        if self._thread and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['pending'] = self._pending
+        stats['avg_batch'] = round(stats['messages'] / stats['batches'], 2) if stats['batches'] else 0
+        stats['avg_commit_time'] = round(stats['commit_time'] / stats['batches'], 6) if stats['batches'] else 0
+        return stats
+
+if WRITE_BEHIND and MESSAGE_QUEUE:
+    # Ids are allocated in-process, so only one process may own the writer
+    app.logger.warning('CHATAPP_WRITE_BEHIND is ignored when running with a message queue')
+    WRITE_BEHIND = False
+
+write_behind = WriteBehindQueue(DB_NAME + '.journal') if WRITE_BEHIND else None
+
+@app.before_request
+def start_write_behind():
+    # Replay the journal before serving rather than on the first message
+    if write_behind:
+        write_behind.start()
+
+def save_private_message(sender_id, receiver_id, message, timestamp):
+    if write_behind:
+        return write_behind.submit('message', (sender_id, receiver_id, message, timestamp))
+    conn = get_db()
+    message_id, = insert_private_messages(conn, [(None, sender_id, receiver_id, message, timestamp)])
+    conn.commit()
+    return message_id
+
+def save_group_message(group_id, sender_id, message, timestamp=None):
+    timestamp = timestamp or now_ms()
+    if write_behind:
+        return write_behind.submit('group_message', (group_id, sender_id, message, timestamp))
+    conn = get_db()
+    message_id, = insert_group_messages(conn, [(None, group_id, sender_id, message, timestamp)])
+    conn.commit()
+    return message_id
+
+# --- MESSAGE ARCHIVE ---
+# Cold messages live in ARCHIVE_FOLDER/messages-YYYY-MM.db, one file per local
+# calendar month, with the same ids and columns as the hot tables. Archiving
+# moves the oldest rows by time, and ids are assigned in time order, so every
+# archived id is below every hot one and history can page straight into them.
+ARCHIVE_TABLES = {
+    'message': (
+        'id, sender_id, receiver_id, message, timestamp, read, read_at',
+        '''CREATE TABLE IF NOT EXISTS archive.message (
+            id          INTEGER PRIMARY KEY,
+            sender_id   INTEGER NOT NULL,
+            receiver_id INTEGER NOT NULL,
+            message     TEXT NOT NULL,
+            timestamp   INTEGER NOT NULL,
+            read        INTEGER,
+            read_at     DATETIME
+        )''',
+        '''CREATE INDEX IF NOT EXISTS archive.idx_message_pair
+           ON message (min(sender_id, receiver_id), max(sender_id, receiver_id), id)''',
+    ),
+    'group_message': (
+        'id, group_id, sender_id, message, timestamp',
+        '''CREATE TABLE IF NOT EXISTS archive.group_message (
+            id        INTEGER PRIMARY KEY,
+            group_id  INTEGER,
+            sender_id INTEGER,
+            message   TEXT NOT NULL,
+            timestamp INTEGER NOT NULL
+        )''',
+        'CREATE INDEX IF NOT EXISTS archive.idx_group_message_group ON group_message (group_id, id)',
+    ),
+}
+
+def archive_path(month):
+    return os.path.join(ARCHIVE_FOLDER, f'messages-{month}.db')
+
+def month_bounds(timestamp_ms):
+    # Local calendar month containing timestamp_ms, as (YYYY-MM, start_ms, end_ms)
+    start = datetime.fromtimestamp(timestamp_ms / 1000).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    end = (start + timedelta(days=32)).replace(day=1)
+    return start.strftime('%Y-%m'), int(start.timestamp() * 1000), int(end.timestamp() * 1000)
+
+def archive_messages(conn, cutoff_ms):
+    """Move rows older than cutoff_ms into monthly archive files; returns {month: rows}."""
+    os.makedirs(ARCHIVE_FOLDER, exist_ok=True)
+    moved = {}
+    for table, (columns, create_table, create_index) in ARCHIVE_TABLES.items():
+        fts = f'{table}_fts'
+        has_fts = FTS_AVAILABLE and conn.execute('SELECT 1 FROM sqlite_master WHERE name = ?', (fts,)).fetchone()
+        while True:
+            oldest = conn.execute(f'SELECT MIN(timestamp) FROM {table} WHERE timestamp < ?', (cutoff_ms,)).fetchone()[0]
+            if oldest is None:
+                break
+            month, start, end = month_bounds(oldest)
+            where = 'timestamp >= ? AND timestamp < ?'
+            params = (start, min(end, cutoff_ms))
+            conn.execute('ATTACH DATABASE ? AS archive', (archive_path(month),))
+            try:
+                # Copy and delete commit separately: with WAL a transaction spanning
+                # attached files is not atomic as a whole, and a crash between the
+                # two only leaves rows that the next run re-copies with OR IGNORE
+                conn.execute(create_table)
+                conn.execute(create_index)
+                conn.execute(f'INSERT OR IGNORE INTO archive.{table} ({columns}) '
+                             f'SELECT {columns} FROM main.{table} WHERE {where}', params)
+                conn.commit()
+            finally:
+                conn.execute('DETACH DATABASE archive')
+            low, high = ARCHIVE_SPAN_KEYS[table]
+            spans = conn.execute(f'SELECT {low}, {high}, MIN(id), MAX(id) FROM main.{table} '
+                                 f'WHERE {where} GROUP BY 1, 2', params).fetchall()
+            conn.executemany(ARCHIVE_SPAN_UPSERT, [(table, span[0], span[1], month, span[2], span[3]) for span in spans])
+            if has_fts:
+                conn.execute(f"INSERT INTO {fts} ({fts}, rowid, message) "
+                             f"SELECT 'delete', id, message FROM main.{table} WHERE {where}", params)
+            count = conn.execute(f'DELETE FROM main.{table} WHERE {where}', params).rowcount
+            conn.commit()
+            moved[month] = moved.get(month, 0) + count
+    return moved
+
+def read_archive(path, sql, params):
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    conn.row_factory = sqlite3.Row
+    try:
+        return conn.execute(sql, params).fetchall()
+    except sqlite3.OperationalError:
+        return []  # month file without this table
+    finally:
+        conn.close()
+
+def archived_rows(conn, table, conversation, where, params, before_id, limit):
+    """Newest-first rows older than before_id from the archive files, at most limit.
+
+    Only months whose archive_span says they hold rows of ``conversation``
+    (a ``(conv_low, conv_high)`` key, see ARCHIVE_SPAN_KEYS) below before_id
+    are opened, so a conversation that was never archived costs one indexed
+    lookup.
+    """
+    months = [row['month'] for row in conn.execute(
+        'SELECT month FROM archive_span WHERE tbl = ? AND conv_low = ? AND conv_high = ? AND min_id < ? '
+        'ORDER BY max_id DESC', (table, *conversation, before_id))]
+    sql = f'SELECT {ARCHIVE_TABLES[table][0]} FROM {table} WHERE {where} AND id < ? ORDER BY id DESC LIMIT ?'
+    rows = []
+    for month in months:
+        if len(rows) >= limit:
+            break
+        rows += run_blocking(read_archive, archive_path(month), sql, params + (before_id, limit - len(rows)))
+    return rows
+
+@app.cli.command('archive-messages')
+@click.option('--days', type=int, default=ARCHIVE_AFTER_DAYS, show_default=True,
+              help='Archive messages older than this many days.')
+@click.option('--vacuum', is_flag=True, help='VACUUM the database afterwards to reclaim space.')
+def archive_messages_command(days, vacuum):
+    """Move old messages out of the hot database into monthly archive files."""
+    ensure_db()
+    cutoff = now_ms() - days * 24 * 3600 * 1000
+    with db_pool.connection() as conn:
+        moved = archive_messages(conn, cutoff)
+        if vacuum:
+            conn.execute('VACUUM')
+    for month, count in sorted(moved.items()):
+        click.echo(f'{archive_path(month)}: {count} row(s)')
+    click.echo(f'Archived {sum(moved.values())} row(s) older than {days} day(s)')
+
+def fts_query(text):
+    # Every word must appear; the last one may be a prefix (search-as-you-type)
+    terms = ['"' + word.replace('"', '""') + '"' for word in text.split()]
+    if terms:
+        terms[-1] += '*'
+    return ' '.join(terms)
+
+def highlight_snippet(snippet):
+    # snippet() returns raw message text, so escape it before adding markup
+    return html.escape(snippet).replace('\x02', '<mark>').replace('\x03', '</mark>')
+
+@app.route('/api/search_messages')
+def search_messages():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    if not FTS_AVAILABLE:
+        return jsonify({'error': 'Message search is unavailable'}), 503
+    query = fts_query(request.args.get('q', ''))
+    if not query:
+        return jsonify({'results': [], 'has_more': False})
+    try:
+        limit = min(int(request.args.get('limit', SEARCH_PAGE_SIZE)), SEARCH_PAGE_MAX)
+        offset = max(int(request.args.get('offset', 0)), 0)
+    except ValueError:
+        return jsonify({'error': 'Invalid parameters'}), 400
+    user_id = session['user_id']
+
+    conn = get_db()
+    c = conn.cursor()
+    # Only conversations the caller is part of: their direct messages and accepted groups
     c.execute('''
-        SELECT m.*, 
-               sender.username as sender_name, 
-               receiver.username as receiver_name
-        FROM message m
-        JOIN user sender ON m.sender_id = sender.id
-        JOIN user receiver ON m.receiver_id = receiver.id
-        WHERE (m.sender_id = ? AND m.receiver_id = ?) 
-           OR (m.sender_id = ? AND m.receiver_id = ?)
-        ORDER BY m.timestamp ASC
-    ''', (user_id, friend_id, friend_id, user_id))
-
-    messages = []
-    for row in c.fetchall():
-        print(dict(row))
-        messages.append({
-            'id': row['id'],
-            'message': row['message'],
-            'sender': row['sender_name'],
-            'sender_id': row['sender_id'],
-            'receiver': row['receiver_name'],
-            'receiver_id': row['receiver_id'],
-            'timestamp': row['timestamp'],
-            'read': bool(row['read']),
-            'read_at': row['read_at'] if row['read'] else None,
-            #'file_id': row.get('file_id'),
-            #'filetype': row.get('filetype'),
-            #'filename': row.get('filename')
-        })
-
-    return jsonify({'messages': messages})
-# --- SOCKETIO PRIVATE MESSAGING ---
-user_sid_map = {}  # user_id: sid
+        SELECT 'direct' AS type, m.id AS id, NULL AS group_id, NULL AS group_name,
+               CASE WHEN m.sender_id = :me THEN m.receiver_id ELSE m.sender_id END AS friend_id,
+               m.sender_id, u.username AS sender, m.timestamp,
+               snippet(message_fts, 0, char(2), char(3), '…', 12) AS snippet,
+               bm25(message_fts) AS rank
+        FROM message_fts
+        JOIN message m ON m.id = message_fts.rowid
+        JOIN user u ON u.id = m.sender_id
+        WHERE message_fts MATCH :q AND (m.sender_id = :me OR m.receiver_id = :me)
+        UNION ALL
+        SELECT 'group', gm.id, gm.group_id, g.name, NULL,
+               gm.sender_id, u.username, gm.timestamp,
+               snippet(group_message_fts, 0, char(2), char(3), '…', 12),
+               bm25(group_message_fts)
+        FROM group_message_fts
+        JOIN group_message gm ON gm.id = group_message_fts.rowid
+        JOIN "group" g ON g.id = gm.group_id
+        JOIN user u ON u.id = gm.sender_id
+        WHERE group_message_fts MATCH :q
+          AND gm.group_id IN (SELECT group_id FROM group_member WHERE user_id = :me AND status = 'accepted')
+        ORDER BY rank, id DESC
+        LIMIT :limit OFFSET :offset
+    ''', {'me': user_id, 'q': query, 'limit': limit + 1, 'offset': offset})
+    rows = c.fetchall()
+
+    results = [{
+        'type': row['type'],
+        'id': row['id'],
+        'friend_id': row['friend_id'],
+        'group_id': row['group_id'],
+        'group_name': row['group_name'],
+        'sender_id': row['sender_id'],
+        'sender': row['sender'],
+        'timestamp': row['timestamp'],
+        'snippet': highlight_snippet(row['snippet']),
+    } for row in rows[:limit]]
+    return jsonify({'results': results, 'has_more': len(rows) > limit})
+
+# --- ROUTING ---
+# Where a user's sockets live. Every per-user emit goes through router.send so
+# delivery works the same whether the socket is on this worker or another one.
+user_sid_map = {}  # user_id: set of this process's sids (the whole table for LocalRouter)
+
+NODE_ID = f'{socket.gethostname()}:{os.getpid()}'
+NODE_HEARTBEAT_INTERVAL = 10  # seconds
+NODE_TIMEOUT = 30             # routes of nodes silent for longer are dropped
+
+def user_room(user_id):
+    # Every connection of a user (all devices, any worker) joins this room
+    return f'user_{user_id}'
+
+@contextmanager
+def route_db():
+    # Inside a request or socket handler reuse its connection: checking out a
+    # second one while holding g.db can wait forever once the pool runs dry
+    if has_app_context():
+        yield get_db()
+    else:
+        with db_pool.connection() as conn:
+            yield conn
+
+class LocalRouter:
+    """Routing table for a single process, kept in user_sid_map."""
+
+    def register(self, user_id, sid):
+        user_sid_map.setdefault(user_id, set()).add(sid)
+
+    def unregister(self, user_id, sid):
+        sids = user_sid_map.get(user_id)
+        if sids is not None:
+            sids.discard(sid)
+            if not sids:
+                del user_sid_map[user_id]
+
+    def sids(self, user_ids):
+        return {user_id: list(user_sid_map[user_id]) for user_id in user_ids if user_id in user_sid_map}
+
+    def local_sids(self, user_id):
+        # Only sockets connected to this process, which is all join_room can reach
+        return set(user_sid_map.get(user_id, ()))
+
+    def online_count(self):
+        return len(user_sid_map)
+
+    def heartbeat(self):
+        pass
+
+    def send(self, event, payload, user_id, batch=False):
+        self.send_many(event, {user_id: payload}, batch)
+
+    def send_many(self, event, payloads, batch=False):
+        # payloads: user_id -> payload; users with no live socket are skipped.
+        # batch=True lets outbound coalesce it with other messages to the same user.
+        send = outbound.emit if batch else socketio.emit
+        for user_id in self.sids(payloads):
+            send(event, payloads[user_id], room=user_room(user_id))
+
+class SharedRouter(LocalRouter):
+    """Routing table shared by every worker through the database.
+
+    Each worker records its sockets in socket_route (and, for local_sids, in
+    user_sid_map) and heartbeats in socket_node; emits to a user room travel
+    over MESSAGE_QUEUE to whichever workers hold that user's connections.
+    Routes of workers that stop heartbeating are purged. Nothing touches the
+    database until the first socket registers (init_db has run by then).
+    """
+
+    def __init__(self):
+        self._last_heartbeat = 0  # heartbeat on the first register
+
+    def register(self, user_id, sid):
+        super().register(user_id, sid)  # local_sids
+        if time.time() - self._last_heartbeat > NODE_HEARTBEAT_INTERVAL:
+            self.heartbeat()
+        with route_db() as conn:
+            conn.execute('INSERT OR REPLACE INTO socket_route (sid, user_id, node, connected_at) VALUES (?, ?, ?, ?)',
+                         (sid, user_id, NODE_ID, time.time()))
+            conn.commit()
+
+    def unregister(self, user_id, sid):
+        super().unregister(user_id, sid)
+        with route_db() as conn:
+            conn.execute('DELETE FROM socket_route WHERE sid = ?', (sid,))
+            conn.commit()
 
+    def sids(self, user_ids):
+        user_ids = list(user_ids)
+        result = {}
+        if not user_ids:
+            return result
+        with route_db() as conn:
+            rows = conn.execute(f'SELECT user_id, sid FROM socket_route WHERE user_id IN ({",".join("?" * len(user_ids))})',
+                                user_ids).fetchall()
+        for row in rows:
+            result.setdefault(row['user_id'], []).append(row['sid'])
+        return result
+
+    def online_count(self):
+        with route_db() as conn:
+            return conn.execute('SELECT COUNT(DISTINCT user_id) FROM socket_route').fetchone()[0]
+
+    def heartbeat(self):
+        now = time.time()
+        self._last_heartbeat = now
+        with route_db() as conn:
+            conn.execute('INSERT OR REPLACE INTO socket_node (node, heartbeat) VALUES (?, ?)', (NODE_ID, now))
+            conn.execute('DELETE FROM socket_route WHERE node IN (SELECT node FROM socket_node WHERE heartbeat < ?)',
+                         (now - NODE_TIMEOUT,))
+            conn.execute('DELETE FROM socket_node WHERE heartbeat < ?', (now - NODE_TIMEOUT,))
+            conn.commit()
+
+router = SharedRouter() if MESSAGE_QUEUE else LocalRouter()
+
+# --- WIRE FORMAT ---
+# Message events (private_message, group_message, replay) in compact mode use
+# these short keys and drop empty fields; chat.js gets the same table from the
+# page and expands them. File messages carry file_id/filetype/filename instead
+# of the stored "[fileid]id|type|name" string.
+WIRE_FIELDS = {
+    'id': 'i', 'from_id': 'f', 'to_id': 't', 'group_id': 'g', 'sender': 's', 'sender_id': 'u',
+    'message': 'm', 'timestamp': 'ts', 'file_id': 'fi', 'filetype': 'ft', 'filename': 'fn',
+}
+
+def wire_config():
+    # Handed to chat.js so it picks the matching client parser and key table
+    return {'serializer': SOCKET_SERIALIZER, 'fields': WIRE_FIELDS if SOCKET_COMPACT else None}
+
+def wire_message(payload):
+    if not SOCKET_COMPACT:
+        return payload
+    text = payload.get('message') or ''
+    if text.startswith('[fileid]') and not payload.get('file_id'):
+        file_id, filetype, filename = (text[len('[fileid]'):].split('|', 2) + ['', ''])[:3]
+        payload = dict(payload, message='', file_id=file_id, filetype=filetype, filename=filename)
+    return {WIRE_FIELDS.get(key, key): value for key, value in payload.items() if value is not None and value != ''}
+
+class OutboundBatcher:
+    """Coalesces message events per room into one ``messages`` event.
+
+    Events emitted to a room within SOCKET_BATCH_WINDOW of each other go out
+    as a single ``messages`` frame holding ``[event, payload]`` pairs, so a
+    busy user or a large group costs one frame (and one serialisation) per
+    window rather than one per message. A lone event is sent unchanged.
+    """
+
+    def __init__(self, window=SOCKET_BATCH_WINDOW, max_batch=SOCKET_BATCH_MAX):
+        self.window = window
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._pending = {}  # room: [[event, payload], ...]
+        self._wakeup = threading.Event()
+        self._started = False
+        self.frames = 0
+        self.events = 0
+
+    def emit(self, event, payload, room):
+        if not self.window:
+            self._send(room, [[event, payload]])
+            return
+        with self._lock:
+            items = self._pending.setdefault(room, [])
+            items.append([event, payload])
+            if len(items) >= self.max_batch:
+                del self._pending[room]
+            else:
+                items = None
+            if not self._started:
+                self._started = True
+                socketio.start_background_task(self._run)
+        if items:
+            self._send(room, items)
+        self._wakeup.set()
+
+    def pending(self):
+        with self._lock:
+            return sum(len(items) for items in self._pending.values())
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for room, items in pending.items():
+            self._send(room, items)
+
+    def _send(self, room, items):
+        self.frames += 1
+        self.events += len(items)
+        if len(items) == 1:
+            socketio.emit(items[0][0], items[0][1], room=room)
+        else:
+            socketio.emit('messages', items, room=room)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            socketio.sleep(self.window)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                app.logger.exception('Outbound batch flush error: %s', e)
+
+outbound = OutboundBatcher()
+
+# --- SOCKET RATE LIMITS ---
+# Token bucket per (user, event): 'rate' tokens per second up to 'burst'. Each
+# worker enforces its own buckets. A rejected event is dropped and answered
+# with a 'throttled' event. Override any entry with
+# CHATAPP_RATE_LIMITS="private_message=5:20,group_create=0.1:3"; a rate of 0
+# lifts the limit for that event.
+SOCKET_RATE_LIMITS = {
+    'private_message': (10, 30),
+    'group_message': (10, 30),
+    'group_create': (0.2, 5),
+    'group_accept': (2, 10),
+    'delivered': (5, 20),
+}
+RATE_LIMIT_TRACKED = 100000  # buckets kept before the least recently used are dropped
+SOCKET_QUEUE_MAX = int(os.environ.get('CHATAPP_SOCKET_QUEUE_MAX', 1000))      # queued packets per socket; 0 = unbounded
+SOCKET_QUEUE_CHECK_INTERVAL = 1.0                                            # seconds between slow-consumer sweeps
+GROUP_MAX_MEMBERS = int(os.environ.get('CHATAPP_GROUP_MAX_MEMBERS', 256))   # member_ids accepted by group_create
+
+def parse_rate_limits(spec, defaults=SOCKET_RATE_LIMITS):
+    limits = dict(defaults)
+    for item in filter(None, (part.strip() for part in (spec or '').split(','))):
+        event, _, value = item.partition('=')
+        rate, _, burst = value.partition(':')
+        limits[event.strip()] = (float(rate), float(burst or rate))
+    return limits
+
+SOCKET_RATE_LIMITS = parse_rate_limits(os.environ.get('CHATAPP_RATE_LIMITS'))
+
+class RateLimiter:
+    """Token buckets keyed by (user_id, event), least recently used dropped first."""
+
+    def __init__(self, limits=SOCKET_RATE_LIMITS, size=RATE_LIMIT_TRACKED):
+        self.limits = limits
+        self.size = size
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()  # (user_id, event): (tokens, updated)
+
+    def acquire(self, user_id, event):
+        """Take a token; returns 0 on success, else seconds until one is available."""
+        rate, burst = self.limits.get(event, (0, 0))
+        if not rate:
+            return 0
+        key = (user_id, event)
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.size:
+                self._buckets.popitem(last=False)
+        return 0 if allowed else (1 - tokens) / rate
+
+    def stats(self):
+        with self._lock:
+            return {'tracked': len(self._buckets)}
+
+rate_limiter = RateLimiter()
+socket_rejected = register_metric(Counter('chatapp_socket_rejected_total',
+                                          'Socket.IO events refused by a limit.', ('event', 'reason')))
+slow_consumer_disconnects = register_metric(Counter('chatapp_socket_slow_consumer_disconnects_total',
+                                                    'Sockets dropped for exceeding CHATAPP_SOCKET_QUEUE_MAX.'))
+register_metric(Gauge('chatapp_socket_rate_limit', 'Configured token bucket per event.',
+                      lambda: {(event, param): value for event, (rate, burst) in SOCKET_RATE_LIMITS.items()
+                               for param, value in (('rate', rate), ('burst', burst))},
+                      ('event', 'param')))
+register_metric(Gauge('chatapp_socket_queue_limit', 'Queued packets allowed per socket (0 = unbounded).',
+                      lambda: SOCKET_QUEUE_MAX))
+register_metric(Gauge('chatapp_group_member_limit', 'member_ids accepted by group_create.',
+                      lambda: GROUP_MAX_MEMBERS))
+
+def reject_event(event, reason, **details):
+    socket_rejected.inc(event, reason)
+    emit('throttled', dict(details, event=event, reason=reason))
+
+def socket_throttled(event):
+    # Call at the top of a handler: True (after telling the client) means drop the event
+    retry_after = rate_limiter.acquire(session.get('user_id') or request.sid, event)
+    if not retry_after:
+        return False
+    reject_event(event, 'rate', retry_after=round(retry_after, 3))
+    return True
+
+def drop_slow_consumers():
+    # A socket whose Engine.IO send queue keeps growing is not reading; cut it
+    # loose rather than buffer for it. It reconnects and catches up via replay.
+    if not SOCKET_QUEUE_MAX:
+        return
+    for eio_sid, sock in list(socketio.server.eio.sockets.items()):
+        if sock.queue.qsize() > SOCKET_QUEUE_MAX:
+            app.logger.warning('Disconnecting slow consumer %s (%d packets queued)', eio_sid, sock.queue.qsize())
+            slow_consumer_disconnects.inc()
+            socketio.server.eio.disconnect(eio_sid)
+
+# --- PRESENCE ---
+PRESENCE_PUSH_INTERVAL = 1.0   # seconds; state changes inside a window are coalesced
+LAST_SEEN_FLUSH_INTERVAL = 30  # seconds between batched last_seen writes
+PRESENCE_BATCH_LIMIT = 500     # max ids accepted by /api/presence
+
+def now_str():
+    return datetime.now().isoformat(sep=' ', timespec='seconds')
+
+def format_last_seen(last_seen_time):
+    diff = datetime.now() - last_seen_time
+
+    # Format the last seen time in a human-readable way
+    if diff.days > 0:
+        if diff.days == 1:
+            return "yesterday"
+        return f"{diff.days} days ago"
+    elif diff.seconds >= 3600:
+        return f"{diff.seconds // 3600}h ago"
+    elif diff.seconds >= 60:
+        return f"{diff.seconds // 60}m ago"
+    return "just now"
+
+class PresenceRegistry:
+    """last_seen and pending presence changes for users connecting to this process.
+
+    Online state itself comes from the router, so it is correct across
+    workers. Connect/disconnect only touch memory; changes are pushed to
+    friends in coalesced batches and last_seen is written back to the
+    database in one statement per flush interval.
+    """
+
+    def __init__(self, router):
+        self.router = router
+        self._lock = threading.Lock()
+        self._last_seen = {}    # user_id: 'YYYY-MM-DD HH:MM:SS', until written back while offline
+        self._published = {}    # user_id: 'online' for users friends last saw online
+        self._changed = set()
+        self._dirty = set()
+
+    def connect(self, user_id):
+        self._touch(user_id)
+
+    def disconnect(self, user_id):
+        self._touch(user_id)
+
+    def _touch(self, user_id):
+        with self._lock:
+            self._last_seen[user_id] = now_str()
+            self._changed.add(user_id)
+            self._dirty.add(user_id)
+
+    def online(self, user_ids):
+        # One router lookup for the whole batch
+        return set(self.router.sids(user_ids))
+
+    def last_seen(self, user_id):
+        return self._last_seen.get(user_id)
+
+    def online_count(self):
+        return self.router.online_count()
+
+    def drain_changes(self):
+        # Only report users whose state differs from what friends last saw
+        with self._lock:
+            changed, self._changed = self._changed, set()
+        online = self.router.sids(changed)
+        result = []
+        with self._lock:
+            for user_id in changed:
+                status = 'online' if user_id in online else 'offline'
+                if self._published.get(user_id, 'offline') != status:
+                    if status == 'online':
+                        self._published[user_id] = status
+                    else:
+                        del self._published[user_id]
+                    result.append((user_id, status, self._last_seen[user_id]))
+        return result
+
+    def drain_last_seen(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            return [(self._last_seen[user_id], user_id) for user_id in dirty]
+
+    def written_back(self, user_ids):
+        # Offline users whose last_seen is now in the database (and user_cache)
+        # are read from there, so their entries here can go
+        with self._lock:
+            for user_id in user_ids:
+                if user_id not in self._published and user_id not in self._changed and user_id not in self._dirty:
+                    self._last_seen.pop(user_id, None)
+
+presence = PresenceRegistry(router)
+_presence_worker_started = False
+_presence_worker_lock = threading.Lock()
+
+def presence_entry(user_id, last_seen_str, online):
+    entry = {'status': 'online' if online else 'offline',
+             'last_seen': 'Unknown', 'timestamp': None}
+    if last_seen_str:
+        last_seen_time = datetime.strptime(last_seen_str, '%Y-%m-%d %H:%M:%S')
+        entry['last_seen'] = format_last_seen(last_seen_time)
+        entry['timestamp'] = last_seen_str
+    return entry
+
+def flush_last_seen():
+    rows = presence.drain_last_seen()
+    if rows:
+        with db_pool.connection() as conn:
+            conn.executemany('UPDATE user SET last_seen = ? WHERE id = ?', rows)
+            conn.commit()
+        user_cache.update_last_seen(rows)
+        presence.written_back([user_id for _, user_id in rows])
+
+def push_presence():
+    changes = presence.drain_changes()
+    if not changes:
+        return
+    with db_pool.connection() as conn:
+        friends = accepted_friend_ids(conn, [user_id for user_id, _, _ in changes])
+    # One event per recipient carrying every friend that changed
+    outbox = {}
+    for user_id, status, last_seen_str in changes:
+        update = {'id': user_id, 'status': status, 'last_seen': 'just now',
+                  'timestamp': last_seen_str}
+        for friend_id in friends[user_id]:
+            outbox.setdefault(friend_id, {'users': []})['users'].append(update)
+    router.send_many('presence', outbox)
+
+def presence_worker():
+    last_flush = last_heartbeat = last_sweep = time.monotonic()
+    while True:
+        socketio.sleep(PRESENCE_PUSH_INTERVAL)
+        try:
+            push_presence()
+            if time.monotonic() - last_sweep >= SOCKET_QUEUE_CHECK_INTERVAL:
+                last_sweep = time.monotonic()
+                drop_slow_consumers()
+            if time.monotonic() - last_heartbeat >= NODE_HEARTBEAT_INTERVAL:
+                last_heartbeat = time.monotonic()
+                router.heartbeat()
+            if time.monotonic() - last_flush >= LAST_SEEN_FLUSH_INTERVAL:
+                last_flush = time.monotonic()
+                flush_last_seen()
+        except Exception as e:
+            app.logger.exception('Presence worker error: %s', e)
+
+def ensure_presence_worker():
+    global _presence_worker_started
+    if _presence_worker_started:
+        return
+    with _presence_worker_lock:
+        if not _presence_worker_started:
+            _presence_worker_started = True
+            socketio.start_background_task(presence_worker)
+
+atexit.register(flush_last_seen)
+
+# --- DEVICE CURSORS ---
+# Each device acknowledges the highest direct / group message id it has seen.
+# On reconnect it gets everything after that in one 'replay' event.
+REPLAY_MAX = 500
+DEVICE_ID_MAX_LENGTH = 64
+
+def load_device_cursor(conn, user_id, device_id):
+    row = conn.execute('SELECT message_id, group_message_id FROM device_cursor WHERE user_id = ? AND device_id = ?',
+                       (user_id, device_id)).fetchone()
+    if row:
+        return row['message_id'], row['group_message_id']
+    # New device: it loads history over REST, so start from the current tip
+    message_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM message').fetchone()[0]
+    group_message_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM group_message').fetchone()[0]
+    conn.execute('INSERT OR IGNORE INTO device_cursor (user_id, device_id, message_id, group_message_id, updated_at) '
+                 'VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)', (user_id, device_id, message_id, group_message_id))
+    conn.commit()
+    return None
+
+def build_replay(conn, user_id, message_id, group_message_id):
+    c = conn.cursor()
+    c.execute('''SELECT id, sender_id, receiver_id, message, timestamp FROM message
+                 WHERE receiver_id = :me AND id > :cursor
+                 UNION ALL
+                 SELECT id, sender_id, receiver_id, message, timestamp FROM message
+                 WHERE sender_id = :me AND receiver_id != :me AND id > :cursor
+                 ORDER BY id LIMIT :limit''', {'me': user_id, 'cursor': message_id, 'limit': REPLAY_MAX + 1})
+    direct = c.fetchall()
+    group_ids = list(group_membership.groups_of(conn, user_id))
+    group = []
+    if group_ids:
+        c.execute(f'''SELECT id, group_id, sender_id, message, timestamp FROM group_message
+                      WHERE id > ? AND group_id IN ({",".join("?" * len(group_ids))})
+                      ORDER BY id LIMIT ?''', [group_message_id] + group_ids + [REPLAY_MAX + 1])
+        group = c.fetchall()
+
+    sender_ids = {row['sender_id'] for row in direct} | {row['sender_id'] for row in group}
+    names = usernames(conn, sender_ids)
+
+    # Same shapes as the live private_message / group_message events
+    return {
+        'messages': [wire_message({
+            'id': row['id'], 'from_id': row['sender_id'], 'to_id': row['receiver_id'],
+            'sender': names.get(row['sender_id']), 'message': row['message'],
+            'file_id': None, 'filetype': None, 'filename': None, 'timestamp': row['timestamp'],
+        }) for row in direct[:REPLAY_MAX]],
+        'group_messages': [wire_message({
+            'id': row['id'], 'group_id': row['group_id'], 'sender': names.get(row['sender_id']),
+            'message': row['message'], 'timestamp': row['timestamp'],
+        }) for row in group[:REPLAY_MAX]],
+        'has_more': len(direct) > REPLAY_MAX or len(group) > REPLAY_MAX,
+    }
+
+# --- SOCKETIO PRIVATE MESSAGING ---
 @socketio.on('connect')
-def on_connect():
+def on_connect(auth=None):
+    ensure_db()  # the Socket.IO handshake skips before_request
     if 'user_id' in session:
         user_id = session['user_id']
 
-        user_sid_map[user_id] = request.sid
-
-        # Update last seen time when user connects
-        conn = get_db()
-        c = conn.cursor()
-        c.execute('UPDATE user SET last_seen = ? WHERE id = ?',
-                 (datetime.now().isoformat(sep=' ', timespec='seconds'), user_id))
-        conn.commit()
+        join_room(user_room(user_id))
+        join_group_rooms(user_id, group_membership.groups_of(get_db(), user_id))
+        router.register(user_id, request.sid)
+        presence.connect(user_id)
+        ensure_presence_worker()
+
+        device_id = auth.get('device_id') if isinstance(auth, dict) else None
+        if isinstance(device_id, str) and 0 < len(device_id) <= DEVICE_ID_MAX_LENGTH:
+            session['device_id'] = device_id
+            cursor = load_device_cursor(get_db(), user_id, device_id)
+            if cursor:
+                emit('replay', build_replay(get_db(), user_id, *cursor))
+
+@socketio.on('delivered')
+def handle_delivered(data=None):
+    # Clients ack in batches; cursors only ever move forward
+    if 'user_id' not in session or 'device_id' not in session or socket_throttled('delivered'):
+        return
+    try:
+        message_id = int(data.get('message_id') or 0)
+        group_message_id = int(data.get('group_message_id') or 0)
+    except (AttributeError, TypeError, ValueError):
+        return
+    if not (0 <= message_id <= sys.maxsize and 0 <= group_message_id <= sys.maxsize):
+        return  # would not fit an SQLite integer
+    conn = get_db()
+    conn.execute('''UPDATE device_cursor
+                    SET message_id = MAX(message_id, ?), group_message_id = MAX(group_message_id, ?),
+                        updated_at = CURRENT_TIMESTAMP
+                    WHERE user_id = ? AND device_id = ?''',
+                 (message_id, group_message_id, session['user_id'], session['device_id']))
+    conn.commit()
 
 @socketio.on('disconnect')
 def on_disconnect():
     if 'user_id' in session:
         user_id = session['user_id']
-        # Update last seen time when user disconnects
-        conn = get_db()
-        c = conn.cursor()
-        c.execute('UPDATE user SET last_seen = ? WHERE id = ?',
-                 (datetime.now().isoformat(sep=' ', timespec='seconds'), user_id))
-        conn.commit()
-
-        if user_id in user_sid_map:
-            del user_sid_map[user_id]
+        router.unregister(user_id, request.sid)
+        presence.disconnect(user_id)
 
 @socketio.on('private_message')
 def handle_private_message(data):
-    if 'user_id' not in session:
+    if 'user_id' not in session or socket_throttled('private_message'):
         return
     sender_id = session['user_id']
-    receiver_id = data['to']
+    try:
+        receiver_id = int(data['to'])
+    except (KeyError, TypeError, ValueError):
+        return
     message = data.get('message', '')
     file_id = data.get('file_id')
     filetype = data.get('filetype')
     filename = data.get('filename')
+    if file_id:
+        if not isinstance(filetype, str) or not isinstance(filename, str):
+            return
+    elif not isinstance(message, str) or not message:
+        return
 
-    # Get current timestamp and format it
-    now = datetime.now()
-    timestamp = now.isoformat(sep=' ', timespec='seconds')
-    formatted_time = now.strftime('%I:%M %p')
-    print(timestamp)
-    print(formatted_time)
+    # Epoch milliseconds; clients format it in their own timezone
+    timestamp = now_ms()
+    app.logger.debug('private_message %s -> %s at %s', sender_id, receiver_id, timestamp)
 
     # Save to DB
-    conn = get_db()
-    c = conn.cursor()
-    c.execute('SELECT username FROM user WHERE id=?', (sender_id,))
-    sender_name = c.fetchone()['username']
-    c.execute('SELECT username FROM user WHERE id=?', (receiver_id,))
-    receiver_name = c.fetchone()['username']
+    names = usernames(get_db(), [sender_id, receiver_id])
+    if receiver_id not in names:
+        return
+    sender_name = names[sender_id]
 
     if file_id:
         # Save as message with file id
-        c.execute('INSERT INTO message (sender_id, receiver_id, message, timestamp) VALUES (?, ?, ?, ?)',
-                  (sender_id, receiver_id, f'[fileid]{file_id}|{filetype}|{filename}', formatted_time))
-        conn.commit()
+        message_id = save_private_message(sender_id, receiver_id,
+                                          f'[fileid]{file_id}|{filetype}|{filename}', timestamp)
     else:
-        c.execute('INSERT INTO message (sender_id, receiver_id, message, timestamp) VALUES (?, ?, ?, ?)',
-                  (sender_id, receiver_id, message, formatted_time))
-        conn.commit()
+        message_id = save_private_message(sender_id, receiver_id, message, timestamp)
 
-    # Emit to sender
-    emit('private_message', {
+    payload = wire_message({
+        'id': message_id,
         'from_id': sender_id,
         'to_id': receiver_id,
         'sender': sender_name,
@@ -402,21 +3430,10 @@ def handle_private_message(data):
         'file_id': file_id,
         'filetype': filetype,
         'filename': filename,
-        'timestamp': formatted_time
-    }, room=request.sid)
-
-    # Emit to receiver if online
-    if receiver_id in user_sid_map:
-        emit('private_message', {
-            'from_id': sender_id,
-            'to_id': receiver_id,
-            'sender': sender_name,
-            'message': message,
-            'file_id': file_id,
-            'filetype': filetype,
-            'filename': filename,
-            'timestamp': formatted_time
-        }, room=user_sid_map[receiver_id])
+        'timestamp': timestamp
+    })
+    # Every device of the sender, and of the receiver if online (on any worker)
+    router.send_many('private_message', {sender_id: payload, receiver_id: payload}, batch=True)
 
 
 @app.route('/api/last_seen')
@@ -427,41 +3444,39 @@ def last_seen():
     if not friend_id:
         return jsonify({'status': 'unknown'})
 
-    conn = get_db()
-    c = conn.cursor()
-    c.execute('SELECT last_seen FROM user WHERE id = ?', (friend_id,))
-    row = c.fetchone()
+    try:
+        friend_id = int(friend_id)
+    except ValueError:
+        return jsonify({'status': 'unknown'})
 
-    if not row:
-        return jsonify({'status': 'offline', 'last_seen': 'Unknown'})
+    last_seen_str = presence.last_seen(friend_id)
+    if not last_seen_str:
+        record = user_cache.get(get_db(), friend_id)
+        if not record:
+            return jsonify({'status': 'offline', 'last_seen': 'Unknown'})
+        last_seen_str = record['last_seen']
 
-    last_seen_time = datetime.strptime(row['last_seen'], '%Y-%m-%d %H:%M:%S')
-    now = datetime.now()
-    diff = now - last_seen_time
+    return jsonify(presence_entry(friend_id, last_seen_str, friend_id in presence.online([friend_id])))
 
-    # Format the last seen time in a human-readable way
-    if diff.days > 0:
-        if diff.days == 1:
-            last_seen_formatted = "yesterday"
-        else:
-            last_seen_formatted = f"{diff.days} days ago"
-    elif diff.seconds >= 3600:
-        hours = diff.seconds // 3600
-        last_seen_formatted = f"{hours}h ago"
-    elif diff.seconds >= 60:
-        minutes = diff.seconds // 60
-        last_seen_formatted = f"{minutes}m ago"
-    else:
-        last_seen_formatted = "just now"
-
-    status = 'online' if friend_id in user_sid_map else 'offline'
-
-    return jsonify({
-        'status': status,
-        'last_seen': last_seen_formatted,
-        'timestamp': last_seen_time.strftime('%Y-%m-%d %H:%M:%S')
-    })
-# More endpoints for friends, chat, etc. will be added next.
+@app.route('/api/presence')
+def presence_batch():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    try:
+        ids = [int(i) for i in request.args.get('ids', '').split(',') if i.strip()]
+    except ValueError:
+        return jsonify({'error': 'Invalid ids'}), 400
+    ids = list(dict.fromkeys(ids))[:PRESENCE_BATCH_LIMIT]
+
+    known = {user_id: presence.last_seen(user_id) for user_id in ids}
+    missing = [user_id for user_id, value in known.items() if value is None]
+    for user_id, record in user_cache.get_many(get_db(), missing).items():
+        if record:
+            known[user_id] = record['last_seen']
+
+    online = presence.online(ids)
+    return jsonify({'presence': {str(user_id): presence_entry(user_id, last_seen_str, user_id in online)
+                                 for user_id, last_seen_str in known.items()}})
 
 @app.route('/settings', methods=['GET', 'POST'])
 def settings():
@@ -473,15 +3488,22 @@ def settings():
         if 'profile_picture' in request.files:
             file = request.files['profile_picture']
             if file and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(filepath)
-
-                # Update the user's profile picture in the database
+                # Already spooled and hashed by the parser; identical pictures share one entry.
+                # Check it decodes first so a rejected upload never reaches the store.
+                spool = file.stream
+                spool.flush()
+                try:
+                    if Image is not None:
+                        run_cpu(image_pool, check_image, spool.path)
+                except Exception:
+                    return render_template('settings.html', username=session['username'],
+                                           error='Could not read that image')
+                sha256, _ = spool.commit()
                 conn = get_db()
-                c = conn.cursor()
-                c.execute('UPDATE user SET profile_picture = ? WHERE id = ?', (filename, session['user_id']))
+                store_avatar(conn, sha256)
+                conn.execute('UPDATE user SET avatar = ? WHERE id = ?', (sha256, session['user_id']))
                 conn.commit()
+                user_cache.invalidate(session['user_id'])
 
                 return redirect(url_for('settings'))
 
@@ -497,6 +3519,10 @@ def mark_messages_read():
 
     if not sender_id:
         return jsonify({'error': 'Missing sender_id'}), 400
+    try:
+        sender_id = int(sender_id)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid sender_id'}), 400
 
     conn = get_db()
     c = conn.cursor()
@@ -511,14 +3537,16 @@ def mark_messages_read():
 
     # Get the number of affected rows
     updated_rows = c.rowcount
+    c.execute('UPDATE conversation SET unread = 0 WHERE user_id = ? AND peer_id = ? AND unread != 0',
+              (session['user_id'], sender_id))
     conn.commit()
 
     # Notify sender about read messages if any messages were updated
-    if updated_rows > 0 and sender_id in user_sid_map:
-        socketio.emit('messages_read', {
+    if updated_rows > 0:
+        router.send('messages_read', {
             'reader_id': session['user_id'],
             'timestamp': now
-        }, room=user_sid_map[sender_id])
+        }, sender_id)
 
     return jsonify({'success': True, 'count': updated_rows})
 
@@ -526,9 +3554,20 @@ def mark_messages_read():
 
 @socketio.on('group_create')
 def handle_group_create(data):
-    name      = data['name']
-    members   = data['member_ids']           # list[int]
+    if 'user_id' not in session or socket_throttled('group_create'):
+        return
+    name      = data.get('name')
+    members   = data.get('member_ids') or []  # list[int]
     owner_id  = session['user_id']
+    if not isinstance(name, str) or not name or not isinstance(members, list):
+        return
+    if len(members) > GROUP_MAX_MEMBERS:
+        reject_event('group_create', 'member_limit', limit=GROUP_MAX_MEMBERS)
+        return
+    try:
+        members = list(dict.fromkeys(int(uid) for uid in members if uid != owner_id))
+    except (TypeError, ValueError):
+        return
 
     conn = get_db()
     cur  = conn.cursor()
@@ -541,23 +3580,28 @@ def handle_group_create(data):
                 'VALUES (?,?,?,CURRENT_TIMESTAMP)',
                 (group_id, owner_id, 'accepted'))
 
-    # invite friends
-    for uid in members:
+    # invite friends (only accepted ones)
+    for uid in [uid for uid in members if friend_graph.are_friends(conn, owner_id, uid)]:
         cur.execute('INSERT INTO group_member (group_id,user_id,invited_by) '
                     'VALUES (?,?,?)', (group_id, uid, owner_id))
-        if uid in user_sid_map:                      # friend is on-line
-            socketio.emit('group_invite',
-                          {'group_id': group_id, 'group_name': name,
-                           'inviter': session["username"]},
-                          room=user_sid_map[uid])
+        router.send('group_invite',                  # if the friend is on-line
+                    {'group_id': group_id, 'group_name': name,
+                     'inviter': session["username"]},
+                    uid)
 
     conn.commit()
-    join_room(f'group_{group_id}')
+    group_membership.joined(owner_id, group_id)
+    join_group_rooms(owner_id, [group_id])
     emit('group_created', {'group_id': group_id})
 
 @socketio.on('group_accept')
 def handle_group_accept(data):
-    gid  = data['group_id']
+    if 'user_id' not in session or socket_throttled('group_accept'):
+        return
+    try:
+        gid = int(data['group_id'])
+    except (KeyError, TypeError, ValueError):
+        return
     uid  = session['user_id']
     conn = get_db(); cur = conn.cursor()
 
@@ -566,29 +3610,122 @@ def handle_group_accept(data):
                 'WHERE group_id=? AND user_id=? AND status="pending"',
                 (gid, uid))
     if cur.rowcount:
-        join_room(f'group_{gid}')
+        conn.commit()
+        group_membership.joined(uid, gid)
+        join_group_rooms(uid, [gid])
         socketio.emit('member_joined',
                       {'user': session['username'], 'uid': uid},
-                      room=f'group_{gid}')
-        conn.commit()
+                      room=group_room(gid))
 
 @socketio.on('group_message')
 def handle_group_message(data):
-    gid     = data['group_id']
-    msg     = data['message']
+    if 'user_id' not in session or socket_throttled('group_message'):
+        return
+    try:
+        gid = int(data['group_id'])
+    except (KeyError, TypeError, ValueError):
+        return
+    msg     = data.get('message')
     sender  = session['user_id']
-    conn    = get_db(); cur=conn.cursor()
+    if not isinstance(msg, str) or not msg:
+        return
+    if not group_membership.is_member(get_db(), sender, gid):
+        return
 
-    cur.execute('INSERT INTO group_message(group_id,sender_id,message) '
-                'VALUES (?,?,?)', (gid, sender, msg))
-    conn.commit()
+    timestamp = now_ms()
+    message_id = save_group_message(gid, sender, msg, timestamp)
+
+    outbound.emit('group_message',
+                  wire_message({'id': message_id,
+                                'group_id': gid,
+                                'sender': session["username"],
+                                'sender_id': sender,
+                                'message': msg,
+                                'timestamp': timestamp}),
+                  room=group_room(gid))
 
-    emit('group_message',
-         {'group_id': gid,
-          'sender': session["username"],
-          'message': msg,
-          'timestamp': datetime.now().strftime('%I:%M %p')},
-         room=f'group_{gid}')
+@app.route('/api/db_stats')
+def db_stats():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    stats = db_pool.stats()
+    stats['user_cache'] = user_cache.stats()
+    stats['rate_limiter'] = rate_limiter.stats()
+    stats['auth'] = {'workers': PASSWORD_WORKERS,
+                     'in_flight': _password_in_flight,
+                     'throttle': login_throttle.stats()}
+    if write_behind:
+        stats['write_behind'] = write_behind.stats()
+    return jsonify(stats)
+
+def run_server():
+    # Production (CHATAPP_ASYNC_MODE=eventlet|gevent):
+    #   python app.py, or gunicorn -k eventlet -w 1 --worker-connections 60000 app:app
+    # Several workers/boxes additionally need CHATAPP_MESSAGE_QUEUE.
+    ensure_db()
+    if ASYNC_MODE == 'threading':
+        # Under the debug reloader the serving child starts write-behind on first use
+        socketio.run(app, host=SERVER_HOST, port=SERVER_PORT, debug=True)
+        return
+    if write_behind:
+        write_behind.start()
+    try:
+        import resource
+        # One descriptor per socket; lift the soft limit as far as the hard one allows
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+    if ASYNC_MODE == 'eventlet':
+        # socketio.run() can't set the listen backlog, so start eventlet's server directly
+        import eventlet.wsgi
+        listener = eventlet.listen((SERVER_HOST, SERVER_PORT), backlog=SERVER_BACKLOG)
+        eventlet.wsgi.server(listener, app, max_size=SERVER_MAX_CONNECTIONS, log_output=False)
+    else:
+        socketio.run(app, host=SERVER_HOST, port=SERVER_PORT, log_output=False, backlog=SERVER_BACKLOG)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    if METRICS_TOKEN and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {METRICS_TOKEN}'):
+        return 'Unauthorized', 401
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n', 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+def outbound_queue_depth():
+    # Packets waiting in this worker's Engine.IO per-socket send queues
+    return sum(s.queue.qsize() for s in list(socketio.server.eio.sockets.values()))
+
+register_metric(Gauge('chatapp_sockets_connected', 'Engine.IO connections on this worker.',
+                      lambda: len(socketio.server.eio.sockets)))
+register_metric(Gauge('chatapp_user_sid_map_users', 'Users with a socket connected to this process.',
+                      lambda: len(user_sid_map)))
+register_metric(Gauge('chatapp_users_online', 'Users with at least one routed socket.',
+                      lambda: router.online_count()))
+register_metric(Gauge('chatapp_socket_outbound_queue', 'Packets queued for sending on this worker.',
+                      outbound_queue_depth))
+register_metric(Gauge('chatapp_socket_batch_pending', 'Message events waiting for the batch window.',
+                      outbound.pending))
+register_metric(Gauge('chatapp_socket_frames_total', 'Message frames sent (a batch counts once).',
+                      lambda: outbound.frames, kind='counter'))
+register_metric(Gauge('chatapp_socket_frame_events_total', 'Message events carried in those frames.',
+                      lambda: outbound.events, kind='counter'))
+register_metric(Gauge('chatapp_db_pool_connections', 'Pooled SQLite connections by state.',
+                      lambda: {('idle',): db_pool.stats()['idle'], ('checked_out',): db_pool.stats()['checked_out']},
+                      ('state',)))
+register_metric(Gauge('chatapp_db_pool_waits_total', 'Checkouts that had to wait for a connection.',
+                      lambda: db_pool.stats()['waits'], kind='counter'))
+register_metric(Gauge('chatapp_db_pool_timeouts_total', 'Checkouts that timed out.',
+                      lambda: db_pool.stats()['timeouts'], kind='counter'))
+register_metric(Gauge('chatapp_write_behind_pending', 'Messages acknowledged but not yet committed.',
+                      lambda: write_behind.stats()['pending'] if write_behind else 0))
+register_metric(Gauge('chatapp_password_hashes_in_flight', 'Password hashes queued or running.',
+                      lambda: _password_in_flight))
+register_metric(Gauge('chatapp_user_cache_requests_total', 'User cache lookups by result.',
+                      lambda: {('hit',): user_cache.hits, ('miss',): user_cache.misses}, ('result',), kind='counter'))
+
+instrument_socket_handlers()
 
 if __name__ == '__main__':
-    socketio.run(app, debug=True)
+    run_server()
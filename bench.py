@@ -0,0 +1,520 @@
+"""Load and latency benchmark for the chat server.
+
+Drives N simulated users through signup/login, friend setup, private and
+group messages, mark_read and chat_history paging against a throwaway
+database, and reports throughput plus p50/p95/p99 latency per operation.
+
+    python bench.py --users 50 --messages 20
+    python bench.py --transport socket --users 200       # real server + socket clients
+    python bench.py --transport socket --users 100 --messages 10 --output bench_baseline.json
+    python bench.py --transport socket --users 100 --messages 10 --baseline bench_baseline.json
+
+The last two record a baseline and exit 1 on a regression against it; the
+comparison needs the same transport and sizes as the baseline, and at least
+REGRESSION_MIN_SAMPLES of an operation before it counts.
+
+The default transport runs the app in-process through Flask's and
+Flask-SocketIO's test clients, which also lets it time every SQLite call
+(reported as db_ms). The socket transport starts the server in a
+subprocess (honouring CHATAPP_ASYNC_MODE) and connects python-socketio
+clients over WebSocket, so delivery latency there is measured end to end;
+its db_ms comes from the server's /metrics SQL time. Message sends are
+timed until the sender's own copy comes back, which also paces them.
+"""
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+PASSWORD = 'bench-password'
+REGRESSION_TOLERANCE = 0.5   # relative slack before a p95 / throughput change counts as a regression
+REGRESSION_FLOOR_MS = 1.0    # p95 changes smaller than this are noise on sub-millisecond operations
+REGRESSION_MIN_SAMPLES = 100 # operations with fewer samples are reported but not compared
+
+
+# --- MEASUREMENT ---
+def percentile(samples, p):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, len(samples) * p // 100)]
+
+class Recorder:
+    """Latency samples (seconds) and wall time per operation.
+
+    SQLite time is charged per call by the test-client driver; a driver that
+    can only read the server's running total sets ``db_clock`` instead, and
+    each phase is charged the difference.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}
+        self.db_time = {}
+        self.wall = {}
+        self.db_clock = None
+
+    def add(self, op, seconds, db_seconds=None):
+        with self._lock:
+            self.samples.setdefault(op, []).append(seconds)
+            if db_seconds is not None:
+                self.db_time[op] = self.db_time.get(op, 0.0) + db_seconds
+
+    @contextmanager
+    def phase(self, op):
+        db_started = self.db_clock() if self.db_clock else None
+        started = time.perf_counter()
+        yield
+        self.wall[op] = self.wall.get(op, 0.0) + time.perf_counter() - started
+        if db_started is not None:
+            with self._lock:
+                self.db_time[op] = self.db_time.get(op, 0.0) + self.db_clock() - db_started
+
+    def report(self):
+        result = {}
+        for op, samples in self.samples.items():
+            entry = {
+                'count': len(samples),
+                'throughput': round(len(samples) / self.wall[op], 1) if self.wall.get(op) else None,
+                'p50_ms': round(percentile(samples, 50) * 1000, 3),
+                'p95_ms': round(percentile(samples, 95) * 1000, 3),
+                'p99_ms': round(percentile(samples, 99) * 1000, 3),
+            }
+            if op in self.db_time:
+                entry['db_ms'] = round(self.db_time[op] / len(samples) * 1000, 3)
+            result[op] = entry
+        return result
+
+# Per-thread SQLite time, so each operation can be charged the DB work it caused
+_db_clock = threading.local()
+
+def db_seconds():
+    return getattr(_db_clock, 'seconds', 0.0)
+
+def install_db_timer(app_module):
+    # Every pooled statement is already timed into the app's SQL histogram;
+    # tee those observations into the per-thread clock
+    observe = app_module.sql_latency.observe
+
+    def timed_observe(seconds, *labels):
+        _db_clock.seconds = db_seconds() + seconds
+        observe(seconds, *labels)
+    app_module.sql_latency.observe = timed_observe
+
+
+# --- SCENARIO ---
+# Transport-independent: a driver exposes signup/friend/emit/get/post and a
+# way to wait for received events; the scenario only talks to that.
+def run_scenario(driver, recorder, users, messages, group_size, page_size):
+    names = [f'bench{i}' for i in range(users)]
+
+    with recorder.phase('signup'):
+        for name in names:
+            driver.timed('signup', driver.signup, name)
+    with recorder.phase('login'):
+        for name in names:
+            driver.timed('login', driver.login, name)
+    ids = driver.user_ids
+
+    # Ring of friendships: everyone is friends with the next user
+    with recorder.phase('friend_request'):
+        for i, name in enumerate(names):
+            other = names[(i + 1) % users]
+            driver.timed('friend_request', driver.post, name, '/api/send_friend_request', {'friend_id': ids[other]})
+    with recorder.phase('friend_accept'):
+        for i, name in enumerate(names):
+            other = names[(i - 1) % users]
+            driver.timed('friend_accept', driver.post, name, '/api/accept_friend_request', {'friend_id': ids[other]})
+
+    driver.connect_all()
+
+    # Each round everyone messages the next user, then sends a read receipt
+    # for what arrived from the previous one, as the client does
+    for round_ in range(messages):
+        with recorder.phase('private_message'):
+            for i, name in enumerate(names):
+                other = names[(i + 1) % users]
+                driver.timed('private_message', driver.send, name, 'private_message',
+                             {'to': ids[other], 'message': driver.stamp()})
+        driver.wait_for('private_message', users * (round_ + 1))
+        with recorder.phase('mark_read'):
+            for i, name in enumerate(names):
+                other = names[(i - 1) % users]
+                driver.timed('mark_read', driver.post, name, '/api/mark_read', {'sender_id': ids[other]})
+
+    # Groups of up to group_size consecutive users; the first one owns it
+    groups = [names[i:i + group_size] for i in range(0, users, group_size)]
+    group_ids = []
+    for members in groups:
+        owner = members[0]
+        # Only friends can be invited, so the owner befriends the rest first
+        for member in members[2:]:
+            driver.post(owner, '/api/send_friend_request', {'friend_id': ids[member]})
+            driver.post(member, '/api/accept_friend_request', {'friend_id': ids[owner]})
+        group_id = driver.create_group(owner, [ids[m] for m in members[1:]])
+        for member in members[1:]:
+            driver.emit(member, 'group_accept', {'group_id': group_id})
+        group_ids.append(group_id)
+    driver.settle()
+    driver.clear_latency('group_message')
+
+    expected = 0
+    with recorder.phase('group_message'):
+        for round_ in range(messages):
+            for members, group_id in zip(groups, group_ids):
+                for member in members:
+                    driver.timed('group_message', driver.send, member, 'group_message',
+                                 {'group_id': group_id, 'message': driver.stamp()})
+                    expected += len(members)
+    driver.wait_for('group_message', expected)
+
+    # Page each conversation backwards from the newest message
+    with recorder.phase('chat_history_page'):
+        for i, name in enumerate(names):
+            other = names[(i + 1) % users]
+            before = None
+            while True:
+                query = f'/api/chat_history?friend_id={ids[other]}&limit={page_size}'
+                if before:
+                    query += f'&before_id={before}'
+                page = driver.timed('chat_history_page', driver.get, name, query)
+                if not page['messages'] or not page['has_more']:
+                    break
+                before = page['messages'][0]['id']
+
+    driver.close()
+
+
+# --- TEST CLIENT TRANSPORT ---
+class TestClientDriver:
+    """Runs the app in this process through Flask / Flask-SocketIO test clients."""
+
+    def __init__(self, app_module, recorder):
+        self.app = app_module
+        self.recorder = recorder
+        self.http = {}
+        self.sockets = {}
+        self.user_ids = {}
+        self.received = {}
+
+    def timed(self, op, fn, *args):
+        started, db_started = time.perf_counter(), db_seconds()
+        result = fn(*args)
+        self.recorder.add(op, time.perf_counter() - started, db_seconds() - db_started)
+        return result
+
+    def stamp(self):
+        return f'bench {time.perf_counter()}'
+
+    def signup(self, name):
+        client = self.app.app.test_client()
+        client.post('/signup', data={'username': name, 'password': PASSWORD})
+        self.http[name] = client
+
+    def login(self, name):
+        self.http[name].post('/login', data={'username': name, 'password': PASSWORD})
+        with self.http[name].session_transaction() as session:
+            self.user_ids[name] = session['user_id']
+
+    def post(self, name, path, payload):
+        return self.http[name].post(path, json=payload).get_json()
+
+    def get(self, name, path):
+        return self.http[name].get(path).get_json()
+
+    def connect_all(self):
+        for name, client in self.http.items():
+            self.sockets[name] = self.app.socketio.test_client(self.app.app, flask_test_client=client)
+        self.settle()
+
+    def emit(self, name, event, payload):
+        self.sockets[name].emit(event, payload)
+
+    def create_group(self, owner, member_ids):
+        self.emit(owner, 'group_create', {'name': f'{owner} group', 'member_ids': member_ids})
+        for event in self.sockets[owner].get_received():
+            if event['name'] == 'group_created':
+                return event['args'][0]['group_id']
+        raise RuntimeError('group_create did not answer')
+
+    def send(self, name, event, payload):
+        # Test-client emits run the handler synchronously, fan-out included
+        self.emit(name, event, payload)
+
+    def is_echo(self, name, event, data):
+        # The sender's own copy of a benchmark message
+        if event == 'private_message':
+            return data.get('from_id') == self.user_ids[name] and data.get('to_id') != self.user_ids[name]
+        return data.get('sender') == name
+
+    def arrived(self, name, event, data):
+        # Counts one delivered benchmark message; returns its send stamp
+        message = data.get('message') if isinstance(data, dict) else None
+        if not isinstance(message, str) or not message.startswith('bench '):
+            return None
+        if event == 'private_message' and data.get('to_id') != self.user_ids[name]:
+            return None  # the sender's own copy
+        self.received[event] = self.received.get(event, 0) + 1
+        return float(message.split()[1])
+
+    def _drain(self):
+        # Test-client emits are delivered synchronously, inside the timed
+        # emit, so there is no separate delivery latency to record here
+        for name, client in self.sockets.items():
+            for event in client.get_received():
+                if event['args']:
+                    self.arrived(name, event['name'], event['args'][0])
+
+    def settle(self):
+        self._drain()
+
+    def clear_latency(self, event):
+        self.received.pop(event, None)
+
+    def wait_for(self, event, count):
+        self._drain()
+        if self.received.get(event, 0) < count:
+            raise RuntimeError(f'{event}: delivered {self.received.get(event, 0)} of {count}')
+
+    def close(self):
+        for client in self.sockets.values():
+            client.disconnect()
+
+
+# --- SOCKET TRANSPORT ---
+class SocketDriver(TestClientDriver):
+    """Real server in a subprocess, HTTP via requests, python-socketio clients."""
+
+    def __init__(self, recorder, env, port):
+        super().__init__(None, recorder)
+        import requests
+        import socketio as socketio_client
+        self.base = f'http://127.0.0.1:{port}'
+        self.database = env['CHATAPP_DB']
+        self._requests = requests
+        self._client_factory = socketio_client.Client
+        launcher = ('import app\n'
+                    'if app.ASYNC_MODE == "threading":\n'
+                    '    app.socketio.run(app.app, host="127.0.0.1", port=app.SERVER_PORT,'
+                    ' allow_unsafe_werkzeug=True, log_output=False)\n'
+                    'else:\n'
+                    '    app.run_server()\n')
+        self.log = open(os.path.join(os.path.dirname(self.database), 'server.log'), 'wb')
+        self.server = subprocess.Popen([sys.executable, '-c', launcher], cwd=ROOT,
+                                       env=dict(env, CHATAPP_PORT=str(port)),
+                                       stdout=self.log, stderr=subprocess.STDOUT)
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline or self.server.poll() is not None:
+                    self.server.kill()
+                    raise RuntimeError('Server did not start')
+                time.sleep(0.1)
+        self._lock = threading.Lock()
+        self._arrived = threading.Condition(self._lock)
+        self._group_created = {}
+        self._echoes = set()  # stamps whose sender got its own copy back
+        recorder.db_clock = self.server_db_seconds
+
+    def timed(self, op, fn, *args):
+        started = time.perf_counter()
+        result = fn(*args)
+        self.recorder.add(op, time.perf_counter() - started)
+        return result
+
+    def signup(self, name):
+        session = self._requests.Session()
+        session.post(f'{self.base}/signup', data={'username': name, 'password': PASSWORD}, allow_redirects=False)
+        self.http[name] = session
+
+    def login(self, name):
+        response = self.http[name].post(f'{self.base}/login', data={'username': name, 'password': PASSWORD},
+                                         allow_redirects=False)
+        if response.status_code != 302:
+            raise RuntimeError(f'login failed for {name}: {response.status_code}')
+
+        # The API never tells a user their own id; read it from the bench database
+        with sqlite3.connect(self.database) as conn:
+            self.user_ids[name] = conn.execute('SELECT id FROM user WHERE username = ?', (name,)).fetchone()[0]
+
+    def post(self, name, path, payload):
+        return self.http[name].post(f'{self.base}{path}', json=payload).json()
+
+    def get(self, name, path):
+        return self.http[name].get(f'{self.base}{path}').json()
+
+    def _on_event(self, name, event):
+        def handler(data):
+            now = time.perf_counter()
+            with self._lock:
+                if event == 'group_created':
+                    self._group_created[name] = data['group_id']
+                else:
+                    sent = self.arrived(name, event, data)
+                    if sent is not None:
+                        self.recorder.add(f'{event}_delivery', now - sent)
+                    if self.is_echo(name, event, data):
+                        self._echoes.add(data['message'])
+                self._arrived.notify_all()
+        return handler
+
+    def connect_all(self):
+        for name, session in self.http.items():
+            client = self._client_factory()
+            for event in ('private_message', 'group_message', 'group_created'):
+                client.on(event, self._on_event(name, event))
+            cookie = '; '.join(f'{k}={v}' for k, v in session.cookies.items())
+            client.connect(self.base, headers={'Cookie': cookie}, transports=['websocket'])
+            self.sockets[name] = client
+
+    def emit(self, name, event, payload):
+        self.sockets[name].emit(event, payload)
+
+    def send(self, name, event, payload):
+        # A message send is done when the sender's own copy comes back: that
+        # covers the server's handler and its fan-out, not just queueing the
+        # frame, and paces the sends instead of flooding the server
+        stamp = payload['message']
+        self.sockets[name].emit(event, payload)
+        with self._arrived:
+            if not self._arrived.wait_for(lambda: stamp in self._echoes, timeout=30):
+                raise RuntimeError(f'{event}: no echo for {name}')
+            self._echoes.discard(stamp)
+
+    def server_db_seconds(self):
+        # Total SQLite time the server has recorded (its chatapp_sql_seconds histogram)
+        text = self._requests.get(f'{self.base}/metrics').text
+        return sum(float(line.rsplit(None, 1)[1]) for line in text.splitlines()
+                   if line.startswith('chatapp_sql_seconds_sum'))
+
+    def create_group(self, owner, member_ids):
+        self.emit(owner, 'group_create', {'name': f'{owner} group', 'member_ids': member_ids})
+        with self._arrived:
+            if not self._arrived.wait_for(lambda: owner in self._group_created, timeout=10):
+                raise RuntimeError('group_create did not answer')
+            return self._group_created.pop(owner)
+
+    def settle(self):
+        time.sleep(0.5)
+
+    def clear_latency(self, event):
+        with self._lock:
+            self.received.pop(event, None)
+            self.recorder.samples.pop(f'{event}_delivery', None)
+
+    def wait_for(self, event, count, timeout=60):
+        with self._arrived:
+            if not self._arrived.wait_for(lambda: self.received.get(event, 0) >= count, timeout=timeout):
+                raise RuntimeError(f'{event}: delivered {self.received.get(event, 0)} of {count}')
+
+    def close(self):
+        # Each disconnect blocks for a few seconds on the websocket close; do them all at once
+        threads = [threading.Thread(target=client.disconnect) for client in self.sockets.values()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.server.terminate()
+        self.server.wait(10)
+        self.log.close()
+
+
+# --- ENTRY POINT ---
+def compare(result, baseline, tolerance=REGRESSION_TOLERANCE):
+    # Latencies from another transport or load are not comparable at all
+    mismatched = [f'{key}: {result.get(key)} vs baseline {baseline.get(key)}'
+                  for key in ('transport', 'users', 'messages', 'group_size') if result.get(key) != baseline.get(key)]
+    if mismatched:
+        return mismatched
+    regressions = []
+    for op, base in baseline.get('operations', {}).items():
+        current = result['operations'].get(op)
+        if not current or min(current['count'], base.get('count', 0)) < REGRESSION_MIN_SAMPLES:
+            continue
+        if base.get('p95_ms') and current['p95_ms'] > base['p95_ms'] * (1 + tolerance) and \
+                current['p95_ms'] - base['p95_ms'] > REGRESSION_FLOOR_MS:
+            regressions.append(f"{op}: p95 {current['p95_ms']}ms vs baseline {base['p95_ms']}ms")
+        if base.get('throughput') and current.get('throughput') and \
+                current['throughput'] < base['throughput'] * (1 - tolerance):
+            regressions.append(f"{op}: {current['throughput']}/s vs baseline {base['throughput']}/s")
+    return regressions
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--messages', type=int, default=20, help='messages per user, per phase')
+    parser.add_argument('--group-size', type=int, default=10)
+    parser.add_argument('--page-size', type=int, default=5, help='chat_history limit while paging')
+    parser.add_argument('--transport', choices=('testclient', 'socket'), default='testclient')
+    parser.add_argument('--output', help='write the JSON report here')
+    parser.add_argument('--baseline', help='compare against this JSON report; exit 1 on regression')
+    parser.add_argument('--tolerance', type=float, default=REGRESSION_TOLERANCE,
+                        help='relative p95 / throughput change allowed against the baseline')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='chatapp-bench-')
+    env = dict(os.environ,
+               CHATAPP_DB=os.path.join(workdir, 'bench.db'),
+               CHATAPP_ATTACHMENTS=os.path.join(workdir, 'attachments'),
+               CHATAPP_LOGIN_MAX_PER_IP=str(sys.maxsize),
+               # Every simulated user sends as fast as it can; measure the server, not the limits
+               CHATAPP_RATE_LIMITS='private_message=0,group_message=0,group_create=0,group_accept=0,delivered=0')
+    recorder = Recorder()
+
+    if args.transport == 'testclient':
+        os.environ.update(env)
+        os.chdir(ROOT)
+        sys.path.insert(0, ROOT)
+        import app as app_module
+        install_db_timer(app_module)
+        driver = TestClientDriver(app_module, recorder)
+    else:
+        driver = SocketDriver(recorder, env, free_port())
+
+    started = time.perf_counter()
+    run_scenario(driver, recorder, args.users, args.messages, args.group_size, args.page_size)
+    result = {
+        'transport': args.transport,
+        'async_mode': os.environ.get('CHATAPP_ASYNC_MODE', 'threading'),
+        'users': args.users,
+        'messages': args.messages,
+        'group_size': args.group_size,
+        'elapsed_s': round(time.perf_counter() - started, 3),
+        'operations': recorder.report(),
+    }
+
+    print(f"{'operation':<26}{'count':>8}{'ops/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'db ms':>9}")
+    for op, entry in result['operations'].items():
+        print(f"{op:<26}{entry['count']:>8}{entry['throughput'] or '':>10}{entry['p50_ms']:>10}"
+              f"{entry['p95_ms']:>10}{entry['p99_ms']:>10}{entry.get('db_ms', ''):>9}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+            f.write('\n')
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f'REGRESSION {line}')
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
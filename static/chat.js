@@ -1,11 +1,25 @@
 class ChatApp {
   constructor() {
     this.myUsername = document.querySelector('.user-label')?.textContent?.replace('👤', '').trim();
-    this.socket = io();
+    this.deviceId = this.getDeviceId();
+    // The device id lets the server replay whatever this device missed on reconnect
+    this.socket = io({ auth: { device_id: this.deviceId } });
+    // Compact mode: the server sends message events with short keys (see WIRE_FIELDS)
+    const fields = window.CHATAPP_WIRE?.fields;
+    this.wireKeys = fields ? Object.fromEntries(Object.entries(fields).map(([name, code]) => [code, name])) : null;
+    this.delivered = { message_id: 0, group_message_id: 0 };
+    this.deliveredTimer = null;
     this.currentFriend = null;
     this.friendStatusInterval = null;
+    this.oldestMessageId = null;   // keyset cursors for the open conversation
+    this.newestMessageId = null;
+    this.renderedIds = new Set();  // message ids shown in the open conversation
+    this.hasMoreHistory = false;
+    this.loadingHistory = false;
+    this.presence = {};         // { friendId: {status, timestamp} }, pushed over the socket
     this.groups = {};           // { groupId: {name, members, unreadCount} }
     this.currentGroup = null;   // active group object or null
+    this.inbox = {};            // { friendId: {unread, last_message} } from /api/inbox
 
 
     this.init();
@@ -86,13 +100,18 @@ class ChatApp {
     const searchInput = document.getElementById('search-user-input');
     const searchResults = document.getElementById('search-results');
 
-    this.socket.on('private_message', (data) => this.handleIncomingMessage(data));
+    this.socket.on('private_message', (data) => this.handleIncomingMessage(this.expandMessage(data)));
+    this.socket.on('messages', (batch) => this.handleBatch(batch));
+    this.socket.on('throttled', (data) => this.handleThrottled(data));
     this.socket.on('messages_read', (data) => this.handleReadReceipt(data));
+    this.socket.on('presence', (data) => this.applyPresence(data.users));
+    this.socket.on('replay', (data) => this.handleReplay(data));
+    this.socket.on('file_ready', (data) => this.handleFileReady(data));
     // === GROUP SOCKET EVENTS ===
     this.socket.on('group_invite',   d => this.receiveGroupInvite(d));
     this.socket.on('group_created',  d => this.groupCreated(d));      // feedback to creator
     this.socket.on('member_joined',  d => this.memberJoined(d));      // someone accepted
-    this.socket.on('group_message',  d => this.handleGroupMessage(d));
+    this.socket.on('group_message',  d => this.handleGroupMessage(this.expandMessage(d)));
 
     let searchTimeout = null;
 
@@ -136,6 +155,14 @@ class ChatApp {
       fileInput.addEventListener('change', (e) => this.handleFileUpload(e));
     }
 
+    // Load older messages when scrolled to the top
+    const chatMessages = document.getElementById('chat-messages');
+    if (chatMessages) {
+      chatMessages.addEventListener('scroll', () => {
+        if (chatMessages.scrollTop < 50) this.loadOlderMessages();
+      });
+    }
+
     // Message form
     const chatForm = document.getElementById('chat-form');
     if (chatForm) {
@@ -143,6 +170,58 @@ class ChatApp {
     }
 
   }
+  getDeviceId() {
+    let deviceId = localStorage.getItem('deviceId');
+    if (!deviceId) {
+      deviceId = (crypto.randomUUID?.() || `${Date.now()}-${Math.random().toString(36).slice(2)}`);
+      localStorage.setItem('deviceId', deviceId);
+    }
+    return deviceId;
+  }
+
+  markDelivered(kind, id) {
+    if (!id || id <= this.delivered[kind]) return;
+    this.delivered[kind] = id;
+    // Batch acks: at most one 'delivered' event every 2 seconds
+    if (!this.deliveredTimer) {
+      this.deliveredTimer = setTimeout(() => {
+        this.deliveredTimer = null;
+        this.socket.emit('delivered', this.delivered);
+      }, 2000);
+    }
+  }
+
+  expandMessage(data) {
+    if (!this.wireKeys) return data;
+    const message = { message: '', file_id: null, filetype: null, filename: null };
+    Object.entries(data).forEach(([key, value]) => { message[this.wireKeys[key] || key] = value; });
+    return message;
+  }
+
+  handleThrottled(data) {
+    // The server dropped one of our events: too many too fast, or a request over a size limit
+    if (data.reason === 'member_limit') {
+      alert(`A group can be created with at most ${data.limit} members.`);
+    } else {
+      console.warn(`Server throttled ${data.event}; retry in ${data.retry_after}s`);
+    }
+  }
+
+  handleBatch(batch) {
+    // Events coalesced by the server's batch window, in send order
+    batch.forEach(([event, data]) => {
+      if (event === 'private_message') this.handleIncomingMessage(this.expandMessage(data));
+      else if (event === 'group_message') this.handleGroupMessage(this.expandMessage(data));
+    });
+  }
+
+  handleReplay(data) {
+    (data.messages || []).forEach(message => this.handleIncomingMessage(this.expandMessage(message)));
+    (data.group_messages || []).forEach(message => this.handleGroupMessage(this.expandMessage(message)));
+    // Too much to replay: fall back to a since= fetch for the open conversation
+    if (data.has_more) this.syncChatHistory();
+  }
+
   async markMessagesAsRead(senderId) {
   try {
     await fetch('/api/mark_read', {
@@ -231,6 +310,7 @@ class ChatApp {
       const response = await fetch('/api/friends');
       const data = await response.json();
 
+      await Promise.all([this.loadPresence(data.friends.map(friend => friend.id)), this.loadInbox()]);
       await this.renderFriends(data.friends);
       this.renderPendingRequests(data.pending_received, data.pending_sent);
       this.setupFriendStatusUpdates();
@@ -245,23 +325,115 @@ class ChatApp {
 
     friendList.innerHTML = '';
 
+    // Most recent conversation first; friends never messaged keep server order at the end
+    const lastId = friend => this.inbox[friend.id]?.last_message?.id || 0;
+    friends = [...friends].sort((a, b) => lastId(b) - lastId(a));
+
     for (const friend of friends) {
       const li = await this.createFriendElement(friend);
       friendList.appendChild(li);
     }
   }
 
+  async loadPresence(friendIds) {
+    if (!friendIds.length) return;
+    try {
+      const response = await fetch(`/api/presence?ids=${friendIds.join(',')}`);
+      const data = await response.json();
+      Object.entries(data.presence || {}).forEach(([id, entry]) => {
+        this.presence[id] = entry;
+      });
+    } catch (error) {
+      console.error('Load presence error:', error);
+    }
+  }
+
+  async loadInbox() {
+    try {
+      const response = await fetch('/api/inbox');
+      const data = await response.json();
+      this.inbox = {};
+      (data.conversations || []).forEach(conversation => {
+        this.inbox[conversation.peer_id] = conversation;
+      });
+    } catch (error) {
+      console.error('Load inbox error:', error);
+    }
+  }
+
+  updateUnreadBadge(friendId) {
+    const li = document.querySelector(`#friend-list li[data-friend-id="${friendId}"]`);
+    if (!li) return;
+    const unread = this.inbox[friendId]?.unread || 0;
+    let badge = li.querySelector('.unread-badge');
+    if (!unread) {
+      badge?.remove();
+      return;
+    }
+    if (!badge) {
+      badge = document.createElement('span');
+      badge.className = 'unread-badge';
+      li.appendChild(badge);
+    }
+    badge.textContent = unread > 99 ? '99+' : unread;
+  }
+
+  applyPresence(users) {
+    (users || []).forEach(user => {
+      this.presence[user.id] = user;
+      this.updateFriendStatus(user.id);
+    });
+  }
+
+  formatLastSeen(timestamp) {
+    if (!timestamp) return 'Unknown';
+    const seconds = Math.floor((Date.now() - new Date(timestamp.replace(' ', 'T')).getTime()) / 1000);
+    const days = Math.floor(seconds / 86400);
+
+    if (days > 0) return days === 1 ? 'yesterday' : `${days} days ago`;
+    if (seconds >= 3600) return `${Math.floor(seconds / 3600)}h ago`;
+    if (seconds >= 60) return `${Math.floor(seconds / 60)}m ago`;
+    return 'just now';
+  }
+
+  formatMessageTime(timestamp) {
+    // Message timestamps are epoch milliseconds; show the date too when not today
+    if (typeof timestamp !== 'number') return timestamp || '';
+    const date = new Date(timestamp);
+    const time = date.toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' });
+    if (date.toDateString() === new Date().toDateString()) return time;
+    return `${date.toLocaleDateString([], { month: 'short', day: 'numeric' })} ${time}`;
+  }
+
+  friendStatus(friendId) {
+    const entry = this.presence[friendId] || {};
+    const online = entry.status === 'online';
+    return {
+      online,
+      text: online ? 'Online' : (entry.timestamp ? this.formatLastSeen(entry.timestamp) : (entry.last_seen || 'Unknown'))
+    };
+  }
+
+  createAvatar(user) {
+    const avatar = document.createElement('span');
+    avatar.className = 'avatar';
+    if (user.avatar) {
+      avatar.classList.add('avatar-image');
+      avatar.style.backgroundImage = `url('${user.avatar}')`;
+    } else {
+      avatar.textContent = this.getInitials(user.username);
+    }
+    return avatar;
+  }
+
   async createFriendElement(friend) {
-    const statusResponse = await fetch(`/api/last_seen?friend_id=${friend.id}`);
-    const statusData = await statusResponse.json();
+    const statusData = this.friendStatus(friend.id);
 
     const li = document.createElement('li');
     li.setAttribute('data-friend-id', friend.id);
     li.addEventListener('click', () => this.selectFriend(friend));
 
-    const avatar = document.createElement('span');
-    avatar.className = 'avatar';
-    avatar.textContent = this.getInitials(friend.username);
+    const avatar = this.createAvatar(friend);
 
     const friendInfo = document.createElement('div');
     friendInfo.className = 'friend-info';
@@ -272,12 +444,21 @@ class ChatApp {
     const statusDiv = document.createElement('div');
     statusDiv.className = 'user-status';
     statusDiv.innerHTML = `
-      <span class="status-indicator ${statusData.status === 'online' ? 'status-online' : 'status-offline'}"></span>
-      ${statusData.status === 'online' ? 'Online' : statusData.last_seen}
+      <span class="status-indicator ${statusData.online ? 'status-online' : 'status-offline'}"></span>
+      ${statusData.text}
     `;
 
     friendInfo.appendChild(nameSpan);
     friendInfo.appendChild(statusDiv);
+
+    const lastMessage = this.inbox[friend.id]?.last_message;
+    if (lastMessage) {
+      const preview = document.createElement('div');
+      preview.className = 'message-preview';
+      preview.textContent = lastMessage.preview;
+      friendInfo.appendChild(preview);
+    }
+
     li.appendChild(avatar);
     li.appendChild(friendInfo);
 
@@ -285,6 +466,14 @@ class ChatApp {
       li.classList.add('selected');
     }
 
+    const unread = this.inbox[friend.id]?.unread || 0;
+    if (unread) {
+      const badge = document.createElement('span');
+      badge.className = 'unread-badge';
+      badge.textContent = unread > 99 ? '99+' : unread;
+      li.appendChild(badge);
+    }
+
     return li;
   }
 
@@ -298,9 +487,7 @@ class ChatApp {
     pendingReceived.forEach(friend => {
       const li = document.createElement('li');
 
-      const avatar = document.createElement('span');
-      avatar.className = 'avatar';
-      avatar.textContent = this.getInitials(friend.username);
+      const avatar = this.createAvatar(friend);
 
       const nameSpan = document.createElement('span');
       nameSpan.textContent = friend.username;
@@ -331,9 +518,7 @@ class ChatApp {
     pendingSent.forEach(friend => {
       const li = document.createElement('li');
 
-      const avatar = document.createElement('span');
-      avatar.className = 'avatar';
-      avatar.textContent = this.getInitials(friend.username);
+      const avatar = this.createAvatar(friend);
 
       const nameSpan = document.createElement('span');
       nameSpan.textContent = `${friend.username} (pending)`;
@@ -387,9 +572,12 @@ class ChatApp {
 
   // Load chat history and update status
   await this.loadChatHistory(friend.id);
-  await this.updateFriendStatus(friend.id);
+  this.updateFriendStatus(friend.id);
   await this.markMessagesAsRead(friend.id);
-
+  if (this.inbox[friend.id]) {
+    this.inbox[friend.id].unread = 0;
+    this.updateUnreadBadge(friend.id);
+  }
 
 
   // Close mobile sidebar
@@ -398,16 +586,37 @@ class ChatApp {
   }
 }
 
+  firstRender(id) {
+    // A replay after a quick reconnect (inside the ack debounce) resends what is already on screen
+    if (!id) return true;
+    if (this.renderedIds.has(id)) return false;
+    this.renderedIds.add(id);
+    return true;
+  }
+
+  trackMessageId(id) {
+    if (!id) return;
+    if (this.oldestMessageId === null || id < this.oldestMessageId) this.oldestMessageId = id;
+    if (this.newestMessageId === null || id > this.newestMessageId) this.newestMessageId = id;
+  }
+
   async loadChatHistory(friendId) {
     try {
       const response = await fetch(`/api/chat_history?friend_id=${friendId}`);
       const data = await response.json();
 
+      this.oldestMessageId = null;
+      this.newestMessageId = null;
+      this.renderedIds.clear();
+      this.hasMoreHistory = data.has_more;
+
       const chatMessages = document.getElementById('chat-messages');
       if (chatMessages) {
         chatMessages.innerHTML = '';
 
         data.messages.forEach(message => {
+          if (!this.firstRender(message.id)) return;
+          this.trackMessageId(message.id);
           this.displayMessage(message, false);
         });
 
@@ -418,6 +627,57 @@ class ChatApp {
     }
   }
 
+  async loadOlderMessages() {
+    if (!this.currentFriend || !this.hasMoreHistory || this.loadingHistory || this.oldestMessageId === null) return;
+    this.loadingHistory = true;
+    const friendId = this.currentFriend.id;
+
+    try {
+      const response = await fetch(`/api/chat_history?friend_id=${friendId}&before_id=${this.oldestMessageId}`);
+      const data = await response.json();
+      if (this.currentFriend?.id !== friendId) return;
+
+      const chatMessages = document.getElementById('chat-messages');
+      const previousHeight = chatMessages.scrollHeight;
+
+      // Prepend newest-first so the page ends up in ascending order
+      [...data.messages].reverse().forEach(message => {
+        if (!this.firstRender(message.id)) return;
+        this.trackMessageId(message.id);
+        this.displayMessage(message, false, true);
+      });
+      this.hasMoreHistory = data.has_more;
+
+      // Keep the viewport anchored on the message the user was reading
+      chatMessages.scrollTop += chatMessages.scrollHeight - previousHeight;
+    } catch (error) {
+      console.error('Load older messages error:', error);
+    } finally {
+      this.loadingHistory = false;
+    }
+  }
+
+  async syncChatHistory() {
+    // After a reconnect only fetch what was missed while offline
+    if (!this.currentFriend || this.newestMessageId === null) return;
+    const friendId = this.currentFriend.id;
+
+    try {
+      const response = await fetch(`/api/chat_history?friend_id=${friendId}&since=${this.newestMessageId}`);
+      const data = await response.json();
+      if (this.currentFriend?.id !== friendId) return;
+
+      data.messages.forEach(message => {
+        if (!this.firstRender(message.id)) return;
+        this.trackMessageId(message.id);
+        this.displayMessage(message, true);
+      });
+      if (data.has_more) this.loadChatHistory(friendId);
+    } catch (error) {
+      console.error('Sync chat history error:', error);
+    }
+  }
+
   handleReadReceipt(data) {
   // Update UI for messages that were read
   if (this.currentFriend && data.reader_id === this.currentFriend.id) {
@@ -435,7 +695,7 @@ class ChatApp {
   }
 }
 
-  displayMessage(data, animate = true) {
+  displayMessage(data, animate = true, prepend = false) {
     const chatMessages = document.getElementById('chat-messages');
     if (!chatMessages) return;
 
@@ -457,10 +717,15 @@ class ChatApp {
     const fileInfo = this.parseFileMessage(data);
     if (fileInfo) {
       if (fileInfo.filetype?.startsWith('image/')) {
+        // 256px thumbnail in the list, full image on click
         bubble.innerHTML = `
-          <img src="${fileInfo.url}" 
-               alt="image" 
-               style="max-width: 200px; max-height: 200px; border-radius: var(--radius-sm); margin-bottom: 0.5rem;" />
+          <a href="${fileInfo.url}" target="_blank" rel="noopener noreferrer">
+            <img src="${fileInfo.url}?variant=256"
+                 data-file-id="${fileInfo.file_id}"
+                 alt="image"
+                 loading="lazy"
+                 style="max-width: 200px; max-height: 200px; border-radius: var(--radius-sm); margin-bottom: 0.5rem;" />
+          </a>
         `;
       } else {
         bubble.innerHTML = `
@@ -480,7 +745,8 @@ class ChatApp {
     if (data.timestamp) {
       const timeSpan = document.createElement('div');
       timeSpan.className = 'message-time';
-      timeSpan.textContent = data.timestamp;
+      timeSpan.textContent = this.formatMessageTime(data.timestamp);
+      timeSpan.title = typeof data.timestamp === 'number' ? new Date(data.timestamp).toLocaleString() : '';
       bubble.appendChild(timeSpan);
     }
 
@@ -493,7 +759,11 @@ class ChatApp {
   }
     li.appendChild(avatar);
     li.appendChild(bubble);
-    chatMessages.appendChild(li);
+    if (prepend) {
+      chatMessages.insertBefore(li, chatMessages.firstChild);
+    } else {
+      chatMessages.appendChild(li);
+    }
 
     if (animate) {
       chatMessages.scrollTop = chatMessages.scrollHeight;
@@ -512,6 +782,7 @@ class ChatApp {
       }
 
       return {
+        file_id,
         url: `/file/${file_id}`,
         filetype,
         filename
@@ -527,6 +798,13 @@ class ChatApp {
     return null;
   }
 
+  handleFileReady({ file_id }) {
+    // Thumbnails were still rendering when the message was shown; swap them in
+    document.querySelectorAll(`#chat-messages img[data-file-id="${file_id}"]`).forEach(img => {
+      img.src = `/file/${file_id}?variant=256&ready=1`;
+    });
+  }
+
   async handleFileUpload(event) {
     const file = event.target.files[0];
     if (!file || !this.currentFriend) return;
@@ -543,7 +821,9 @@ class ChatApp {
 
       const data = await response.json();
 
-      if (data.file_id) {
+      if (data.error) {
+        alert(data.error);
+      } else if (data.file_id) {
         this.socket.emit('private_message', {
           to: this.currentFriend.id,
           message: '',
@@ -586,44 +866,52 @@ class ChatApp {
   }
 
   handleIncomingMessage(data) {
+    this.markDelivered('message_id', data.id);
     if (!this.currentFriend ||
         (data.from_id !== this.currentFriend.id && data.to_id !== this.currentFriend.id)) {
+      // Mirror the server's conversation counter so the badge is right without refetching
+      if (data.from_id !== data.to_id && data.sender !== this.myUsername) {
+        const entry = this.inbox[data.from_id] || (this.inbox[data.from_id] = { unread: 0 });
+        if (!entry.last_message || entry.last_message.id < data.id) {
+          entry.unread += 1;
+          this.updateUnreadBadge(data.from_id);
+        }
+      }
       return;
     }
 
+    if (!this.firstRender(data.id)) return;
+    this.trackMessageId(data.id);
     this.displayMessage(data, true);
   }
 
-  async updateFriendStatus(friendId) {
-    try {
-      const response = await fetch(`/api/last_seen?friend_id=${friendId}`);
-      const data = await response.json();
+  updateFriendStatus(friendId) {
+    const data = this.friendStatus(friendId);
 
-      const chatHeader = document.getElementById('chat-header');
-      if (chatHeader && this.currentFriend?.id === friendId) {
-        const statusElement = chatHeader.querySelector('.user-status');
-        if (statusElement) {
-          statusElement.innerHTML = `
-            <span class="status-indicator ${data.status === 'online' ? 'status-online' : 'status-offline'}"></span>
-            <span>${data.status === 'online' ? 'Online' : data.last_seen}</span>
-          `;
-        }
-      }
-
-      // Update in friend list
-      const friendElement = document.querySelector(`#friend-list li[data-friend-id="${friendId}"] .user-status`);
-      if (friendElement) {
-        friendElement.innerHTML = `
-          <span class="status-indicator ${data.status === 'online' ? 'status-online' : 'status-offline'}"></span>
-          ${data.status === 'online' ? 'Online' : data.last_seen}
+    const chatHeader = document.getElementById('chat-header');
+    if (chatHeader && String(this.currentFriend?.id) === String(friendId)) {
+      const statusElement = chatHeader.querySelector('.user-status');
+      if (statusElement) {
+        statusElement.innerHTML = `
+          <span class="status-indicator ${data.online ? 'status-online' : 'status-offline'}"></span>
+          <span>${data.text}</span>
         `;
       }
-    } catch (error) {
-      console.error('Update friend status error:', error);
+    }
+
+    // Update in friend list
+    const friendElement = document.querySelector(`#friend-list li[data-friend-id="${friendId}"] .user-status`);
+    if (friendElement) {
+      friendElement.innerHTML = `
+        <span class="status-indicator ${data.online ? 'status-online' : 'status-offline'}"></span>
+        ${data.text}
+      `;
     }
   }
 
   setupFriendStatusUpdates() {
+    // Presence changes are pushed over the socket; this only refreshes the
+    // relative "last seen" labels locally without touching the network.
     this.friendStatusInterval = setInterval(() => {
       const friendElements = document.querySelectorAll('#friend-list li[data-friend-id]');
       friendElements.forEach(element => {
@@ -632,7 +920,7 @@ class ChatApp {
           this.updateFriendStatus(friendId);
         }
       });
-    }, 10000);
+    }, 60000);
   }
 
   receiveGroupInvite({ group_id, group_name, inviter }) {
@@ -659,12 +947,12 @@ renderGroupList() {
     const li = document.createElement('li');
     li.textContent = `${g.name}${g.unreadCount ? ' ('+g.unreadCount+')' : ''}`;
     li.addEventListener('click', () => this.selectGroup(gid));
-    if (this.currentGroup?.id === gid) li.classList.add('selected');
+    if (this.currentGroup?.id === Number(gid)) li.classList.add('selected');
     ul.appendChild(li);
   });
 }
 async selectGroup(gid) {
-  this.currentGroup   = { id: gid, ...this.groups[gid] };
+  this.currentGroup   = { ...this.groups[gid], id: Number(gid) };
   this.currentFriend  = null;             // leave private mode
   this.updateChatUIState();
 
@@ -680,7 +968,8 @@ async selectGroup(gid) {
   const data = await res.json();
   const ul = document.getElementById('chat-messages');
   ul.innerHTML = '';
-  data.messages.forEach(m => this.displayMessage(m,false));
+  this.renderedIds.clear();
+  data.messages.forEach(m => { if (this.firstRender(m.id)) this.displayMessage(m,false); });
   ul.scrollTop = ul.scrollHeight;
 
   // mark all as read
@@ -689,8 +978,10 @@ async selectGroup(gid) {
 }
 
 handleGroupMessage(d) {
+  this.markDelivered('group_message_id', d.id);
   // if we’re looking at this group show it, otherwise bump unread counter
   if (this.currentGroup?.id === d.group_id) {
+    if (!this.firstRender(d.id)) return;
     this.displayMessage({
       sender   : d.sender,
       message  : d.message,
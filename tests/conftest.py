@@ -0,0 +1,23 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# app.py opens its database and folders at import time, so point them at a
+# scratch directory before any test imports it
+WORKDIR = tempfile.mkdtemp(prefix='chatapp-tests-')
+os.environ.update(
+    CHATAPP_DB=os.path.join(WORKDIR, 'chatapp.db'),
+    CHATAPP_ATTACHMENTS=os.path.join(WORKDIR, 'attachments'),
+    CHATAPP_ARCHIVE=os.path.join(WORKDIR, 'archive'),
+    CHATAPP_LOGIN_MAX_PER_IP='1000000',
+)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(autouse=True, scope='session')
+def database():
+    # Importing app doesn't migrate; a serving process does it on first use
+    import app
+    app.ensure_db()
@@ -0,0 +1,51 @@
+import os
+from datetime import datetime
+
+import app
+
+
+def ms(text):
+    return int(datetime.fromisoformat(text).timestamp() * 1000)
+
+
+def login(name):
+    client = app.app.test_client()
+    client.post('/signup', data={'username': name, 'password': 'pw'})
+    client.post('/login', data={'username': name, 'password': 'pw'})
+    with app.db_pool.connection() as conn:
+        return client, conn.execute('SELECT id FROM user WHERE username = ?', (name,)).fetchone()[0]
+
+
+def test_history_opens_only_archives_holding_the_conversation(monkeypatch):
+    ann, ann_id = login('archive_ann')
+    _, bob_id = login('archive_bob')
+    _, cat_id = login('archive_cat')
+    with app.db_pool.connection() as conn:
+        app.insert_private_messages(conn, [
+            (None, ann_id, bob_id, 'jan', ms('2024-01-10 12:00:00')),
+            (None, ann_id, cat_id, 'feb', ms('2024-02-10 12:00:00')),
+            (None, bob_id, ann_id, 'mar', ms('2024-03-10 12:00:00')),
+        ])
+        conn.commit()
+        app.archive_messages(conn, ms('2024-06-01 00:00:00'))
+        pair = (min(ann_id, bob_id), max(ann_id, bob_id))
+        spans = conn.execute("SELECT month FROM archive_span WHERE tbl = 'message' AND conv_low = ? AND conv_high = ? "
+                             'ORDER BY month', pair).fetchall()
+    assert [row[0] for row in spans] == ['2024-01', '2024-03']
+
+    opened = []
+    read_archive = app.read_archive
+    monkeypatch.setattr(app, 'read_archive', lambda path, *args: opened.append(os.path.basename(path))
+                        or read_archive(path, *args))
+    history = ann.get(f'/api/chat_history?friend_id={bob_id}').get_json()
+    assert [m['message'] for m in history['messages']] == ['jan', 'mar']
+    assert opened == ['messages-2024-03.db', 'messages-2024-01.db']
+
+    opened.clear()
+    ann.get(f'/api/chat_history?friend_id={bob_id}&limit=1')
+    assert opened == ['messages-2024-03.db', 'messages-2024-01.db']
+    opened.clear()
+    # A conversation that was never archived opens nothing
+    _, dan_id = login('archive_dan')
+    assert ann.get(f'/api/chat_history?friend_id={dan_id}').get_json()['messages'] == []
+    assert opened == []
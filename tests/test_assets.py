@@ -0,0 +1,65 @@
+import gzip
+import os
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def dist(tmp_path, monkeypatch):
+    # Build into a scratch folder so the checkout's static/dist is left alone
+    monkeypatch.setattr(app, 'ASSET_FOLDER', str(tmp_path))
+    monkeypatch.setattr(app, 'ASSET_MANIFEST', str(tmp_path / 'manifest.json'))
+    manifest = app.build_assets()
+    monkeypatch.setattr(app, 'asset_manifest', manifest)
+    return tmp_path
+
+
+def test_pages_link_fingerprinted_assets(dist):
+    page = app.app.test_client().get('/login').get_data(as_text=True)
+    built = app.asset_manifest['auth.js']
+    assert built.startswith('auth.') and built != 'auth.js'
+    assert f'/assets/{built}' in page
+    assert 'static/auth.js' not in page
+
+
+def test_asset_encoding_follows_accept_encoding(dist):
+    client = app.app.test_client()
+    built = app.asset_manifest['chat.js']
+    raw = (dist / built).read_bytes()
+
+    response = client.get(f'/assets/{built}', headers={'Accept-Encoding': 'gzip'})
+    assert response.content_encoding == 'gzip'
+    assert gzip.decompress(response.data) == raw
+    assert response.mimetype == 'text/javascript'
+    assert 'Accept-Encoding' in response.vary
+    assert response.cache_control.immutable and response.cache_control.public
+
+    for header in ({}, {'Accept-Encoding': 'identity'}, {'Accept-Encoding': 'gzip;q=0'}):
+        response = client.get(f'/assets/{built}', headers=header)
+        assert response.content_encoding is None
+        assert response.data == raw
+
+    if app.brotli:
+        response = client.get(f'/assets/{built}', headers={'Accept-Encoding': 'gzip, br'})
+        assert response.content_encoding == 'br'
+    assert client.get('/assets/manifest.json').status_code == 404
+
+
+def test_rebuild_keeps_the_previous_build_and_deletes_older_ones(dist, monkeypatch):
+    first = dict(app.asset_manifest)
+    (dist / 'chat.0123456789ab.js').write_text('old')
+    (dist / 'chat.0123456789ab.js.gz').write_bytes(b'old')
+    (dist / 'notes.txt').write_text('not a build output')
+
+    monkeypatch.setattr(app, 'minify_js', lambda text: text + '\n// second build\n')
+    second = app.build_assets()
+    monkeypatch.setattr(app, 'minify_js', lambda text: text + '\n// third build\n')
+    third = app.build_assets()
+
+    names = set(os.listdir(dist))
+    assert 'chat.0123456789ab.js' not in names and 'chat.0123456789ab.js.gz' not in names
+    assert first['chat.js'] not in names and first['chat.js'] + '.gz' not in names
+    assert {second['chat.js'], second['chat.js'] + '.gz', third['chat.js'], third['chat.js'] + '.gz'} <= names
+    assert {first['style.css'], 'notes.txt', 'manifest.json'} <= names  # unchanged CSS is still current
@@ -0,0 +1,33 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import app
+
+
+def test_async_pool_connections_run_every_blocking_call_off_the_caller(monkeypatch, tmp_path):
+    # Stand-in for the eventlet / gevent thread pool
+    offload = ThreadPoolExecutor(1)
+    offloaded = []
+
+    def run_blocking(fn, *args, **kwargs):
+        offloaded.append(getattr(fn, '__name__', fn))
+        return offload.submit(fn, *args, **kwargs).result()
+
+    monkeypatch.setattr(app, 'ASYNC_MODE', 'gevent')
+    monkeypatch.setattr(app, 'run_blocking', run_blocking)
+    pool = app.ConnectionPool(str(tmp_path / 'async.db'), size=1)
+
+    with pool.connection() as conn:
+        assert isinstance(conn, app.OffloadedConnection)
+        conn.execute('CREATE TABLE t (x)')
+        conn.executemany('INSERT INTO t VALUES (?)', [(1,), (2,)])
+        conn.commit()
+        offloaded.clear()
+        c = conn.cursor()
+        assert [row['x'] for row in c.execute('SELECT x FROM t ORDER BY x')] == [1, 2]
+        conn.execute('INSERT INTO t VALUES (3)')
+        assert conn.in_transaction
+    offload.shutdown()
+
+    assert offloaded == ['execute', 'fetchall', 'execute', 'rollback']
+    with pool.connection() as conn:
+        assert not conn.in_transaction
@@ -0,0 +1,63 @@
+import os
+import signal
+import time
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def client():
+    return app.app.test_client()
+
+
+def signup(client, name):
+    return client.post('/signup', data={'username': name, 'password': 'pw'})
+
+
+def kill_workers(pool):
+    executor = pool()
+    executor.submit(os.getpid).result()  # make sure a worker is running
+    for process in list(executor._processes.values()):
+        os.kill(process.pid, signal.SIGKILL)
+        process.join()
+
+
+@pytest.mark.skipif(not app.PASSWORD_WORKERS, reason='hashing runs inline')
+def test_login_recovers_after_a_hashing_worker_dies(client):
+    signup(client, 'auth_killed')
+    kill_workers(app.password_pool)
+
+    response = client.post('/login', data={'username': 'auth_killed', 'password': 'pw'})
+
+    assert response.status_code == 302
+    assert app.hash_password('pw') == app.hash_password('pw')
+
+
+@pytest.mark.skipif(not app.PASSWORD_WORKERS, reason='hashing runs inline')
+def test_hash_timeout_answers_busy(client, monkeypatch):
+    monkeypatch.setattr(app, 'PASSWORD_TIMEOUT', 0.2)
+    # Every worker is busy for longer than the timeout
+    for _ in range(app.PASSWORD_WORKERS):
+        app.password_pool().submit(time.sleep, 1)
+
+    response = client.post('/login', data={'username': 'auth_timeout', 'password': 'pw'})
+
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+    assert app._password_in_flight == 0
+
+
+def test_pool_that_keeps_breaking_answers_busy(client, monkeypatch):
+    def broken(*args, **kwargs):
+        raise app.BrokenProcessPool('worker died')
+    monkeypatch.setattr(app, 'PASSWORD_WORKERS', 1)
+    monkeypatch.setattr(app, 'submit_cpu', broken)
+
+    assert signup(client, 'auth_broken').status_code == 503
+
+
+def test_image_pool_recovers_after_a_worker_dies():
+    kill_workers(app.image_pool)
+    assert app.run_cpu(app.image_pool, os.getpid) != os.getpid()
@@ -0,0 +1,39 @@
+import hashlib
+import io
+import os
+
+import app
+
+
+def test_rejected_avatar_never_reaches_the_store():
+    client = app.app.test_client()
+    client.post('/signup', data={'username': 'avatar_junk', 'password': 'pw'})
+    client.post('/login', data={'username': 'avatar_junk', 'password': 'pw'})
+    junk = b'definitely not an image ' + os.urandom(16)
+
+    response = client.post('/settings', data={'profile_picture': (io.BytesIO(junk), 'x.png')},
+                           content_type='multipart/form-data')
+
+    assert b'Could not read that image' in response.data
+    assert not os.path.exists(app.attachment_path(hashlib.sha256(junk).hexdigest()))
+    assert not [name for name in os.listdir(app.ATTACHMENT_FOLDER) if name.startswith('.upload-')]
+
+
+def test_renditions_keep_transparency_as_png_and_flatten_the_rest_to_jpeg(tmp_path):
+    Image = app.Image
+    Image.new('RGBA', (300, 200), (255, 0, 0, 128)).save(tmp_path / 'alpha.png')
+    Image.new('RGB', (300, 200), (0, 0, 255)).save(tmp_path / 'opaque.png')
+    paletted = Image.new('P', (300, 200))
+    paletted.info['transparency'] = 0
+    paletted.save(tmp_path / 'paletted.png')
+
+    for name, fmt, mimetype in (('alpha.png', 'PNG', 'image/png'), ('paletted.png', 'PNG', 'image/png'),
+                                ('opaque.png', 'JPEG', 'image/jpeg')):
+        source = str(tmp_path / name)
+        avatars = app.render_avatar_sizes(source)
+        variants = app.render_image_variants(source)
+        assert [size for size, _, _, _ in avatars] == list(app.AVATAR_SIZES)
+        assert {rendition[2] for rendition in avatars + variants} == {mimetype}
+        for _, path, _, _ in avatars:
+            with Image.open(path) as img:
+                assert img.format == fmt
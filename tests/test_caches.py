@@ -0,0 +1,60 @@
+import app
+
+
+def test_friend_graph_entries_are_not_mutated_under_readers():
+    graph = app.FriendGraph()
+    with app.db_pool.connection() as conn:
+        entry = graph.get(conn, 9001)
+        accepted = app.accepted_friend_ids(conn, [9001])[9001]
+    graph.request_sent(9001, 9002)
+    graph.request_accepted(9001, 9002)
+    assert entry['sent'] == entry['accepted'] == accepted == frozenset()
+    with app.db_pool.connection() as conn:
+        assert graph.get(conn, 9001)['accepted'] == {9002}
+
+
+def test_group_membership_entries_are_not_mutated_under_readers():
+    membership = app.GroupMembership()
+    with app.db_pool.connection() as conn:
+        groups = membership.groups_of(conn, 9001)
+        membership.joined(9001, 77)
+        assert groups == frozenset()
+        assert membership.is_member(conn, 9001, 77)
+
+
+class OnlineSet:
+    # Stands in for the socket router: just the set of connected users
+    def __init__(self):
+        self.users = set()
+
+    def sids(self, user_ids):
+        return {user_id: ['sid'] for user_id in user_ids if user_id in self.users}
+
+
+def test_presence_forgets_offline_users_once_written_back():
+    router = OnlineSet()
+    presence = app.PresenceRegistry(router)
+    router.users.add(1)
+    presence.connect(1)
+    assert presence.drain_changes() == [(1, 'online', presence.last_seen(1))]
+    rows = presence.drain_last_seen()
+    presence.written_back([user_id for _, user_id in rows])
+    assert presence.last_seen(1) is not None  # still online
+
+    router.users.discard(1)
+    presence.disconnect(1)
+    assert [status for _, status, _ in presence.drain_changes()] == ['offline']
+    rows = presence.drain_last_seen()
+    presence.written_back([user_id for _, user_id in rows])
+    assert presence.last_seen(1) is None
+    assert not presence._last_seen and not presence._published
+
+    # A reconnect is still pushed, a connect/disconnect nobody saw is not
+    router.users.add(1)
+    presence.connect(1)
+    assert [status for _, status, _ in presence.drain_changes()] == ['online']
+    router.users.discard(1)
+    presence.disconnect(1)
+    presence.connect(2)
+    presence.disconnect(2)
+    assert presence.drain_changes() == [(1, 'offline', presence.last_seen(1))]
@@ -0,0 +1,54 @@
+import hashlib
+import io
+import os
+
+import app
+
+
+def login(name):
+    client = app.app.test_client()
+    client.post('/signup', data={'username': name, 'password': 'pw'})
+    client.post('/login', data={'username': name, 'password': 'pw'})
+    return client
+
+
+def upload(client, data, filename, content_type='text/plain'):
+    response = client.post('/api/upload', data={'file': (io.BytesIO(data), filename, content_type)},
+                           content_type='multipart/form-data')
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def test_uploads_are_stored_once_by_content_and_served_with_ranges():
+    client = login('files_ann')
+    data = b'0123456789' * 1000 + os.urandom(8)
+    first = upload(client, data, 'notes.txt')
+    second = upload(client, data, 'copy.txt')
+    assert first['file_id'] != second['file_id'] and second['filename'] == 'copy.txt'
+    sha256 = hashlib.sha256(data).hexdigest()
+    with open(app.attachment_path(sha256), 'rb') as f:
+        assert f.read() == data
+    with app.db_pool.connection() as conn:
+        assert {row['sha256'] for row in conn.execute('SELECT sha256 FROM file WHERE id IN (?, ?)',
+                                                       (first['file_id'], second['file_id']))} == {sha256}
+
+    response = client.get(f"/file/{first['file_id']}")
+    assert response.status_code == 200 and response.data == data
+    assert response.cache_control.private and response.cache_control.immutable
+
+    response = client.get(f"/file/{first['file_id']}", headers={'Range': 'bytes=10-19'})
+    assert response.status_code == 206 and response.data == data[10:20]
+    assert response.headers['Content-Range'] == f'bytes 10-19/{len(data)}'
+
+    etag = client.get(f"/file/{first['file_id']}").headers['ETag']
+    assert client.get(f"/file/{first['file_id']}", headers={'If-None-Match': etag}).status_code == 304
+    assert client.get('/file/999999999').status_code == 404
+
+
+def test_upload_rejects_missing_and_disallowed_files():
+    client = login('files_bob')
+    assert client.post('/api/upload', data={}, content_type='multipart/form-data').status_code == 400
+    response = client.post('/api/upload', data={'file': (io.BytesIO(b'x'), 'run.exe')},
+                           content_type='multipart/form-data')
+    assert response.status_code == 400
+    assert app.app.test_client().post('/api/upload').status_code == 401
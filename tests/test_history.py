@@ -0,0 +1,63 @@
+import app
+
+
+def login(name):
+    client = app.app.test_client()
+    client.post('/signup', data={'username': name, 'password': 'pw'})
+    client.post('/login', data={'username': name, 'password': 'pw'})
+    return client
+
+
+def user_id(name):
+    with app.db_pool.connection() as conn:
+        return conn.execute('SELECT id FROM user WHERE username = ?', (name,)).fetchone()[0]
+
+
+def history(client, **params):
+    response = client.get('/api/chat_history', query_string=params)
+    assert response.status_code == 200
+    page = response.get_json()
+    return [message['message'] for message in page['messages']], page['has_more'], page['messages']
+
+
+def test_history_pages_backwards_and_syncs_forwards_by_id():
+    ann, bob, cat = login('history_ann'), login('history_bob'), login('history_cat')
+    ann_id, bob_id, cat_id = user_id('history_ann'), user_id('history_bob'), user_id('history_cat')
+    ann_socket = app.socketio.test_client(app.app, flask_test_client=ann)
+    bob_socket = app.socketio.test_client(app.app, flask_test_client=bob)
+    for i in range(5):
+        sender, to = (ann_socket, bob_id) if i % 2 == 0 else (bob_socket, ann_id)
+        sender.emit('private_message', {'to': to, 'message': f'm{i}'})
+        ann_socket.emit('private_message', {'to': cat_id, 'message': f'other{i}'})  # another conversation
+
+    texts, has_more, messages = history(ann, friend_id=bob_id, limit=2)
+    assert texts == ['m3', 'm4'] and has_more
+    assert messages[0]['sender'] == 'history_bob' and messages[0]['receiver_id'] == ann_id
+    texts, has_more, older = history(ann, friend_id=bob_id, limit=2, before_id=messages[0]['id'])
+    assert texts == ['m1', 'm2'] and has_more
+    texts, has_more, oldest = history(ann, friend_id=bob_id, limit=2, before_id=older[0]['id'])
+    assert texts == ['m0'] and not has_more
+
+    # The other side sees the same conversation
+    assert history(bob, friend_id=ann_id)[0] == ['m0', 'm1', 'm2', 'm3', 'm4']
+
+    texts, has_more, _ = history(ann, friend_id=bob_id, limit=2, after_id=oldest[0]['id'])
+    assert texts == ['m1', 'm2'] and has_more
+    texts, has_more, _ = history(ann, friend_id=bob_id, since=older[-1]['id'])
+    assert texts == ['m3', 'm4'] and not has_more
+
+    assert ann.get(f'/api/chat_history?friend_id={bob_id}&limit=0').status_code == 400
+    assert ann.get('/api/chat_history?friend_id=x').status_code == 400
+    assert ann.get('/api/chat_history').status_code == 400
+
+
+def test_history_reports_reads():
+    ann, bob = login('history_reader'), login('history_writer')
+    ann_id, bob_id = user_id('history_reader'), user_id('history_writer')
+    app.socketio.test_client(app.app, flask_test_client=bob).emit('private_message', {'to': ann_id, 'message': 'hi'})
+    [message] = history(bob, friend_id=ann_id)[2]
+    assert not message['read'] and message['read_at'] is None
+
+    ann.post('/api/mark_read', json={'sender_id': bob_id})
+    [message] = history(bob, friend_id=ann_id)[2]
+    assert message['read'] and message['read_at']
@@ -0,0 +1,58 @@
+import io
+import time
+
+import app
+
+
+def login(name):
+    client = app.app.test_client()
+    client.post('/signup', data={'username': name, 'password': 'pw'})
+    client.post('/login', data={'username': name, 'password': 'pw'})
+    return client
+
+
+def png(size, color):
+    buffer = io.BytesIO()
+    app.Image.new('RGB', size, color).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def upload(client, data, filename):
+    response = client.post('/api/upload', data={'file': (io.BytesIO(data), filename, 'image/png')},
+                           content_type='multipart/form-data')
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def file_ready(socket, file_id, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        for packet in socket.get_received():
+            if packet['name'] == 'file_ready' and packet['args'][0]['file_id'] == file_id:
+                return packet['args'][0]['variants']
+        time.sleep(0.05)
+    raise AssertionError(f'file {file_id} never became ready')
+
+
+def test_image_uploads_get_thumbnails_off_the_request_and_reuse_them():
+    client = login('variants_ann')
+    socket = app.socketio.test_client(app.app, flask_test_client=client)
+    data = png((1500, 1000), (10, 200, 30))
+
+    uploaded = upload(client, data, 'big.png')
+    assert uploaded['processing'] and uploaded['variants'] == []
+    variants = file_ready(socket, uploaded['file_id'])
+    assert sorted(variants, key=int) == [str(size) for size in app.IMAGE_VARIANT_SIZES]
+
+    response = client.get(f"/file/{uploaded['file_id']}?variant=256")
+    assert response.status_code == 200 and response.mimetype == 'image/jpeg'
+    with app.Image.open(io.BytesIO(response.data)) as img:
+        assert img.size == (256, 171)
+    assert response.headers['ETag'].strip('"').endswith('-256')
+
+    again = upload(client, data, 'same.png')
+    assert not again['processing'] and sorted(again['variants']) == sorted(variants)
+
+    # Unknown variants fall back to the original, uncacheable as the variant
+    response = client.get(f"/file/{uploaded['file_id']}?variant=999")
+    assert response.data == data and response.cache_control.no_cache
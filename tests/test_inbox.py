@@ -0,0 +1,54 @@
+import app
+
+
+def login(name):
+    client = app.app.test_client()
+    client.post('/signup', data={'username': name, 'password': 'pw'})
+    client.post('/login', data={'username': name, 'password': 'pw'})
+    return client
+
+
+def user_id(name):
+    with app.db_pool.connection() as conn:
+        return conn.execute('SELECT id FROM user WHERE username = ?', (name,)).fetchone()[0]
+
+
+def send(client, to, text):
+    socket = app.socketio.test_client(app.app, flask_test_client=client)
+    socket.emit('private_message', {'to': to, 'message': text})
+    socket.disconnect()
+
+
+def summary(conversation):
+    return conversation['username'], conversation['unread'], conversation['last_message']['preview']
+
+
+def test_inbox_counts_unread_per_conversation_and_pages_newest_first():
+    ann, bob, cat = login('inbox_ann'), login('inbox_bob'), login('inbox_cat')
+    send(bob, user_id('inbox_ann'), 'one')
+    send(bob, user_id('inbox_ann'), 'two')
+    send(cat, user_id('inbox_ann'), 'hi ann')
+    send(ann, user_id('inbox_cat'), 'hi cat')
+
+    page = ann.get('/api/inbox').get_json()
+    assert [summary(c) for c in page['conversations']] == [('inbox_cat', 1, 'hi cat'), ('inbox_bob', 2, 'two')]
+    assert page['has_more'] is False
+    assert [summary(c) for c in bob.get('/api/inbox').get_json()['conversations']] == [('inbox_ann', 0, 'two')]
+
+    first = ann.get('/api/inbox?limit=1').get_json()
+    assert [c['username'] for c in first['conversations']] == ['inbox_cat'] and first['has_more']
+    before_id = first['conversations'][-1]['last_message']['id']
+    second = ann.get(f'/api/inbox?limit=1&before_id={before_id}').get_json()
+    assert [c['username'] for c in second['conversations']] == ['inbox_bob'] and not second['has_more']
+
+    assert ann.post('/api/mark_read', json={'sender_id': user_id('inbox_bob')}).get_json()['count'] == 2
+    assert [summary(c) for c in ann.get('/api/inbox').get_json()['conversations']] == [
+        ('inbox_cat', 1, 'hi cat'), ('inbox_bob', 0, 'two')]
+
+    assert ann.get('/api/inbox?limit=0').status_code == 400
+    assert ann.get('/api/inbox?limit=x').status_code == 400
+
+
+def test_inbox_previews_file_messages_by_name():
+    assert app.message_preview('[fileid]12|image/png|holiday.png') == '📎 holiday.png'
+    assert app.message_preview('plain [fileid] text') == 'plain [fileid] text'
@@ -0,0 +1,78 @@
+import app
+
+
+def login(name):
+    client = app.app.test_client()
+    client.post('/signup', data={'username': name, 'password': 'pw'})
+    client.post('/login', data={'username': name, 'password': 'pw'})
+    return client
+
+
+def user_id(name):
+    with app.db_pool.connection() as conn:
+        return conn.execute('SELECT id FROM user WHERE username = ?', (name,)).fetchone()[0]
+
+
+def throttled(socket):
+    return [packet['args'][0] for packet in socket.get_received() if packet['name'] == 'throttled']
+
+
+def test_rate_limiter_allows_a_burst_then_refills_per_user_and_event(monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(app.time, 'monotonic', lambda: clock[0])
+    limiter = app.RateLimiter({'send': (2, 3)}, size=2)
+
+    assert [limiter.acquire(1, 'send') for _ in range(3)] == [0, 0, 0]
+    assert limiter.acquire(1, 'send') == 0.5
+    assert limiter.acquire(2, 'send') == 0
+    assert limiter.acquire(1, 'unlimited') == 0
+    clock[0] += 0.5
+    assert limiter.acquire(1, 'send') == 0
+    assert limiter.acquire(1, 'send') > 0
+
+    limiter.acquire(3, 'send')
+    assert limiter.stats() == {'tracked': 2}
+
+
+def test_rate_limit_overrides_parse_from_the_environment_format():
+    limits = app.parse_rate_limits('private_message=5:20, group_create=0.5,delivered=0', {'group_accept': (2, 10)})
+    assert limits == {'group_accept': (2, 10), 'private_message': (5, 20), 'group_create': (0.5, 0.5),
+                      'delivered': (0, 0)}
+
+
+def test_throttled_events_are_dropped_and_answered(monkeypatch):
+    monkeypatch.setattr(app, 'rate_limiter', app.RateLimiter({'private_message': (0.01, 2)}))
+    client = login('limits_ann')
+    login('limits_bob')
+    bob = user_id('limits_bob')
+    socket = app.socketio.test_client(app.app, flask_test_client=client)
+    socket.get_received()
+    with app.db_pool.connection() as conn:
+        before = conn.execute('SELECT COUNT(*) FROM message WHERE receiver_id = ?', (bob,)).fetchone()[0]
+
+    for text in ('one', 'two', 'three'):
+        socket.emit('private_message', {'to': bob, 'message': text})
+
+    [notice] = throttled(socket)
+    assert notice['event'] == 'private_message' and notice['reason'] == 'rate'
+    assert 0 < notice['retry_after'] <= 100
+    with app.db_pool.connection() as conn:
+        assert conn.execute('SELECT COUNT(*) FROM message WHERE receiver_id = ?', (bob,)).fetchone()[0] == before + 2
+    assert socket.is_connected()
+
+
+def test_group_create_refuses_more_than_the_member_cap(monkeypatch):
+    monkeypatch.setattr(app, 'GROUP_MAX_MEMBERS', 2)
+    client = login('limits_owner')
+    socket = app.socketio.test_client(app.app, flask_test_client=client)
+    socket.get_received()
+    with app.db_pool.connection() as conn:
+        before = conn.execute('SELECT COUNT(*) FROM "group"').fetchone()[0]
+
+    socket.emit('group_create', {'name': 'too big', 'member_ids': [1, 2, 3]})
+    assert throttled(socket) == [{'event': 'group_create', 'reason': 'member_limit', 'limit': 2}]
+
+    socket.emit('group_create', {'name': 'fits', 'member_ids': [1, 2]})
+    assert [packet['name'] for packet in socket.get_received()] == ['group_created']
+    with app.db_pool.connection() as conn:
+        assert conn.execute('SELECT COUNT(*) FROM "group"').fetchone()[0] == before + 1
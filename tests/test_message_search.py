@@ -0,0 +1,58 @@
+import pytest
+
+import app
+
+pytestmark = pytest.mark.skipif(not app.FTS_AVAILABLE, reason='SQLite built without FTS5')
+
+
+def login(name):
+    client = app.app.test_client()
+    client.post('/signup', data={'username': name, 'password': 'pw'})
+    client.post('/login', data={'username': name, 'password': 'pw'})
+    return client
+
+
+def user_id(name):
+    with app.db_pool.connection() as conn:
+        return conn.execute('SELECT id FROM user WHERE username = ?', (name,)).fetchone()[0]
+
+
+def search(client, q, **params):
+    response = client.get('/api/search_messages', query_string={'q': q, **params})
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def test_message_search_covers_own_direct_and_group_conversations_only():
+    ann, bob, cat = login('msearch_ann'), login('msearch_bob'), login('msearch_cat')
+    bob_id = user_id('msearch_bob')
+    ann_socket = app.socketio.test_client(app.app, flask_test_client=ann)
+    ann_socket.emit('private_message', {'to': bob_id, 'message': 'the <b>zephyrquux</b> plan'})
+    ann_socket.emit('group_create', {'name': 'msearch group', 'member_ids': []})
+    group_id = next(packet['args'][0]['group_id'] for packet in ann_socket.get_received()
+                    if packet['name'] == 'group_created')
+    ann_socket.emit('group_message', {'group_id': group_id, 'message': 'zephyrquux in the group'})
+
+    results = search(ann, 'zephyrq')['results']
+    assert sorted(result['type'] for result in results) == ['direct', 'group']
+    direct = next(result for result in results if result['type'] == 'direct')
+    assert direct['friend_id'] == bob_id and direct['sender'] == 'msearch_ann'
+    assert direct['snippet'] == 'the &lt;b&gt;<mark>zephyrquux</mark>&lt;/b&gt; plan'
+    group = next(result for result in results if result['type'] == 'group')
+    assert group['group_id'] == group_id and group['group_name'] == 'msearch group'
+
+    # bob sees the direct message, not the group he is not in; cat sees nothing
+    assert [result['type'] for result in search(bob, 'zephyrquux')['results']] == ['direct']
+    assert search(cat, 'zephyrquux')['results'] == []
+    assert search(ann, 'zephyrquux plan')['results'][0]['type'] == 'direct'
+
+    page = search(ann, 'zephyrquux', limit=1)
+    assert len(page['results']) == 1 and page['has_more']
+    assert not search(ann, 'zephyrquux', limit=1, offset=1)['has_more']
+
+
+def test_message_search_quotes_user_input():
+    client = login('msearch_quoter')
+    for q in ('"', 'a OR b', 'NEAR(', '*', 'col:umn', ''):
+        assert search(client, q)['results'] == []
+    assert app.fts_query('say "hi" now') == '"say" """hi""" "now"*'
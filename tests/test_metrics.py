@@ -0,0 +1,56 @@
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import app
+
+
+def sample(text, name):
+    return [line for line in text.splitlines() if line.startswith(name)]
+
+
+def test_metrics_cover_routes_sql_and_socket_events():
+    client = app.app.test_client()
+    client.post('/signup', data={'username': 'metrics_ann', 'password': 'pw'})
+    socket = app.socketio.test_client(app.app, flask_test_client=client)
+    socket.emit('delivered', {'message_id': 1})
+
+    text = client.get('/metrics').get_data(as_text=True)
+
+    assert sample(text, 'chatapp_http_request_seconds_count{endpoint="signup",method="POST"')
+    assert sample(text, 'chatapp_sql_seconds_count{verb="INSERT",table="user"}')
+    assert sample(text, 'chatapp_socketio_event_seconds_count{event="delivered"}')
+
+
+def test_metrics_token_is_required_when_configured(monkeypatch):
+    monkeypatch.setattr(app, 'METRICS_TOKEN', 'sekrit')
+    client = app.app.test_client()
+    assert client.get('/metrics').status_code == 401
+    assert client.get('/metrics', headers={'Authorization': 'Bearer sekrit'}).status_code == 200
+
+
+def test_sql_label_extraction():
+    assert app.sql_labels('SELECT id FROM user WHERE username = ?') == ('SELECT', 'user')
+    assert app.sql_labels('insert or ignore into message (id) values (?)') == ('INSERT', 'message')
+    assert app.sql_labels('CREATE TABLE IF NOT EXISTS foo (x)') == ('CREATE', 'foo')
+
+
+def test_offloaded_sql_is_recorded_in_the_calling_thread(monkeypatch):
+    # Stand-in for eventlet's tpool: the statement runs on another OS thread,
+    # the metric must not be taken there
+    offload = ThreadPoolExecutor(1)
+    monkeypatch.setattr(app, 'ASYNC_MODE', 'eventlet')
+    monkeypatch.setattr(app, 'run_blocking', lambda fn, *args: offload.submit(fn, *args).result())
+    observed = []
+    monkeypatch.setattr(app.sql_latency, 'observe', lambda value, *labels: observed.append(
+        (threading.get_ident(), labels)))
+
+    conn = sqlite3.connect(':memory:', factory=app.InstrumentedConnection, check_same_thread=False)
+    cursor = app.OffloadedCursor(conn.cursor())
+    cursor.execute('CREATE TABLE t (x)')
+    cursor.execute('SELECT x FROM t').fetchall()
+    offload.shutdown()
+
+    assert observed == [(threading.get_ident(), ('CREATE', 't')),
+                        (threading.get_ident(), ('SELECT', 't')),
+                        (threading.get_ident(), ('SELECT', 't'))]
@@ -0,0 +1,69 @@
+import sqlite3
+from datetime import datetime
+
+import app
+
+
+def ms(text):
+    return int(datetime.fromisoformat(text).timestamp() * 1000)
+
+
+def test_migrations_backfill_legacy_timestamps(tmp_path):
+    conn = sqlite3.connect(tmp_path / 'legacy.db', isolation_level='')
+    conn.row_factory = sqlite3.Row
+    # Schema and data as written before the migration runner existed
+    app.create_schema(conn)
+    conn.executemany("INSERT INTO user (id, username, password_hash, profile_picture) VALUES (?, ?, 'x', '')",
+                     [(1, 'ann'), (2, 'bob')])
+    conn.executemany('INSERT INTO message (id, sender_id, receiver_id, message, timestamp, read, read_at) '
+                     'VALUES (?, ?, ?, ?, ?, ?, ?)', [
+                         (1, 1, 2, 'late', '11:50 PM', 1, None),
+                         (2, 2, 1, 'after midnight', '12:10 AM', 1, '2024-03-02 00:20:00'),
+                         (3, 1, 2, 'morning', '09:00 AM', 0, None),
+                         (4, 2, 1, 'reply', '09:01 AM', 1, '2024-03-02 09:05:00'),
+                     ])
+    conn.execute('INSERT INTO "group" (id, name, owner_id) VALUES (1, \'g\', 1)')
+    conn.executemany('INSERT INTO group_message (id, group_id, sender_id, message, timestamp) VALUES (?, 1, 1, ?, ?)',
+                     [(1, 'no time', None), (2, 'iso', '2024-03-02 08:00:00')])
+    conn.commit()
+    assert app.schema_version(conn) == 0
+
+    applied = app.migrate(conn)
+
+    assert applied == [version for version, _ in app.MIGRATIONS]
+    assert app.schema_version(conn) == app.MIGRATIONS[-1][0]
+    # Clock-only times land on the latest day that keeps ids in order and
+    # every message no later than its read_at
+    assert [tuple(row) for row in conn.execute('SELECT id, timestamp FROM message ORDER BY id')] == [
+        (1, ms('2024-03-01 23:50:00')),
+        (2, ms('2024-03-02 00:10:00')),
+        (3, ms('2024-03-02 09:00:00')),
+        (4, ms('2024-03-02 09:01:00')),
+    ]
+    # A missing group timestamp inherits the next message's
+    assert [tuple(row) for row in conn.execute('SELECT id, timestamp FROM group_message ORDER BY id')] == [
+        (1, ms('2024-03-02 08:00:00')),
+        (2, ms('2024-03-02 08:00:00')),
+    ]
+    assert {tuple(row) for row in conn.execute('SELECT user_id, peer_id, last_message_id, last_timestamp, unread '
+                                               'FROM conversation')} == {
+        (1, 2, 4, ms('2024-03-02 09:01:00'), 0),
+        (2, 1, 4, ms('2024-03-02 09:01:00'), 1),
+    }
+    # Re-running is a no-op
+    assert app.migrate(conn) == []
+    conn.close()
+
+
+def test_migrate_command_stops_at_the_requested_version(tmp_path, monkeypatch):
+    pool = app.ConnectionPool(str(tmp_path / 'fresh.db'))
+    monkeypatch.setattr(app, 'db_pool', pool)
+    runner = app.app.test_cli_runner()
+
+    result = runner.invoke(args=['migrate', '--to', '2'])
+    assert 'Schema version 0 -> 2 (2 migration(s) applied' in result.output
+    with pool.connection() as conn:
+        assert app.schema_version(conn) == 2
+
+    result = runner.invoke(args=['migrate'])
+    assert f'Schema version 2 -> {app.MIGRATIONS[-1][0]}' in result.output
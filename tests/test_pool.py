@@ -0,0 +1,40 @@
+import threading
+
+import pytest
+
+import app
+
+
+def test_pool_reuses_connections_lifo_and_rolls_back_dangling_transactions(tmp_path):
+    pool = app.ConnectionPool(str(tmp_path / 'pool.db'), size=2, timeout=0.1)
+    with pool.connection() as conn:
+        assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        conn.execute('CREATE TABLE t (x)')
+        conn.commit()
+        conn.execute('INSERT INTO t VALUES (1)')
+        first = conn
+
+    with pool.connection() as conn:
+        assert conn is first
+        assert not conn.in_transaction
+        assert conn.execute('SELECT COUNT(*) FROM t').fetchone()[0] == 0
+    assert pool.stats()['created'] == 1 and pool.stats()['checked_out'] == 0
+
+
+def test_pool_is_bounded_and_times_out_waiters(tmp_path):
+    pool = app.ConnectionPool(str(tmp_path / 'pool.db'), size=2, timeout=0.1)
+    held = [pool.acquire(), pool.acquire()]
+    with pytest.raises(RuntimeError):
+        pool.acquire()
+
+    # A waiter gets the next connection released
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(pool.acquire()))
+    pool.timeout = 5
+    waiter.start()
+    pool.release(held.pop())
+    waiter.join()
+    assert got and pool.stats()['created'] == 2
+
+    stats = pool.stats()
+    assert stats['timeouts'] == 1 and stats['waits'] >= 1 and stats['checked_out'] == 2
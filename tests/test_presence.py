@@ -0,0 +1,53 @@
+import time
+
+import app
+
+
+def login(name):
+    client = app.app.test_client()
+    client.post('/signup', data={'username': name, 'password': 'pw'})
+    client.post('/login', data={'username': name, 'password': 'pw'})
+    return client
+
+
+def user_id(name):
+    with app.db_pool.connection() as conn:
+        return conn.execute('SELECT id FROM user WHERE username = ?', (name,)).fetchone()[0]
+
+
+def pushed_status(socket, about, timeout=5):
+    # The presence worker may push first; either way the update reaches the friend
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        app.push_presence()
+        for packet in socket.get_received():
+            if packet['name'] == 'presence':
+                for update in packet['args'][0]['users']:
+                    if update['id'] == about:
+                        return update['status']
+        time.sleep(0.05)
+    raise AssertionError(f'no presence update for {about}')
+
+
+def test_presence_is_pushed_to_friends_and_served_in_batches():
+    ann, bob, eve = login('presence_ann'), login('presence_bob'), login('presence_eve')
+    ann_id, bob_id, eve_id = user_id('presence_ann'), user_id('presence_bob'), user_id('presence_eve')
+    ann.post('/api/send_friend_request', json={'friend_id': bob_id})
+    bob.post('/api/accept_friend_request', json={'friend_id': ann_id})
+
+    bob_socket = app.socketio.test_client(app.app, flask_test_client=bob)
+    eve_socket = app.socketio.test_client(app.app, flask_test_client=eve)
+    ann_socket = app.socketio.test_client(app.app, flask_test_client=ann)
+    assert pushed_status(bob_socket, ann_id) == 'online'
+
+    batch = bob.get(f'/api/presence?ids={ann_id},{eve_id},{ann_id}').get_json()['presence']
+    assert batch.keys() == {str(ann_id), str(eve_id)}
+    assert batch[str(ann_id)]['status'] == 'online' and batch[str(ann_id)]['last_seen'] == 'just now'
+    assert bob.get('/api/presence?ids=x').status_code == 400
+
+    ann_socket.disconnect()
+    assert pushed_status(bob_socket, ann_id) == 'offline'
+    assert bob.get(f'/api/last_seen?friend_id={ann_id}').get_json()['status'] == 'offline'
+    # Not a friend: nothing about ann is pushed to eve
+    assert not [packet for packet in eve_socket.get_received() if packet['name'] == 'presence'
+                and any(update['id'] == ann_id for update in packet['args'][0]['users'])]
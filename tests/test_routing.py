@@ -0,0 +1,24 @@
+import pytest
+
+import app
+
+
+def test_shared_router_reuses_the_handler_connection(monkeypatch):
+    router = app.SharedRouter()
+    with app.app.test_request_context():
+        app.get_db()
+
+        def exhausted():
+            pytest.fail('checked out a second pool connection while holding g.db')
+
+        monkeypatch.setattr(app.db_pool, 'connection', exhausted)
+        router._last_heartbeat = 0  # register heartbeats on the same connection too
+        router.register(4242, 'sid-a')
+        router.register(4242, 'sid-b')
+        assert sorted(router.sids([4242, 4343])[4242]) == ['sid-a', 'sid-b']
+        assert app.PresenceRegistry(router).online([4242, 4343]) == {4242}
+        assert router.local_sids(4242) == {'sid-a', 'sid-b'}
+        router.unregister(4242, 'sid-a')
+        router.unregister(4242, 'sid-b')
+        assert router.sids([4242]) == {}
+        assert router.local_sids(4242) == set()
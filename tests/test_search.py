@@ -0,0 +1,50 @@
+import app
+
+
+def login(name):
+    client = app.app.test_client()
+    client.post('/signup', data={'username': name, 'password': 'pw'})
+    client.post('/login', data={'username': name, 'password': 'pw'})
+    return client
+
+
+def user_id(name):
+    with app.db_pool.connection() as conn:
+        return conn.execute('SELECT id FROM user WHERE username = ?', (name,)).fetchone()[0]
+
+
+def befriend(a, b):
+    a.post('/api/send_friend_request', json={'friend_id': user_id(b.name)})
+    b.post('/api/accept_friend_request', json={'friend_id': user_id(a.name)})
+
+
+def search(client, query, **params):
+    response = client.get('/api/search_users', query_string={'query': query, **params})
+    assert response.status_code == 200
+    return [(user['username'], user['mutual_friends']) for user in response.get_json()]
+
+
+def test_search_ranks_friends_of_friends_then_prefix_then_length_and_pages_in_order():
+    clients = {}
+    for name in ('qzv_me', 'qzv_pal', 'qzvcarol', 'qzvab', 'x_qzv_x'):
+        clients[name] = login(name)
+        clients[name].name = name
+    befriend(clients['qzv_me'], clients['qzv_pal'])
+    befriend(clients['qzv_pal'], clients['qzvcarol'])
+    me = clients['qzv_me']
+
+    expected = [('qzvcarol', 1), ('qzvab', 0), ('qzv_pal', 0)]
+    if app.FTS_AVAILABLE:
+        expected.append(('x_qzv_x', 0))
+    assert search(me, 'qzv') == expected
+    assert search(me, 'qzv', limit=2) + search(me, 'qzv', limit=2, offset=2) == expected
+    assert search(me, 'qzv', fof=0)[:3] == [('qzvab', 0), ('qzv_pal', 0), ('qzvcarol', 0)]
+
+
+def test_search_treats_like_wildcards_literally():
+    client = login('qzw_searcher')
+    for name in ('qzw_one', 'qzwxtwo', 'qzw%three'):
+        login(name)
+    assert [name for name, _ in search(client, 'qzw_')] == ['qzw_one']
+    assert [name for name, _ in search(client, 'qzw%')] == ['qzw%three']
+    assert search(client, 'qzw\\') == []
@@ -0,0 +1,47 @@
+import app
+
+
+def login(name):
+    client = app.app.test_client()
+    client.post('/signup', data={'username': name, 'password': 'pw'})
+    client.post('/login', data={'username': name, 'password': 'pw'})
+    return client
+
+
+def test_malformed_connect_and_delivered_payloads_are_ignored():
+    client = login('socket_junk')
+    for auth in ('junk', ['device'], 42):
+        socket = app.socketio.test_client(app.app, flask_test_client=client, auth=auth)
+        assert socket.is_connected()
+        socket.disconnect()
+
+    socket = app.socketio.test_client(app.app, flask_test_client=client, auth={'device_id': 'junk-device'})
+    with app.db_pool.connection() as conn:
+        # A new device's cursor starts at the current tip
+        tip = tuple(conn.execute("SELECT message_id, group_message_id FROM device_cursor WHERE device_id = 'junk-device'"
+                                 ).fetchone())
+    for payload in ('junk', None, [1], {'message_id': 'x'}, {'message_id': {}}, {'message_id': 2 ** 70},
+                    {'message_id': -1}):
+        socket.emit('delivered', payload)
+    socket.emit('delivered')
+    socket.emit('delivered', {'message_id': tip[0] + 5, 'group_message_id': str(tip[1] + 3)})
+    assert socket.is_connected()
+    with app.db_pool.connection() as conn:
+        cursor = conn.execute("SELECT message_id, group_message_id FROM device_cursor WHERE device_id = 'junk-device'"
+                              ).fetchone()
+    assert tuple(cursor) == (tip[0] + 5, tip[1] + 3)
+
+
+def test_private_message_without_text_is_ignored():
+    client = login('socket_text_ann')
+    login('socket_text_bob')
+    with app.db_pool.connection() as conn:
+        bob = conn.execute("SELECT id FROM user WHERE username = 'socket_text_bob'").fetchone()[0]
+        before = conn.execute('SELECT COUNT(*) FROM message').fetchone()[0]
+    socket = app.socketio.test_client(app.app, flask_test_client=client)
+    for text in ({'x': 1}, ['a'], 5, '', None):
+        socket.emit('private_message', {'to': bob, 'message': text})
+    socket.emit('private_message', {'to': bob, 'file_id': 1, 'filetype': {'x': 1}, 'filename': 'a'})
+    assert socket.is_connected()
+    with app.db_pool.connection() as conn:
+        assert conn.execute('SELECT COUNT(*) FROM message').fetchone()[0] == before
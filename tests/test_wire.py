@@ -0,0 +1,62 @@
+import app
+
+
+def login(name):
+    client = app.app.test_client()
+    client.post('/signup', data={'username': name, 'password': 'pw'})
+    client.post('/login', data={'username': name, 'password': 'pw'})
+    return client
+
+
+def user_id(name):
+    with app.db_pool.connection() as conn:
+        return conn.execute('SELECT id FROM user WHERE username = ?', (name,)).fetchone()[0]
+
+
+def test_compact_wire_format_shortens_keys_and_splits_file_messages(monkeypatch):
+    message = {'id': 7, 'from_id': 1, 'to_id': 2, 'message': 'hi', 'timestamp': 1700000000000, 'filename': None}
+    assert app.wire_message(message) is message
+    assert app.wire_config()['fields'] is None
+
+    monkeypatch.setattr(app, 'SOCKET_COMPACT', True)
+    assert app.wire_message(message) == {'i': 7, 'f': 1, 't': 2, 'm': 'hi', 'ts': 1700000000000}
+    assert app.wire_message(dict(message, message='[fileid]12|image/png|a|b.png')) == {
+        'i': 7, 'f': 1, 't': 2, 'ts': 1700000000000, 'fi': '12', 'ft': 'image/png', 'fn': 'a|b.png'}
+    assert app.wire_config()['fields'] == app.WIRE_FIELDS
+
+
+def test_compact_mode_reaches_socket_clients(monkeypatch):
+    monkeypatch.setattr(app, 'SOCKET_COMPACT', True)
+    ann, bob = login('wire_ann'), login('wire_bob')
+    bob_socket = app.socketio.test_client(app.app, flask_test_client=bob)
+    bob_socket.get_received()
+    app.socketio.test_client(app.app, flask_test_client=ann).emit(
+        'private_message', {'to': user_id('wire_bob'), 'message': 'short keys'})
+    [packet] = [packet for packet in bob_socket.get_received() if packet['name'] == 'private_message']
+    assert packet['args'][0]['m'] == 'short keys' and packet['args'][0]['f'] == user_id('wire_ann')
+
+
+def test_batcher_coalesces_events_per_room_into_one_frame():
+    cat = app.socketio.test_client(app.app, flask_test_client=login('wire_cat'))
+    cat.get_received()
+    room = app.user_room(user_id('wire_cat'))
+    batcher = app.OutboundBatcher(window=60, max_batch=3)
+    batcher._started = True  # flushed by hand below, not by the background task
+
+    batcher.emit('private_message', {'m': 'one'}, room)
+    batcher.emit('group_message', {'m': 'two'}, room)
+    assert cat.get_received() == [] and batcher.pending() == 2
+    batcher.flush()
+    [frame] = cat.get_received()
+    assert frame['name'] == 'messages'
+    assert frame['args'][0] == [['private_message', {'m': 'one'}], ['group_message', {'m': 'two'}]]
+
+    batcher.emit('private_message', {'m': 'alone'}, room)
+    batcher.flush()
+    assert [(packet['name'], packet['args'][0]) for packet in cat.get_received()] == [
+        ('private_message', {'m': 'alone'})]
+
+    for text in ('a', 'b', 'c'):
+        batcher.emit('private_message', {'m': text}, room)
+    assert [len(packet['args'][0]) for packet in cat.get_received()] == [3]  # a full batch goes at once
+    assert (batcher.frames, batcher.events, batcher.pending()) == (3, 6, 0)
@@ -0,0 +1,179 @@
+import json
+import os
+import time
+from datetime import datetime
+
+import pytest
+
+import app
+
+
+def ms(text):
+    return int(datetime.fromisoformat(text).timestamp() * 1000)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+def user_ids(*names):
+    with app.db_pool.connection() as conn:
+        for name in names:
+            conn.execute("INSERT OR IGNORE INTO user (username, password_hash, profile_picture) VALUES (?, 'x', '')",
+                         (name,))
+        conn.commit()
+        return [conn.execute('SELECT id FROM user WHERE username = ?', (name,)).fetchone()[0] for name in names]
+
+
+def message(message_id):
+    with app.db_pool.connection() as conn:
+        return conn.execute('SELECT sender_id, receiver_id, message FROM message WHERE id = ?',
+                            (message_id,)).fetchone()
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = app.WriteBehindQueue(str(tmp_path / 'journal'), interval=0.001)
+    yield queue
+    queue.stop()
+
+
+def test_replay_commits_journal_and_truncates_it(queue):
+    ann, bob = user_ids('wb_replay_ann', 'wb_replay_bob')
+    with app.db_pool.connection() as conn:
+        next_id = app.WriteBehindQueue.last_used_id(conn, 'message') + 1
+    with open(queue.journal_path, 'w') as journal:
+        journal.write(json.dumps(['message', next_id, ann, bob, 'acked before crash', app.now_ms()]) + '\n')
+        journal.write(json.dumps(['message', next_id + 1, bob, ann, 'second', app.now_ms()]) + '\n')
+        journal.write('["message", 12')  # torn final write
+
+    queue.replay()
+    queue.replay()  # idempotent: explicit ids make the second pass a no-op
+
+    assert tuple(message(next_id)) == (ann, bob, 'acked before crash')
+    assert tuple(message(next_id + 1)) == (bob, ann, 'second')
+    assert os.path.getsize(queue.journal_path) == 0
+    with app.db_pool.connection() as conn:
+        unread = conn.execute('SELECT unread FROM conversation WHERE user_id = ? AND peer_id = ?', (bob, ann)).fetchone()
+    assert unread[0] == 1
+
+
+def test_ids_are_not_reused_after_archiving(queue, monkeypatch, tmp_path):
+    monkeypatch.setattr(app, 'ARCHIVE_FOLDER', str(tmp_path / 'archive'))
+    ann, bob = user_ids('wb_ids_ann', 'wb_ids_bob')
+    with app.db_pool.connection() as conn:
+        archived = app.insert_private_messages(conn, [
+            (None, ann, bob, 'old', ms('2020-01-10 12:00:00')),
+            (None, bob, ann, 'older reply', ms('2020-01-11 12:00:00')),
+        ])
+        conn.commit()
+        app.archive_messages(conn, ms('2021-01-01 00:00:00'))
+        assert app.WriteBehindQueue.last_used_id(conn, 'message') >= max(archived)
+
+    queue.start()
+    new_id = queue.submit('message', (ann, bob, 'new', app.now_ms()))
+    assert new_id > max(archived)
+    wait_for(lambda: message(new_id) is not None)
+    # Explicit ids keep sqlite_sequence current for the next start
+    with app.db_pool.connection() as conn:
+        assert conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'message'").fetchone()[0] >= new_id
+
+
+def test_failed_commit_is_retried_and_journal_truncated(queue, monkeypatch):
+    ann, bob = user_ids('wb_retry_ann', 'wb_retry_bob')
+    monkeypatch.setattr(app, 'WRITE_BEHIND_RETRY_MIN', 0.01)
+    insert = app.MESSAGE_INSERTERS['message']
+    failures = []
+
+    def flaky(conn, rows):
+        if len(failures) < 2:
+            failures.append(rows)
+            raise app.sqlite3.OperationalError('database is locked')
+        return insert(conn, rows)
+
+    monkeypatch.setitem(app.MESSAGE_INSERTERS, 'message', flaky)
+    queue.start()
+    message_id = queue.submit('message', (ann, bob, 'survives a failed commit', app.now_ms()))
+
+    wait_for(lambda: message(message_id) is not None)
+    assert len(failures) == 2
+    wait_for(lambda: queue.stats()['pending'] == 0)
+    assert os.path.getsize(queue.journal_path) == 0
+    assert queue.stats()['messages'] == 1
+
+
+def test_row_that_can_never_commit_is_set_aside(queue):
+    ann, bob = user_ids('wb_poison_ann', 'wb_poison_bob')
+    queue.start()
+    bad_id = queue.submit('message', (ann, bob, {'x': 1}, app.now_ms()))
+    good_id = queue.submit('message', (ann, bob, 'after the bad one', app.now_ms()))
+
+    wait_for(lambda: message(good_id) is not None)
+    wait_for(lambda: queue.stats()['pending'] == 0)
+    assert message(bad_id) is None
+    assert os.path.getsize(queue.journal_path) == 0
+    with open(queue.dead_letter_path) as dead:
+        assert [json.loads(line)[1] for line in dead] == [bad_id]
+
+
+def test_replay_sets_aside_bad_rows_instead_of_failing(queue):
+    ann, bob = user_ids('wb_replay_poison_ann', 'wb_replay_poison_bob')
+    with app.db_pool.connection() as conn:
+        next_id = app.WriteBehindQueue.last_used_id(conn, 'message') + 1
+    with open(queue.journal_path, 'w') as journal:
+        journal.write(json.dumps(['message', next_id, ann, bob, {'x': 1}, app.now_ms()]) + '\n')
+        journal.write(json.dumps(['no_such_table', 1]) + '\n')
+        journal.write(json.dumps(['message', next_id + 1, ann, bob, 'kept', app.now_ms()]) + '\n')
+
+    queue.replay()
+
+    assert message(next_id) is None
+    assert tuple(message(next_id + 1)) == (ann, bob, 'kept')
+    assert os.path.getsize(queue.journal_path) == 0
+    assert queue.stats()['dead'] == 2
+
+
+def test_journal_is_rewritten_to_the_uncommitted_tail(queue, monkeypatch):
+    ann, bob = user_ids('wb_rotate_ann', 'wb_rotate_bob')
+    monkeypatch.setattr(app, 'WRITE_BEHIND_ROTATE_BYTES', 1)
+    insert = app.MESSAGE_INSERTERS['message']
+    entered, gates = [], [app.threading.Event(), app.threading.Event()]
+
+    def gated(conn, rows):
+        entered.append(rows)
+        gates[len(entered) - 1].wait(5)
+        return insert(conn, rows)
+
+    monkeypatch.setitem(app.MESSAGE_INSERTERS, 'message', gated)
+    queue.start()
+    first = queue.submit('message', (ann, bob, 'first', app.now_ms()))
+    wait_for(lambda: len(entered) == 1)
+    second = queue.submit('message', (ann, bob, 'second', app.now_ms()))
+
+    # The first batch commits while the second is still pending: only its row is left
+    gates[0].set()
+    wait_for(lambda: message(first) is not None)
+    wait_for(lambda: len(entered) == 2)
+    with open(queue.journal_path) as journal:
+        assert [json.loads(line)[1] for line in journal] == [second]
+
+    gates[1].set()
+    wait_for(lambda: queue.stats()['pending'] == 0)
+    assert os.path.getsize(queue.journal_path) == 0
+
+
+def test_group_messages_keep_their_epoch_ms_timestamp(queue):
+    ann, = user_ids('wb_group_ann')
+    timestamp = app.now_ms()
+    queue.start()
+    message_id = queue.submit('group_message', (1, ann, 'hello group', timestamp))
+
+    def stored():
+        with app.db_pool.connection() as conn:
+            return conn.execute('SELECT timestamp, typeof(timestamp) FROM group_message WHERE id = ?',
+                                (message_id,)).fetchone()
+    wait_for(lambda: stored() is not None)
+    assert tuple(stored()) == (timestamp, 'integer')